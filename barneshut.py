@@ -1,8 +1,14 @@
-import matplotlib.pyplot as plt
-from matplotlib import animation, colors, colormaps
-import numpy as np
-from structures import Body, QuadTree
+import os
 import time
+from initial_conditions import uniform
+from kernels import set_backend
+from simulation import Simulation, TreeEngine, MultipoleEngine, MemorySink, TrajectorySink, Viewer
+from outlines import OutlineRecorder
+from integrators import make_integrator
+from blockstep import BlockStepper
+from instrumentation import Profiler
+from checkpoint import Checkpointer, resume
+from diagnostics import Diagnostics
 
 # Simulation scale:
 # 1 pixel per million km
@@ -13,138 +19,72 @@ DELTA = 0.01 # 0.01 seconds per frame
 TSTEP = 59220 # 10 week per frame 
 SIM_SPEED = 1# 1 steps per frame
 SIM_LEN = 1000
-G = 6.67430e-11
 BODIES = 500 
 MASS = 1e24 # 1 septillion kg, roughly 1/5 of earth
 RADIUS = 1e6 # 1 million meters, roughly 1/6 of earth
+SEED = 0 # seed of the initial conditions, None draws different bodies every run
+DIMENSIONS = 2 # 3 starts the bodies in a cube and runs them in 3D with the array-backed octree
 SOFT_PARAM = 1e7 # softening parameter
 TREE_UPDATE_FREQ = 5 # how many steps between quadtree updates
+INCREMENTAL_TREE = True # refit the quadtree every step instead of rebuilding it every TREE_UPDATE_FREQ steps
+REBUILD_THRESHOLD = 0.25 # fraction of badly binned bodies that triggers a full rebuild of a refitted quadtree
 LINE_TOGGLE = False
 NODE_DISTANCE_RATIO = 1 
 BODY_LIMIT = 1
-
-def gforce(m1, m2, vec_r):
-    # calculate gravitational force between two bodies
-    #print(vec_r)
-    r = np.linalg.norm(vec_r)
-    #print(r)
-    if r == 0:
-        return np.array([0.0, 0.0])
-    dir_r = vec_r / r
-    force_mag = G * m1 * m2 / (r ** 2 + SOFT_PARAM ** 2)
-    return force_mag * dir_r
-
-
-def calculate_total_force(body, quadtree):
-    if quadtree.get_ratio(body) < NODE_DISTANCE_RATIO:
-        return gforce(body.mass, quadtree.get_total_mass(), quadtree.center_mass - body.pos)
+ESCAPERS = 'expand' # bodies leaving the quadtree root: 'expand' grows the root, 'drop' ignores them, 'direct' sums them directly
+FLAT_TREE = True # use the array-backed quadtree and its iterative traversal
+QUADRUPOLE = False # add the quadrupole moment of approximated nodes
+COLLISIONS = False # merge overlapping bodies every step
+WORKERS = 1 # processes sharing the force calculation of the array-backed quadtree
+BACKEND = None # 'numpy' or 'numba' compiled kernels, None picks numba when it is installed
+TRAJECTORY_FILE = None # stream frames to this file instead of keeping them in memory
+INTEGRATOR = 'leapfrog' # 'euler', 'leapfrog' (one force evaluation per step) or 'yoshida4' (three, 4th order)
+BLOCK_LEVELS = 0 # individual power-of-two timesteps down to TSTEP / 2^BLOCK_LEVELS, 0 steps every body with INTEGRATOR
+BLOCK_ETA = 0.1 # accuracy parameter of the individual timesteps
+FMM_ORDER = 0 # use the fast multipole engine with this many expansion nodes per axis instead of the tree walk, 0 disables
+PERIODIC = False # wrap bodies into the BOX they start in and add the forces of its periodic images
+BOX = 1e9 # side of the periodic box in meters
+PROFILE = False # time the phases of every step and count the tree work, printed as a summary at the end
+PROFILE_LOG = None # also write one JSON line per step to this file
+CHECKPOINT_FILE = None # save the complete state of the run to this file every CHECKPOINT_EVERY steps
+CHECKPOINT_EVERY = 100
+RESUME = True # continue from CHECKPOINT_FILE when it exists instead of starting over
+DIAGNOSTICS_EVERY = 0 # measure energy, momentum, angular momentum and virial ratio every this many steps, 0 disables
+ENERGY_TOLERANCE = None # stop the run when the relative energy error exceeds this
+
+def simulate(particles, sim_len, show=True):
+    if PERIODIC and (not FLAT_TREE or FMM_ORDER > 0):
+        raise ValueError('PERIODIC is only supported by the array-backed quadtree (FLAT_TREE)')
+    if FMM_ORDER > 0:
+        engine = MultipoleEngine(FMM_ORDER, SOFT_PARAM)
+        print('FMM error against direct summation:', engine.fmm.error(particles.pos, particles.mass))
     else:
-        force = np.array([0.0, 0.0])
-        for child in quadtree.children:
-            force += calculate_total_force(body, child)
-        return force
-    
-
-def collide(body1, body2):
-    if np.linalg.norm(body1.pos - body2.pos) < body1.radius + body2.radius:
-        body1.vel = (body1.vel * body1.mass + body2.vel * body2.mass) / (body1.mass + body2.mass)
-        body1.mass += body2.mass
-        body1.radius = (body1.radius ** 3 + body2.radius ** 3) ** (1/3)
-        return True
-    return False
-
-
-def simulate(bodies, sim_len):
-    simulation = [np.array([body.pos for body in bodies])]
-    tree_ev = []
-    quadtree = QuadTree([0, 0, 1e9, 1e9], BODY_LIMIT, bodies)
-    for k in range(sim_len):
-        positions = []
-        # calculate ratio for each body
-        for body in bodies:
-            body.acc = np.array([0.0, 0.0])
-            body.acc = calculate_total_force(body, quadtree) / body.mass
-            #print(f'acceleration: {body.acc}')
-            body.update(DELTA, TSTEP)
-            positions.append(body.pos)
-            # traverse quadtree
-        if k % 10 == 0:
-            print("\033[H\033[J", end="")
-            print(f"{k*100.0/float(sim_len)}% done")
-        # update quadtree
-        if k % TREE_UPDATE_FREQ == 0:
-            quadtree = QuadTree([0, 0, 1e9, 1e9], BODY_LIMIT, bodies)
-        tree_ev.append(quadtree)
-        simulation.append(np.array(positions))
-    return np.array(simulation), np.array(tree_ev)
-
-start_time = time.time()
-
-# create random bodies
-bodies = []
-for i in range(BODIES):
-    # set random positions (m) and velocities (m s^-1)
-    x = np.random.randint(0, 1e9)
-    y = np.random.randint(0, 1e9)
-    vx = np.random.randint(-1e3, 1e3)
-    vy = np.random.randint(-1e3, 1e3)
-    bodies.append(Body(np.array([x, y], dtype=float), np.array([vx, vy], dtype=float), MASS, RADIUS))
-
-scale = 1e-6
-bound = 1e9*scale
-simulation, tree_ev = simulate(bodies, SIM_LEN)
-
-fig = plt.figure()
-scatter = plt.scatter([], [], s=1, c='black', vmin=-1e1, vmax=1e1)
-if LINE_TOGGLE:
-    line_data = []
-    for tree in tree_ev:
-        line_data.append(tree.lines())
-    max_lines = max([len(lines) for lines in line_data])
-    lines = [plt.plot([], [], 'r-')[0] for _ in range(max_lines)]
-
-ax = fig.get_axes()
-ax[0].set_xlim(0, bound)
-ax[0].set_ylim(0, bound)
-ax[0].set_title(f'{BODIES} bodies equal masses and radii')
-ax[0].set_xlabel('x (million km)')
-ax[0].set_ylabel('y (million km)')
-
-plt.gca().set_aspect('equal', adjustable='box') 
-
-print('Simulation time:', time.time() - start_time)
-
-print('Creating animation...')
-
-if LINE_TOGGLE:
-    def update(frame):
-        scatter.set_offsets(simulation[frame*SIM_SPEED]*scale)
-        current_data = line_data[frame]
-        num_lines = len(current_data)
-
-        for i in range(num_lines):
-            x1, y1, x2, y2 = current_data[i]
-            lines[i].set_data([x1*scale, x2*scale], [y1*scale, y2*scale])
-            lines[i].set_visible(True)
-
-        for i in range(num_lines, max_lines):
-            lines[i].set_data([], [])
-            lines[i].set_visible(False)
-
-        return lines + [scatter]
-else:
-    def update(frame):
-        scatter.set_offsets(simulation[frame*SIM_SPEED]*scale)
-        return [scatter]
-
-print('Frames:', SIM_LEN//SIM_SPEED)
-print('Frames per second:', 1/(DELTA))
-print(f'Timescale: {TSTEP*(1/DELTA)} seconds per second')
-print('Animation length:', SIM_LEN//SIM_SPEED*50/1000, 'seconds')
-
-print('Total time:', time.time() - start_time)
-
-anim = animation.FuncAnimation(fig, update, frames=range(SIM_LEN//SIM_SPEED), interval=DELTA*1000, blit=True)
-
-plt.show()
-plt.close()
\ No newline at end of file
+        engine = TreeEngine(NODE_DISTANCE_RATIO, BODY_LIMIT, SOFT_PARAM, FLAT_TREE, QUADRUPOLE, INCREMENTAL_TREE,
+                            REBUILD_THRESHOLD, TREE_UPDATE_FREQ, ESCAPERS, BOX if PERIODIC else None, WORKERS)
+    if BLOCK_LEVELS > 0:
+        integrator = BlockStepper(BLOCK_LEVELS, BLOCK_ETA, SOFT_PARAM)
+    else:
+        integrator = make_integrator(INTEGRATOR)
+    if TRAJECTORY_FILE:
+        sink = TrajectorySink(TRAJECTORY_FILE, BODIES, sim_len + 1, DELTA * TSTEP, dim=particles.dim)
+    else:
+        sink = MemorySink(BODIES, dim=particles.dim)
+    outlines = OutlineRecorder() if LINE_TOGGLE and FMM_ORDER == 0 else None
+    viewer = Viewer(1e9, f'{BODIES} bodies equal masses and radii', SIM_SPEED, DELTA) if show else None
+    checkpointer = Checkpointer(CHECKPOINT_FILE, CHECKPOINT_EVERY) if CHECKPOINT_FILE else None
+    diagnostics = Diagnostics(DIAGNOSTICS_EVERY, ENERGY_TOLERANCE) if DIAGNOSTICS_EVERY > 0 else None
+    simulation = Simulation(particles, engine, integrator, DELTA * TSTEP, sink, outlines, COLLISIONS,
+                            Profiler(PROFILE_LOG) if PROFILE else None, viewer, checkpointer=checkpointer,
+                            diagnostics=diagnostics)
+    if CHECKPOINT_FILE and RESUME and os.path.exists(CHECKPOINT_FILE):
+        resume(simulation, CHECKPOINT_FILE)
+        print('Resumed at step', simulation.steps_done)
+    return simulation.run(sim_len)
+
+
+if __name__ == '__main__':
+    if BACKEND is not None:
+        set_backend(BACKEND)
+    start_time = time.time()
+    simulate(uniform(BODIES, MASS, RADIUS, seed=SEED, dim=DIMENSIONS), SIM_LEN)
+    print('Total time:', time.time() - start_time)
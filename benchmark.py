@@ -0,0 +1,203 @@
+import argparse
+import csv
+import json
+import time
+import tracemalloc
+import numpy as np
+from structures import ParticleSet
+from initial_conditions import uniform
+from forces import SOFT_PARAM, direct_accelerations
+from flattree import FlatQuadTree
+from integrators import leapfrog
+import kernels
+
+NS = [100, 1000, 10000, 100000] # numbers of bodies
+THETAS = [0.5, 0.7, 1.0] # NODE_DISTANCE_RATIO values
+BODY_LIMITS = [1, 8, 32] # BODY_LIMIT values
+TREE_UPDATE_FREQS = [1, 5] # TREE_UPDATE_FREQ values
+STEPS = 5 # timed steps per configuration
+DT = 59220 * 0.01 # seconds per step, TSTEP * DELTA of the drivers
+DIRECT_MAX_N = 20000 # the direct engine is only timed up to this many bodies
+ERROR_SAMPLES = 256 # bodies compared with direct summation for the force error
+MASS = 1e24
+RADIUS = 1e6
+FIELDS = ['engine', 'backend', 'n', 'dim', 'theta', 'body_limit', 'tree_update_freq', 'steps', 'tree_time',
+          'force_time', 'integration_time', 'peak_memory', 'median_error', 'max_error']
+
+
+def initial_conditions(n, seed=0, dim=2) -> ParticleSet:
+    """Returns n bodies placed like the drivers place them: uniformly in the
+    [0, 1e9] box, or cube when dim is 3, with velocities up to 1 km/s.
+    """
+    return uniform(n, MASS, RADIUS, seed=seed, dim=dim)
+
+
+def force_error(pos, mass, acc, samples=ERROR_SAMPLES, seed=0):
+    """Returns the median and maximum relative error of acc against direct summation
+    on a random sample of the bodies.
+    """
+    rng = np.random.default_rng(seed)
+    targets = np.sort(rng.choice(len(pos), min(samples, len(pos)), replace=False))
+    exact = direct_accelerations(pos, mass, SOFT_PARAM, targets=targets)
+    relative = np.linalg.norm(acc[targets] - exact, axis=1) / np.linalg.norm(exact, axis=1)
+    return float(np.median(relative)), float(relative.max())
+
+
+def run(particles, steps, engine, theta=None, body_limit=None, tree_update_freq=None) -> dict:
+    """Advances particles by steps leapfrog steps with one engine and returns the
+    timings, the peak traced memory and the force error of the last evaluation.
+    Tree maintenance, force evaluation and the rest of the integration are timed
+    separately; with a tree, it is rebuilt every tree_update_freq steps like in
+    barneshut.py and reused in between.
+    """
+    timings = {'tree_time': 0.0, 'force_time': 0.0}
+    state = {'tree': None, 'built': None, 'step': 0, 'acc': None}
+
+    def accelerations(particles):
+        if engine == 'tree':
+            start = time.perf_counter()
+            # the first step evaluates twice, before and after its drift, on the same tree
+            if state['tree'] is None or (state['step'] % tree_update_freq == 0 and state['built'] != state['step']):
+                state['tree'] = FlatQuadTree(particles.pos, particles.mass, body_limit)
+                state['built'] = state['step']
+            timings['tree_time'] += time.perf_counter() - start
+        start = time.perf_counter()
+        if engine == 'tree':
+            acc = state['tree'].accelerations(particles.pos, particles.mass, theta, SOFT_PARAM)
+        else:
+            acc = direct_accelerations(particles.pos, particles.mass, SOFT_PARAM)
+        timings['force_time'] += time.perf_counter() - start
+        state['acc'] = acc
+        return acc
+
+    integrator = leapfrog()
+    tracemalloc.start()
+    start = time.perf_counter()
+    for step in range(steps):
+        state['step'] = step
+        integrator.step(particles, DT, accelerations)
+    total = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    median_error, max_error = force_error(particles.pos, particles.mass, state['acc'])
+    return {'engine': engine, 'backend': kernels.BACKEND, 'n': len(particles), 'dim': particles.dim, 'theta': theta, 'body_limit': body_limit,
+            'tree_update_freq': tree_update_freq, 'steps': steps,
+            'tree_time': timings['tree_time'] / steps, 'force_time': timings['force_time'] / steps,
+            'integration_time': (total - timings['tree_time'] - timings['force_time']) / steps,
+            'peak_memory': peak, 'median_error': median_error, 'max_error': max_error}
+
+
+def benchmark(ns=NS, thetas=THETAS, body_limits=BODY_LIMITS, tree_update_freqs=TREE_UPDATE_FREQS,
+              steps=STEPS, direct_max_n=DIRECT_MAX_N, seed=0, verbose=True, dim=2) -> list:
+    """Runs the direct engine and the Barnes-Hut tree over every combination of the
+    parameters and returns one result per configuration. Times are seconds per step
+    and memory is in bytes.
+    """
+    results = []
+    for n in ns:
+        configs = []
+        if n <= direct_max_n:
+            configs.append({'engine': 'direct'})
+        for theta in thetas:
+            for body_limit in body_limits:
+                for tree_update_freq in tree_update_freqs:
+                    configs.append({'engine': 'tree', 'theta': theta, 'body_limit': body_limit,
+                                    'tree_update_freq': tree_update_freq})
+        for config in configs:
+            result = run(initial_conditions(n, seed, dim), steps, **config)
+            results.append(result)
+            if verbose:
+                print(format_result(result))
+    return results
+
+
+def format_result(result) -> str:
+    """Returns a one line summary of a result.
+    """
+    params = '' if result['engine'] == 'direct' else \
+        f" theta={result['theta']} limit={result['body_limit']} freq={result['tree_update_freq']}"
+    return (f"{result['engine']:6s} {result.get('backend', 'numpy'):5s} n={result['n']:<7d}{result.get('dim', 2)}D{params:34s} tree {result['tree_time']:.4f}s"
+            f" force {result['force_time']:.4f}s integrate {result['integration_time']:.4f}s"
+            f" peak {result['peak_memory'] / 2 ** 20:.1f} MiB error {result['median_error']:.2e}")
+
+
+def key(result) -> tuple:
+    """Returns the parameters that identify the configuration of a result.
+    """
+    # results saved before 3D support are 2D, and before the numba kernels NumPy
+    return (result['engine'], result.get('backend', 'numpy'), result['n'], result.get('dim', 2), result['theta'], result['body_limit'],
+            result['tree_update_freq'])
+
+
+def compare(results, baseline, tolerance=0.2) -> list:
+    """Returns the results whose tree plus force time per step grew by more than
+    tolerance over the matching configuration of baseline.
+    """
+    reference = {key(result): result for result in baseline}
+    slower = []
+    for result in results:
+        old = reference.get(key(result))
+        if old is None:
+            continue
+        before = old['tree_time'] + old['force_time']
+        after = result['tree_time'] + result['force_time']
+        if after > before * (1 + tolerance):
+            slower.append(result)
+    return slower
+
+
+def write_json(results, path):
+    """Writes the results to a JSON file.
+    """
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+
+
+def write_csv(results, path):
+    """Writes the results to a CSV file, one row per configuration.
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the force engines over N and tree parameters.')
+    parser.add_argument('--n', type=int, nargs='+', default=NS, help='numbers of bodies')
+    parser.add_argument('--theta', type=float, nargs='+', default=THETAS, help='NODE_DISTANCE_RATIO values')
+    parser.add_argument('--body-limit', type=int, nargs='+', default=BODY_LIMITS, help='BODY_LIMIT values')
+    parser.add_argument('--tree-update-freq', type=int, nargs='+', default=TREE_UPDATE_FREQS,
+                        help='TREE_UPDATE_FREQ values')
+    parser.add_argument('--steps', type=int, default=STEPS, help='timed steps per configuration')
+    parser.add_argument('--direct-max-n', type=int, default=DIRECT_MAX_N, help='largest N run with the direct engine')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the initial conditions')
+    parser.add_argument('--dim', type=int, choices=[2, 3], default=2, help='dimensions of the bodies')
+    parser.add_argument('--backend', choices=kernels.BACKENDS, default=kernels.BACKEND,
+                        help='force kernels, numba when it is installed')
+    parser.add_argument('--json', default=None, help='write the results to this JSON file')
+    parser.add_argument('--csv', default=None, help='write the results to this CSV file')
+    parser.add_argument('--baseline', default=None, help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown reported against the baseline')
+    args = parser.parse_args(argv)
+
+    kernels.set_backend(args.backend)
+    if kernels.use_numba():
+        kernels.warm_up()
+    results = benchmark(args.n, args.theta, args.body_limit, args.tree_update_freq,
+                        args.steps, args.direct_max_n, args.seed, dim=args.dim)
+    if args.json is not None:
+        write_json(results, args.json)
+    if args.csv is not None:
+        write_csv(results, args.csv)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for result in slower:
+            print('Slower than baseline:', format_result(result))
+        if slower:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
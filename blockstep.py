@@ -0,0 +1,98 @@
+import numpy as np
+from forces import SOFT_PARAM
+
+MAX_LEVEL = 6 # smallest step is 2^-MAX_LEVEL of the block step
+ETA = 0.1 # accuracy parameter of the step criterion, smaller is more accurate
+
+
+class BlockStepper:
+    """A class to advance a ParticleSet with individual power-of-two block timesteps.
+    Each body steps with dt / 2^level, its level chosen from its acceleration and
+    jerk. A block step of dt is cut into substeps of the smallest step in use: every
+    substep drifts all bodies, but only the bodies whose own step ends there have
+    their accelerations evaluated and are kicked, kick-drift-kick leapfrog style.
+    Velocities are synchronized with positions at the end of every block step.
+    === Instance Attributes ===
+    max_level: The deepest level, so the smallest step is dt / 2^max_level.
+    eta: The accuracy parameter of the step criterion.
+    soft: The softening length used by the acceleration criterion.
+    levels: The step level of each body.
+    fresh: Whether particles.acc and levels match the current bodies.
+    evaluations: The number of single body force evaluations so far.
+    """
+    max_level: int
+    eta: float
+    soft: float
+    levels: np.ndarray
+    fresh: bool
+    evaluations: int
+
+    def __init__(self, max_level=MAX_LEVEL, eta=ETA, soft=SOFT_PARAM):
+        self.max_level = max_level
+        self.eta = eta
+        self.soft = soft
+        self.levels = None
+        self.fresh = False
+        self.evaluations = 0
+
+    def reset(self):
+        """Forgets the stored accelerations and levels, for example after bodies were
+        merged or removed. They are chosen again at the start of the next step.
+        """
+        self.fresh = False
+
+    def choose_levels(self, acc, jerk, dt) -> np.ndarray:
+        """Returns the level of the largest power-of-two step below
+        eta * min(sqrt(soft / |a|), |a| / |jerk|) for each body. Without a jerk
+        estimate only the acceleration term is used.
+        """
+        a = np.linalg.norm(acc, axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.sqrt(self.soft / a)
+            if jerk is not None:
+                step = np.fmin(step, a / np.linalg.norm(jerk, axis=1))
+            levels = np.ceil(np.log2(dt / (self.eta * step)))
+        levels = np.nan_to_num(levels, nan=0, posinf=self.max_level, neginf=0)
+        return np.clip(levels, 0, self.max_level).astype(np.int64)
+
+    def step(self, particles, dt, accelerations):
+        """Advances particles by dt seconds. accelerations(particles, targets) must
+        return the (len(targets), dim) accelerations of the bodies with indices targets,
+        or of every body when targets is None, at the current positions.
+        """
+        ticks = 1 << self.max_level
+        tick_dt = dt / ticks
+        if not self.fresh or len(self.levels) != len(particles):
+            particles.acc = accelerations(particles, None)
+            self.evaluations += len(particles)
+            self.levels = self.choose_levels(particles.acc, None, dt)
+            self.fresh = True
+        if len(particles) == 0:
+            return
+        # opening half kicks, every body starts a step with the block
+        span = ticks >> self.levels
+        particles.vel += particles.acc * (0.5 * span * tick_dt)[:, None]
+        tick = 0
+        while tick < ticks:
+            substep = ticks >> self.levels.max()
+            particles.pos += particles.vel * (substep * tick_dt)
+            tick += substep
+            active = np.flatnonzero(tick % span == 0)
+            old = particles.acc[active]
+            new = accelerations(particles, active)
+            self.evaluations += len(active)
+            h = span[active] * tick_dt
+            # closing half kicks of the bodies whose step ends now
+            particles.vel[active] += new * (0.5 * h)[:, None]
+            particles.acc[active] = new
+            current = self.levels[active]
+            levels = self.choose_levels(new, (new - old) / h[:, None], dt)
+            # a step can always shrink, but only grows one level at a time and when
+            # the longer step stays aligned with the block
+            longer = np.maximum(current - 1, 0)
+            aligned = tick % (ticks >> longer) == 0
+            levels = np.where(levels >= current, levels, np.where(aligned, longer, current))
+            self.levels[active] = levels
+            span[active] = ticks >> levels
+            if tick < ticks:
+                particles.vel[active] += new * (0.5 * span[active] * tick_dt)[:, None]
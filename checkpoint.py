@@ -0,0 +1,276 @@
+import json
+import os
+import numpy as np
+from flattree import FlatQuadTree
+from structures import QuadTree
+from blockstep import BlockStepper
+from simulation import MemorySink, TrajectorySink
+
+CHECKPOINT_VERSION = 1 # format of the checkpoint files, bumped when their content changes
+CHECKPOINT_EVERY = 100 # steps between checkpoints
+PARTICLE_FIELDS = ['pos', 'vel', 'acc', 'mass', 'radius']
+HISTORY_FIELDS = ['fresh', 'evaluations'] # integrator attributes that depend on the past steps
+
+
+def _parameters(component) -> dict:
+    """Returns the type and the plain (JSON) attributes of a component.
+    """
+    params = {'type': type(component).__name__}
+    for name, value in vars(component).items():
+        if isinstance(value, (bool, int, float, str, type(None))):
+            params[name] = value
+        elif isinstance(value, list) and all(isinstance(item, (int, float)) for item in value):
+            params[name] = value
+    return params
+
+
+def simulation_state(simulation, metadata=None):
+    """Returns the state of a simulation as a JSON serializable dict and a dict of arrays.
+    It covers the bodies, the step index, the integrator history, the engine and its
+    tree, the frames kept in memory, the tree outlines, the diagnostics and the state
+    of the global NumPy random generator. The profiler and the viewer are not part of it.
+    """
+    particles = simulation.particles
+    engine = simulation.engine
+    integrator = simulation.integrator
+    arrays = {f'particles/{name}': getattr(particles, name) for name in PARTICLE_FIELDS}
+    meta = {'version': CHECKPOINT_VERSION, 'steps_done': simulation.steps_done, 'dt': simulation.dt,
+            'collisions': simulation.collisions, 'engine': _parameters(engine),
+            'integrator': _parameters(integrator), 'metadata': metadata or {}}
+    if isinstance(integrator, BlockStepper) and integrator.levels is not None:
+        arrays['integrator/levels'] = integrator.levels
+    tree = getattr(engine, 'tree', None)
+    if isinstance(tree, FlatQuadTree):
+        meta['tree'] = _parameters(tree)
+        for name, value in vars(tree).items():
+            if isinstance(value, np.ndarray):
+                arrays[f'tree/{name}'] = value
+    elif isinstance(tree, QuadTree):
+        meta['object_tree'] = {'capacity': tree.capacity, 'escapers': tree.escapers, 'version': tree.version}
+        for name, value in _object_tree_arrays(tree).items():
+            arrays[f'object_tree/{name}'] = value
+    sink = simulation.sink
+    if isinstance(sink, MemorySink):
+        arrays['frames/positions'] = np.array(sink.positions)
+        if sink.radii:
+            arrays['frames/radii'] = np.array(sink.radius)
+    elif isinstance(sink, TrajectorySink):
+        # the frames on disk must be complete before the checkpoint refers to them
+        sink.writer.flush()
+        meta['trajectory'] = {'path': sink.path, 'frames': sink.writer.header['frames']}
+    if simulation.outlines is not None:
+        for name, value in simulation.outlines.arrays().items():
+            arrays[f'outlines/{name}'] = value
+    if simulation.diagnostics is not None:
+        meta['diagnostics'] = {'records': simulation.diagnostics.records,
+                               'reference': simulation.diagnostics.reference}
+    kind, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    meta['random'] = {'kind': kind, 'position': int(position), 'has_gauss': int(has_gauss),
+                      'cached_gaussian': float(cached_gaussian)}
+    arrays['random/keys'] = keys
+    return meta, arrays
+
+
+def save_checkpoint(path, simulation, metadata=None):
+    """Writes the state of a simulation to a .npz checkpoint file. The file is
+    written next to path and renamed over it once complete, so an interrupted write
+    never damages the previous checkpoint.
+    """
+    meta, arrays = simulation_state(simulation, metadata)
+    arrays['meta'] = np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8)
+    partial = path + '.partial'
+    with open(partial, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+
+
+def load_checkpoint(path):
+    """Returns the JSON metadata and the arrays of a checkpoint file.
+    """
+    with np.load(path) as data:
+        arrays = {name: data[name] for name in data.files}
+    meta = json.loads(arrays.pop('meta').tobytes().decode('utf-8'))
+    if meta['version'] != CHECKPOINT_VERSION:
+        raise ValueError(f'{path} is a version {meta["version"]} checkpoint, expected {CHECKPOINT_VERSION}')
+    return meta, arrays
+
+
+def resume(simulation, path) -> dict:
+    """Restores the state saved in a checkpoint file into a simulation built with the
+    same components, so that run() continues exactly where the checkpointed run was.
+    Components may differ from the checkpointed run to fork an experiment: the
+    integrator history and the tree are then started afresh. Returns the metadata.
+    """
+    meta, arrays = load_checkpoint(path)
+    particles = simulation.particles
+    for name in PARTICLE_FIELDS:
+        setattr(particles, name, arrays[f'particles/{name}'].copy())
+    simulation.steps_done = meta['steps_done']
+
+    integrator = simulation.integrator
+    saved = meta['integrator']
+    current = _parameters(integrator)
+    if all(saved.get(name) == current.get(name) for name in ['type', 'name', 'kicks', 'drifts', 'max_level']):
+        for name in HISTORY_FIELDS:
+            if name in saved:
+                setattr(integrator, name, saved[name])
+        if 'integrator/levels' in arrays:
+            integrator.levels = arrays['integrator/levels'].copy()
+    else:
+        integrator.reset()
+
+    engine = simulation.engine
+    if hasattr(engine, 'build'):
+        tree = meta.get('tree')
+        if tree is not None and engine.flat and _same_tree(tree, 'tree/quadrupole' in arrays, engine):
+            engine.tree = FlatQuadTree.__new__(FlatQuadTree)
+            for name, value in tree.items():
+                if name != 'type':
+                    setattr(engine.tree, name, value)
+            for name, value in arrays.items():
+                if name.startswith('tree/'):
+                    setattr(engine.tree, name[len('tree/'):], value.copy())
+        elif meta.get('object_tree') is not None and not engine.flat and _same_object_tree(meta['object_tree'], engine):
+            engine.bodies = particles.bodies()
+            engine.tree = _object_tree(meta['object_tree'], {name[len('object_tree/'):]: value for name, value
+                                                              in arrays.items() if name.startswith('object_tree/')},
+                                       engine.bodies)
+        else:
+            engine.build(particles)
+    else:
+        engine.start(particles)
+
+    frames = simulation.steps_done + 1
+    sink = simulation.sink
+    if isinstance(sink, MemorySink):
+        sink.positions = list(arrays.get('frames/positions', []))
+        sink.radius = list(arrays.get('frames/radii', []))
+        sink.open(len(sink.positions))
+        if not sink.positions:
+            sink.write(particles)
+    else:
+        saved = meta.get('trajectory')
+        if saved is not None and saved['path'] == sink.path and saved['frames'] == frames:
+            sink.open(frames)
+        else:
+            # a fork into a new file starts with the frame of the checkpoint
+            sink.open()
+            sink.write(particles)
+    if simulation.outlines is not None:
+        if 'outlines/frames' in arrays:
+            simulation.outlines.set_arrays({name[len('outlines/'):]: value for name, value in arrays.items()
+                                            if name.startswith('outlines/')})
+        else:
+            simulation.outlines.record(engine.tree)
+    diagnostics = simulation.diagnostics
+    if diagnostics is not None:
+        saved = meta.get('diagnostics')
+        if saved is not None:
+            diagnostics.open(simulation.diagnostics_path(), saved['records'], saved['reference'])
+        else:
+            # a fork that starts measuring takes the checkpoint as its reference
+            diagnostics.open(simulation.diagnostics_path(), [], None)
+            diagnostics.step(simulation, simulation.steps_done)
+
+    random = meta['random']
+    np.random.set_state((random['kind'], arrays['random/keys'], random['position'], random['has_gauss'],
+                         random['cached_gaussian']))
+    return meta['metadata']
+
+
+def _same_tree(tree, quadrupole, engine) -> bool:
+    """Returns whether a saved flat tree, with quadrupole moments or not, can serve an engine.
+    """
+    boundary = [0, 0, engine.box, engine.box] if engine.box is not None else None
+    return (tree['capacity'] == engine.body_limit and quadrupole == engine.quadrupole
+            and (boundary is None or tree['boundary'] == boundary))
+
+
+def _same_object_tree(tree, engine) -> bool:
+    """Returns whether a saved object tree can serve an engine.
+    """
+    return tree['capacity'] == engine.body_limit and tree['escapers'] == engine.escapers
+
+
+def _object_tree_arrays(tree) -> dict:
+    """Returns the structure of an object QuadTree as arrays over its nodes in
+    depth-first order: their boundaries, numbers of children and bodies, aggregates,
+    and the indices of the bodies each node holds, concatenated. The bodies left
+    outside the root are listed in escaped.
+    """
+    nodes = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(reversed(node.children))
+    bodies = [body.index for node in nodes for body in node.bodies]
+    return {'boundary': np.array([node.boundary for node in nodes], dtype=np.float64).reshape(-1, 4),
+            'children': np.array([len(node.children) for node in nodes], dtype=np.int64),
+            'count': np.array([len(node.bodies) for node in nodes], dtype=np.int64),
+            'bodies': np.array(bodies, dtype=np.int64),
+            'escaped': np.array([body.index for body in tree.escaped], dtype=np.int64),
+            'total_mass': np.array([node.total_mass for node in nodes], dtype=np.float64),
+            'center_mass': np.array([node.center_mass for node in nodes], dtype=np.float64).reshape(-1, 2),
+            'quadrupole': np.array([node.quadrupole for node in nodes], dtype=np.float64).reshape(-1, 2, 2)}
+
+
+def _object_tree(tree, arrays, bodies) -> QuadTree:
+    """Returns the object QuadTree saved by _object_tree_arrays() over the Body views
+    bodies. The aggregates are restored as saved rather than recomputed, as the bodies
+    may have moved since they were last refreshed.
+    """
+    starts = np.cumsum(arrays['count']) - arrays['count']
+    nodes = []
+    for k in range(len(arrays['children'])):
+        node = QuadTree.__new__(QuadTree)
+        node.boundary = [float(v) for v in arrays['boundary'][k]]
+        node.capacity = tree['capacity']
+        node.escapers = tree['escapers']
+        node.version = 0
+        node.bodies = [bodies[i] for i in arrays['bodies'][starts[k]:starts[k] + arrays['count'][k]]]
+        node.children = []
+        node.escaped = []
+        node.total_mass = arrays['total_mass'][k]
+        node.center_mass = arrays['center_mass'][k].copy()
+        node.quadrupole = arrays['quadrupole'][k].copy()
+        nodes.append(node)
+    # the nodes are in depth-first order, so each one takes the next subtrees as children
+    parents = []
+    for node, children in zip(nodes, arrays['children']):
+        if parents:
+            parent = parents[-1]
+            parent[0].children.append(node)
+            if len(parent[0].children) == parent[1]:
+                parents.pop()
+        if children > 0:
+            parents.append((node, children))
+    root = nodes[0]
+    root.version = tree['version']
+    root.escaped = [bodies[i] for i in arrays['escaped']]
+    return root
+
+
+class Checkpointer:
+    """A class to save the state of a simulation every few steps.
+    === Instance Attributes ===
+    path: The path of the checkpoint file, overwritten by every checkpoint.
+    every: The number of steps between checkpoints.
+    metadata: Extra values stored with every checkpoint, such as the options of the run.
+    """
+    path: str
+    every: int
+    metadata: dict
+
+    def __init__(self, path, every=CHECKPOINT_EVERY, metadata=None):
+        self.path = path
+        self.every = every
+        self.metadata = metadata
+
+    def step(self, simulation):
+        """Called after every step, saves a checkpoint every every steps.
+        """
+        if simulation.steps_done % self.every == 0:
+            save_checkpoint(self.path, simulation, self.metadata)
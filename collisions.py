@@ -0,0 +1,150 @@
+import itertools
+import numpy as np
+import kernels
+
+KEY_BITS = 60 # bits of the broad-phase cell keys shared by the axes, keeps them within int64
+
+
+def neighbours(dim) -> list:
+    """Returns the offsets of the cell itself and of half of its adjacent cells, so that
+    each pair of adjacent cells is visited once: those whose first nonzero offset is positive.
+    """
+    offsets = [offset for offset in itertools.product((-1, 0, 1), repeat=dim)
+               if next((o for o in offset if o != 0), 1) > 0]
+    return sorted(offsets, key=lambda offset: offset != (0,) * dim)
+
+
+def grid(pos, radius):
+    """Returns the uniform grid of the broad phase, whose cells are as wide as the
+    largest diameter: the bodies sorted by cell key, the sorted keys of the occupied
+    cells, where each cell starts in that order and how many bodies it holds, and the
+    key offsets of neighbours(), the cell itself first.
+    """
+    n, dim = pos.shape
+    lo = pos.min(axis=0)
+    extent = float((pos.max(axis=0) - lo).max())
+    cell = max(2 * float(np.max(radius)), extent / (1 << (KEY_BITS // dim)))
+    if cell == 0:
+        cell = 1.0
+    index = np.floor((pos - lo) / cell).astype(np.int64)
+    # every axis is shifted by one and padded so neighbouring keys never wrap into another row
+    sizes = index.max(axis=0) + 3
+    strides = np.concatenate([np.cumprod(sizes[:0:-1])[::-1], [1]])
+    keys = (index + 1) @ strides
+    order = np.argsort(keys, kind='stable')
+    cells, start, count = np.unique(keys[order], return_index=True, return_counts=True)
+    offsets = np.array([int(np.dot(offset, strides)) for offset in neighbours(dim)], dtype=np.int64)
+    return order, cells, start, count, offsets
+
+
+def candidate_pairs(pos, radius):
+    """Returns the index arrays (i, j), i != j, of every pair of bodies that share or
+    touch a cell of the grid(). Any two overlapping bodies are always among the candidates.
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    if len(pos) < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order, cells, start, count, offsets = grid(pos, radius)
+    first = []
+    second = []
+    for offset in offsets:
+        target = cells + offset
+        match = np.searchsorted(cells, target)
+        match = np.minimum(match, len(cells) - 1)
+        found = np.nonzero(cells[match] == target)[0]
+        a = found
+        b = match[found]
+        # every body of cell a against every body of cell b
+        size = count[a] * count[b]
+        cell_pair = np.repeat(np.arange(len(a)), size)
+        k = np.arange(size.sum()) - np.repeat(np.cumsum(size) - size, size)
+        i = start[a][cell_pair] + k // count[b][cell_pair]
+        j = start[b][cell_pair] + k % count[b][cell_pair]
+        if offset == 0:
+            # within a cell, keep each unordered pair once
+            keep = i < j
+            i = i[keep]
+            j = j[keep]
+        first.append(order[i])
+        second.append(order[j])
+    return np.concatenate(first), np.concatenate(second)
+
+
+def collision_pairs(pos, radius):
+    """Returns the index arrays (i, j) of every pair of overlapping bodies, that is
+    bodies closer than the sum of their radii.
+    """
+    i, j, _ = broad_phase(pos, radius)
+    return i, j
+
+
+def broad_phase(pos, radius):
+    """Returns the index arrays (i, j) of every pair of overlapping bodies and the
+    number of candidate pairs checked. With the numba backend the candidates of each
+    cell are tested as they are found instead of being gathered first, and the pairs
+    come out in another order.
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    radius = np.asarray(radius, dtype=np.float64)
+    if kernels.use_numba() and len(pos) >= 2:
+        return kernels.touching_pairs(pos, radius, *grid(pos, radius))
+    i, j = candidate_pairs(pos, radius)
+    return (*touching_pairs(pos, radius, i, j), len(i))
+
+
+def touching_pairs(pos, radius, i, j):
+    """Returns the pairs among the candidate pairs (i, j) that overlap.
+    """
+    d = pos[i] - pos[j]
+    touching = np.sqrt(np.einsum('ij,ij->i', d, d)) < radius[i] + radius[j]
+    return i[touching], j[touching]
+
+
+def connected_groups(n, i, j) -> np.ndarray:
+    """Returns, for each of n bodies, the smallest index of the bodies it is connected to
+    through the pairs (i, j).
+    """
+    label = np.arange(n)
+    while True:
+        # propagate the smallest label across every pair, then jump to the root label
+        low = np.minimum(label[i], label[j])
+        new = label.copy()
+        np.minimum.at(new, i, low)
+        np.minimum.at(new, j, low)
+        new = new[new]
+        if np.array_equal(new, label):
+            return label
+        label = new
+
+
+def merge_collisions(particles, stats=None) -> int:
+    """Merges every group of overlapping bodies of a ParticleSet into one body, in one pass.
+    Mass, momentum and volume are conserved and the merged body is placed at the
+    group's center of mass. Merged bodies take the place of the lowest index in their
+    group and the arrays are compacted afterwards.
+    Returns the number of bodies removed. With a Profiler as stats, the candidate
+    pairs checked and the bodies removed are counted.
+    """
+    n = len(particles)
+    i, j, checks = broad_phase(particles.pos, particles.radius)
+    if stats is not None:
+        stats.count('collision_checks', checks)
+    if len(i) == 0:
+        return 0
+    label = connected_groups(n, i, j)
+    mass = particles.mass
+    total = np.bincount(label, weights=mass, minlength=n)
+    survivors = label == np.arange(n)
+    merged = survivors & (np.bincount(label, minlength=n) > 1)
+    for array in [particles.pos, particles.vel, particles.acc]:
+        weighted = np.zeros(array.shape)
+        for axis in range(array.shape[1]):
+            weighted[:, axis] = np.bincount(label, weights=mass * array[:, axis], minlength=n)
+        array[merged] = weighted[merged] / total[merged, None]
+    volume = np.bincount(label, weights=particles.radius ** 3, minlength=n)
+    particles.radius[merged] = volume[merged] ** (1 / 3)
+    particles.mass[merged] = total[merged]
+    particles.compact(survivors)
+    if stats is not None:
+        stats.count('merged', n - int(survivors.sum()))
+    return n - int(survivors.sum())
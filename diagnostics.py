@@ -0,0 +1,191 @@
+import csv
+import numpy as np
+from forces import G, SOFT_PARAM
+from flattree import FlatQuadTree
+
+DIAGNOSTICS_EVERY = 10 # steps between measurements of the conserved quantities
+DIAGNOSTICS_THETA = 0.5 # opening criterion of the potential walk, tighter than the forces as the potential converges slower
+FIELDS = ['step', 'time', 'kinetic', 'potential', 'energy', 'energy_error', 'momentum_x', 'momentum_y',
+          'momentum_z', 'angular_momentum_x', 'angular_momentum_y', 'angular_momentum_z', 'virial_ratio']
+
+
+def kinetic_energy(particles) -> float:
+    """Returns the total kinetic energy of the bodies.
+    """
+    return 0.5 * float(np.sum(particles.mass * np.einsum('ij,ij->i', particles.vel, particles.vel)))
+
+
+def potential_energy(particles, tree=None, theta=DIAGNOSTICS_THETA, soft=SOFT_PARAM) -> float:
+    """Returns the total potential energy 1/2 sum(m phi) of the bodies, with the
+    potentials phi from a walk of tree, a FlatQuadTree over the current bodies. Without
+    a tree one is built, so the cost is O(N log N) either way.
+    """
+    if len(particles) < 2:
+        return 0.0
+    if tree is None:
+        tree = FlatQuadTree(particles.pos, particles.mass, 8)
+    phi = tree.potentials(particles.pos, particles.mass, theta, soft)
+    return 0.5 * float(particles.mass @ phi)
+
+
+def direct_potential_energy(particles, soft=SOFT_PARAM) -> float:
+    """Returns the total potential energy of the bodies summed over every pair, the
+    O(N^2) reference of potential_energy().
+    """
+    d = particles.pos[None, :, :] - particles.pos[:, None, :]
+    r = np.sqrt(np.einsum('ijk,ijk->ij', d, d))
+    pair = -G * np.outer(particles.mass, particles.mass) * (np.pi / 2 - np.arctan(r / soft)) / soft
+    # bodies at the same position (including a body and itself) do not interact
+    pair[r == 0] = 0
+    return 0.5 * float(pair.sum())
+
+
+def momentum(particles) -> np.ndarray:
+    """Returns the total linear momentum of the bodies.
+    """
+    return particles.mass @ particles.vel
+
+
+def angular_momentum(particles) -> np.ndarray:
+    """Returns the total angular momentum vector of the bodies about their center of
+    mass. 2D bodies only have a z component, and their x and y components are 0.
+    """
+    mass = particles.mass
+    pos = particles.pos - mass @ particles.pos / mass.sum()
+    vel = particles.vel - mass @ particles.vel / mass.sum()
+    if particles.dim == 2:
+        return np.array([0.0, 0.0, float(np.sum(mass * (pos[:, 0] * vel[:, 1] - pos[:, 1] * vel[:, 0])))])
+    return mass @ np.cross(pos, vel)
+
+
+def virial_ratio(particles, kinetic=None, acc=None) -> float:
+    """Returns 2 T / -V, with the virial V = sum(m r . a) taken about the center of
+    mass from the accelerations acc at the current positions, by default the ones
+    the integrator last stored, so it costs no force evaluation. It is 1 in virial
+    equilibrium.
+    """
+    mass = particles.mass
+    if acc is None:
+        acc = particles.acc
+    if kinetic is None:
+        kinetic = kinetic_energy(particles)
+    vel = mass @ particles.vel / mass.sum()
+    # the kinetic energy of the bulk motion does not take part in the virial balance
+    kinetic -= 0.5 * mass.sum() * float(vel @ vel)
+    pos = particles.pos - mass @ particles.pos / mass.sum()
+    virial = float(np.sum(mass * np.einsum('ij,ij->i', pos, acc)))
+    return 2 * kinetic / -virial if virial < 0 else float('nan')
+
+
+def measure(particles, tree=None, theta=DIAGNOSTICS_THETA, soft=SOFT_PARAM, box=None, acc=None) -> dict:
+    """Returns the kinetic, potential and total energies, the momentum, the angular
+    momentum and the virial ratio of the bodies. The z momentum of 2D bodies is 0. In a
+    periodic box the potential and the angular momentum are not defined and are NaN.
+    tree must hold the current positions, and acc the accelerations at them.
+    """
+    kinetic = kinetic_energy(particles)
+    p = momentum(particles)
+    if box is None:
+        potential = potential_energy(particles, tree, theta, soft)
+        spin = angular_momentum(particles)
+    else:
+        potential = float('nan')
+        spin = np.full(3, np.nan)
+    return {'kinetic': kinetic, 'potential': potential, 'energy': kinetic + potential, 'momentum_x': float(p[0]),
+            'momentum_y': float(p[1]), 'momentum_z': float(p[2]) if len(p) > 2 else 0.0,
+            'angular_momentum_x': float(spin[0]), 'angular_momentum_y': float(spin[1]),
+            'angular_momentum_z': float(spin[2]), 'virial_ratio': virial_ratio(particles, kinetic, acc)}
+
+
+class Diagnostics:
+    """A class to measure the conserved quantities of a simulation every few steps,
+    as an accuracy guardrail for fast configurations.
+    The potential is walked on the flat tree of the step when the engine refits it at
+    every evaluation, and on a tree built for the purpose otherwise. The virial uses
+    the accelerations the integrator stored at the end of the step; every integrator,
+    euler included, evaluates them after its last drift, so they are at the current
+    positions. Before the first step and after merging there are none, and they are
+    evaluated. With a trajectory file the measurements are streamed to a CSV file
+    next to it.
+    === Instance Attributes ===
+    every: The number of steps between measurements.
+    tolerance: The relative energy error beyond which the run is stopped, or None.
+    theta: The opening criterion of the potential walk.
+    records: The measurements taken so far, one dict of FIELDS per measurement.
+    reference: The total energy of the first measurement, or None before it.
+    exceeded: Whether the energy error went beyond tolerance.
+    file: The open CSV file, or None.
+    """
+    every: int
+    tolerance: float
+    theta: float
+    records: list
+    reference: float
+    exceeded: bool
+    file: object
+
+    def __init__(self, every=DIAGNOSTICS_EVERY, tolerance=None, theta=DIAGNOSTICS_THETA):
+        self.every = every
+        self.tolerance = tolerance
+        self.theta = theta
+        self.records = []
+        self.reference = None
+        self.exceeded = False
+        self.file = None
+
+    def open(self, path=None, records=None, reference=None):
+        """Starts measuring, writing to the CSV file path if given. Measurements restored
+        from a checkpoint are passed as records, with the reference energy.
+        """
+        if records is not None:
+            self.records = [dict(record) for record in records]
+            self.reference = reference
+        if path is not None:
+            self.file = open(path, 'w', newline='')
+            writer = csv.DictWriter(self.file, FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records)
+            self.file.flush()
+
+    def step(self, simulation, k):
+        """Called at the start and after every step k - 1, measures every every steps.
+        """
+        if k % self.every != 0:
+            return
+        engine = simulation.engine
+        particles = simulation.particles
+        tree = getattr(engine, 'tree', None)
+        if not isinstance(tree, FlatQuadTree) or not engine.incremental:
+            # a tree only rebuilt every few steps holds the masses and centers of older positions
+            tree = None
+        acc = None if simulation.integrator.fresh else simulation.accelerations(particles)
+        record = {'step': k, 'time': k * simulation.dt}
+        record.update(measure(particles, tree, self.theta, engine.soft, engine.box, acc))
+        if self.reference is None:
+            self.reference = record['energy']
+        record['energy_error'] = abs(record['energy'] - self.reference) / abs(self.reference) \
+            if self.reference else float('nan')
+        self.records.append(record)
+        if self.file is not None:
+            csv.DictWriter(self.file, FIELDS).writerow(record)
+            self.file.flush()
+        if self.tolerance is not None and record['energy_error'] > self.tolerance:
+            self.exceeded = True
+
+    def summary(self) -> str:
+        """Returns the largest energy error, the magnitude of the last angular momentum
+        and its largest change relative to the first, and the last virial ratio.
+        """
+        if not self.records:
+            return 'no diagnostics'
+        error = max(record['energy_error'] for record in self.records)
+        spin = np.array([[record[f'angular_momentum_{axis}'] for axis in 'xyz'] for record in self.records])
+        reference = np.linalg.norm(spin[0])
+        drift = np.max(np.linalg.norm(spin - spin[0], axis=1)) / reference if reference > 0 else float('nan')
+        return (f'largest relative energy error {error:.3e}, angular momentum {np.linalg.norm(spin[-1]):.3e} '
+                f'(largest relative change {drift:.3e}), virial ratio {self.records[-1]["virial_ratio"]:.3f}')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,263 @@
+import argparse
+import time
+import numpy as np
+from structures import ParticleSet
+from forces import G, SOFT_PARAM
+from collisions import connected_groups
+from integrators import INTEGRATORS, make_integrator
+from simulation import DT
+from initial_conditions import MASS, RADIUS, uniform
+
+BLOCK_ELEMENTS = 1 << 14 # pairs evaluated per block, small enough for the temporaries to stay in cache
+
+
+class Ensemble:
+    """A class to represent M independent systems of up to N bodies as (M, N) arrays,
+    so they are all advanced at once. A body that was merged into another is dead:
+    it has no mass, stays where it was and is masked out of every result.
+    The integrators only use the pos, vel and acc arrays, so they step an Ensemble
+    like a ParticleSet.
+    === Instance Attributes ===
+    pos: An (M, N, 2) array of positions in meters.
+    vel: An (M, N, 2) array of velocities in meters per second.
+    acc: An (M, N, 2) array of accelerations in meters per second squared.
+    mass: An (M, N) array of masses in kilograms, 0 for dead bodies.
+    radius: An (M, N) array of radii in meters, 0 for dead bodies.
+    alive: An (M, N) boolean mask of the bodies that were not merged away.
+    """
+    pos: np.ndarray
+    vel: np.ndarray
+    acc: np.ndarray
+    mass: np.ndarray
+    radius: np.ndarray
+    alive: np.ndarray
+
+    def __init__(self, pos, vel, mass, radius, alive=None):
+        self.pos = np.array(pos, dtype=np.float64)
+        shape = self.pos.shape[:2]
+        self.vel = np.array(np.broadcast_to(vel, shape + (2,)), dtype=np.float64)
+        self.acc = np.zeros(shape + (2,))
+        self.mass = np.array(np.broadcast_to(mass, shape), dtype=np.float64)
+        self.radius = np.array(np.broadcast_to(radius, shape), dtype=np.float64)
+        self.alive = np.ones(shape, dtype=bool) if alive is None else np.array(alive, dtype=bool)
+        self.kill(~self.alive)
+
+    @classmethod
+    def from_particle_sets(cls, systems):
+        """Returns an Ensemble holding a copy of the ParticleSets, padded with dead
+        bodies up to the largest of them.
+        """
+        n = max((len(system) for system in systems), default=0)
+        pos = np.zeros((len(systems), n, 2))
+        vel = np.zeros((len(systems), n, 2))
+        mass = np.zeros((len(systems), n))
+        radius = np.zeros((len(systems), n))
+        alive = np.zeros((len(systems), n), dtype=bool)
+        for k, system in enumerate(systems):
+            size = len(system)
+            pos[k, :size] = system.pos
+            vel[k, :size] = system.vel
+            mass[k, :size] = system.mass
+            radius[k, :size] = system.radius
+            alive[k, :size] = True
+        return cls(pos, vel, mass, radius, alive)
+
+    @classmethod
+    def random(cls, m, n, mass=MASS, radius=RADIUS, seed=0):
+        """Returns m systems of n random bodies, system k being the one uniform()
+        places with seed + k.
+        """
+        return cls.from_particle_sets([uniform(n, mass, radius, seed=seed + k) for k in range(m)])
+
+    def __len__(self):
+        return len(self.pos)
+
+    def counts(self) -> np.ndarray:
+        """Returns the number of bodies alive in each system.
+        """
+        return self.alive.sum(axis=1)
+
+    def system(self, k) -> ParticleSet:
+        """Returns a ParticleSet holding a copy of the bodies alive in system k.
+        """
+        keep = self.alive[k]
+        particles = ParticleSet(self.pos[k, keep], self.vel[k, keep], self.mass[k, keep], self.radius[k, keep])
+        particles.acc = self.acc[k, keep].copy()
+        return particles
+
+    def positions(self) -> np.ndarray:
+        """Returns a copy of the positions, NaN for dead bodies.
+        """
+        pos = self.pos.copy()
+        pos[~self.alive] = np.nan
+        return pos
+
+    def kill(self, dead):
+        """Marks the bodies where the (M, N) mask dead is True as dead.
+        """
+        self.alive &= ~dead
+        self.mass[dead] = 0
+        self.radius[dead] = 0
+        self.vel[dead] = 0
+        self.acc[dead] = 0
+
+
+def ensemble_accelerations(pos, mass, soft=SOFT_PARAM, block_elements=BLOCK_ELEMENTS) -> np.ndarray:
+    """Returns the (M, N, 2) accelerations of every body of M independent systems from
+    direct summation within each system, with the softened law of direct_accelerations().
+    Bodies without mass exert no force. The systems are evaluated in blocks so that
+    at most block_elements pairs are held in memory at once.
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    mass = np.asarray(mass, dtype=np.float64)
+    m, n = pos.shape[:2]
+    acc = np.zeros((m, n, 2))
+    if n == 0:
+        return acc
+    rows = max(1, block_elements // (n * n))
+    soft2 = soft ** 2
+    for start in range(0, m, rows):
+        block = slice(start, start + rows)
+        dx = pos[block, None, :, 0] - pos[block, :, None, 0]
+        dy = pos[block, None, :, 1] - pos[block, :, None, 1]
+        r2 = dx * dx + dy * dy
+        r = np.sqrt(r2)
+        r2 += soft2
+        r2 *= r
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f = np.divide(G * mass[block, None, :], r2)
+        # bodies at the same position (including a body and itself) exert no force
+        f[r == 0] = 0
+        acc[block, :, 0] = np.einsum('kij,kij->ki', f, dx)
+        acc[block, :, 1] = np.einsum('kij,kij->ki', f, dy)
+    return acc
+
+
+def ensemble_touching_pairs(pos, radius, alive, block_elements=BLOCK_ELEMENTS):
+    """Returns the index arrays (system, i, j), i < j, of every pair of overlapping
+    bodies alive in the same system.
+    """
+    m, n = alive.shape
+    rows = max(1, block_elements // max(n * n, 1))
+    # each unordered pair once
+    upper = np.triu(np.ones((n, n), dtype=bool), 1)
+    found = []
+    for start in range(0, m, rows):
+        block = slice(start, start + rows)
+        # squared distances against squared sums of radii
+        dx = pos[block, None, :, 0] - pos[block, :, None, 0]
+        dy = pos[block, None, :, 1] - pos[block, :, None, 1]
+        dx *= dx
+        dy *= dy
+        dx += dy
+        reach = radius[block, :, None] + radius[block, None, :]
+        reach *= reach
+        touching = dx < reach
+        touching &= upper
+        if touching.any():
+            touching &= alive[block, :, None] & alive[block, None, :]
+            system, i, j = np.nonzero(touching)
+            found.append((system + start, i, j))
+    if not found:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    return tuple(np.concatenate(arrays) for arrays in zip(*found))
+
+
+def merge_ensemble_collisions(ensemble) -> np.ndarray:
+    """Merges every group of overlapping bodies of each system into one body, like
+    merge_collisions(). The merged body takes the place of the lowest index in its
+    group and the other bodies of the group die.
+    Returns the number of bodies removed from each system.
+    """
+    m, n = ensemble.alive.shape
+    removed = np.zeros(m, dtype=np.int64)
+    system, i, j = ensemble_touching_pairs(ensemble.pos, ensemble.radius, ensemble.alive)
+    if len(i) == 0:
+        return removed
+    # pairs never cross systems, so the groups of all systems are found at once
+    label = connected_groups(m * n, system * n + i, system * n + j)
+    size = m * n
+    mass = ensemble.mass.reshape(size)
+    total = np.bincount(label, weights=mass, minlength=size)
+    survivors = label == np.arange(size)
+    merged = survivors & (np.bincount(label, minlength=size) > 1)
+    for array in [ensemble.pos, ensemble.vel, ensemble.acc]:
+        flat = array.reshape(size, 2)
+        weighted = np.zeros((size, 2))
+        weighted[:, 0] = np.bincount(label, weights=mass * flat[:, 0], minlength=size)
+        weighted[:, 1] = np.bincount(label, weights=mass * flat[:, 1], minlength=size)
+        flat[merged] = weighted[merged] / total[merged, None]
+    volume = np.bincount(label, weights=ensemble.radius.reshape(size) ** 3, minlength=size)
+    ensemble.radius.reshape(size)[merged] = volume[merged] ** (1 / 3)
+    mass[merged] = total[merged]
+    dead = ~survivors.reshape(m, n) & ensemble.alive
+    ensemble.kill(dead)
+    removed[:] = dead.sum(axis=1)
+    return removed
+
+
+def simulate_ensemble(ensemble, steps, dt=DT, integrator='leapfrog', soft=SOFT_PARAM, collisions=True,
+                      stride=0, progress=False) -> dict:
+    """Advances every system of an ensemble by steps steps of dt seconds, merging
+    overlapping bodies after every step when collisions is set.
+    Returns the numbers of bodies alive in each system after every step, as the
+    (steps + 1, M) array 'counts', and with a stride the (frames, M, N, 2) positions
+    of every stride-th step, NaN for dead bodies, as 'positions'.
+    """
+    integrator = make_integrator(integrator)
+
+    def accelerations(ensemble):
+        acc = ensemble_accelerations(ensemble.pos, ensemble.mass, soft)
+        # dead bodies keep still
+        acc[~ensemble.alive] = 0
+        return acc
+
+    counts = [ensemble.counts()]
+    positions = [ensemble.positions()] if stride else []
+    for k in range(steps):
+        integrator.step(ensemble, dt, accelerations)
+        if collisions:
+            changed = np.flatnonzero(merge_ensemble_collisions(ensemble))
+            if len(changed) > 0:
+                # only the systems that merged bodies need their accelerations again
+                ensemble.acc[changed] = ensemble_accelerations(ensemble.pos[changed], ensemble.mass[changed], soft)
+                ensemble.acc[~ensemble.alive] = 0
+        counts.append(ensemble.counts())
+        if stride and (k + 1) % stride == 0:
+            positions.append(ensemble.positions())
+        if progress and k % 10 == 0:
+            print(f"{k*100.0/float(steps)}% done")
+    result = {'counts': np.array(counts)}
+    if stride:
+        result['positions'] = np.array(positions)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run many small independent systems in one vectorized run.')
+    parser.add_argument('--systems', type=int, default=1000, help='number of independent systems')
+    parser.add_argument('--bodies', type=int, default=25, help='bodies per system')
+    parser.add_argument('--steps', type=int, default=2000, help='number of steps')
+    parser.add_argument('--dt', type=float, default=DT, help='seconds per step')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first system, the others follow')
+    parser.add_argument('--integrator', choices=sorted(INTEGRATORS), default='leapfrog', help='integration scheme')
+    parser.add_argument('--no-collisions', action='store_true', help='do not merge overlapping bodies')
+    parser.add_argument('--stride', type=int, default=0, help='store the positions of every stride-th step')
+    parser.add_argument('--output', default=None, help='write the results to this .npz file')
+    args = parser.parse_args(argv)
+
+    start_time = time.time()
+    ensemble = Ensemble.random(args.systems, args.bodies, seed=args.seed)
+    result = simulate_ensemble(ensemble, args.steps, args.dt, args.integrator, collisions=not args.no_collisions,
+                               stride=args.stride, progress=True)
+    counts = result['counts'][-1]
+    print(f'Bodies left per system: mean {counts.mean():.2f}, min {counts.min()}, max {counts.max()}')
+    if args.output is not None:
+        np.savez(args.output, pos=ensemble.pos, vel=ensemble.vel, mass=ensemble.mass, radius=ensemble.radius,
+                 alive=ensemble.alive, **result)
+    print('Total time:', time.time() - start_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,461 @@
+import numpy as np
+import kernels
+from forces import G, SOFT_PARAM
+from periodic import ewald_table, minimum_image
+
+MORTON_BITS = 30 # bits per axis in the Morton keys of a quadtree, also its maximum depth
+OCTREE_BITS = 21 # the same for an octree, whose three interleaved axes fill 63 bits
+TARGET_BLOCK = 4096 # bodies walked through the tree at once, bounds peak memory
+
+
+def key_bits(dim) -> int:
+    """Returns the bits per axis of the Morton keys of positions in dim dimensions.
+    """
+    if dim == 2:
+        return MORTON_BITS
+    if dim == 3:
+        return OCTREE_BITS
+    raise ValueError(f'positions must be 2D or 3D, not {dim}D')
+
+
+def morton_keys(pos, boundary, bits=None):
+    """Returns the Morton (Z-order) keys of the 2D or 3D positions inside the boundary
+    [x, y, (z,) width, height, (depth)]. Positions outside the boundary are clamped to
+    the nearest edge cell.
+    """
+    dim = pos.shape[1]
+    if bits is None:
+        bits = key_bits(dim)
+    if kernels.use_numba():
+        return kernels.morton_keys(pos, boundary, bits)
+    spread = _spread_bits if dim == 2 else _spread_bits_3d
+    scale = float(1 << bits)
+    keys = np.zeros(len(pos), dtype=np.uint64)
+    for axis in range(dim):
+        lo = boundary[axis]
+        size = boundary[dim + axis]
+        cell = np.clip((pos[:, axis] - lo) / size * scale, 0, scale - 1).astype(np.uint64)
+        keys |= spread(cell) << np.uint64(axis)
+    return keys
+
+
+def _spread_bits(v):
+    """Inserts a zero bit between each of the lower 32 bits of v.
+    """
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+
+def _spread_bits_3d(v):
+    """Inserts two zero bits between each of the lower 21 bits of v.
+    """
+    v = v & np.uint64(0x1FFFFF)
+    v = (v | (v << np.uint64(32))) & np.uint64(0x001F00000000FFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x001F0000FF0000FF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x100F00F00F00F00F)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x10C30C30C30C30C3)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return v
+
+
+def quadrupole_moments(mass, d):
+    """Returns the (N, D, D) traceless quadrupole moments of point masses at offsets d,
+    or their in-plane block in 2D.
+    """
+    q = 3 * d[:, :, None] * d[:, None, :]
+    r2 = (d * d).sum(axis=1)
+    for axis in range(d.shape[1]):
+        q[:, axis, axis] -= r2
+    return mass[:, None, None] * q
+
+
+def bounding_box(pos):
+    """Returns the smallest square [x, y, width, height], or cube [x, y, z, width,
+    height, depth] for 3D positions, that strictly contains the positions.
+    """
+    dim = pos.shape[1] if pos.ndim == 2 else 2
+    if len(pos) == 0:
+        return [0.0] * dim + [1.0] * dim
+    lo = pos.min(axis=0)
+    hi = pos.max(axis=0)
+    width = float((hi - lo).max())
+    # pad so the largest coordinates fall strictly inside the box
+    width = width * (1 + 1e-9) if width > 0 else 1.0
+    return [float(v) for v in lo] + [width] * dim
+
+
+class FlatQuadTree:
+    """A class to represent a quadtree stored in parallel NumPy arrays, or an octree
+    when the positions are 3D. Everything below is written for D dimensions.
+    Nodes are numbered level by level, every internal node has exactly 2^D children,
+    and the bodies of each node are a contiguous slice of order.
+    === Instance Attributes ===
+    dim: The number of dimensions D, 2 or 3.
+    bits: The bits per axis of the Morton keys, also the maximum depth.
+    boundary: The boundary of the root in the form [x, y, width, height], or
+    [x, y, z, width, height, depth] in 3D.
+    capacity: The maximum number of bodies in a leaf, unless it is at maximum depth.
+    order: The body indices sorted by Morton key.
+    start: For each node, the index in order of its first body.
+    count: For each node, the number of bodies it contains.
+    child: An (M, 2^D) array of child node indices, -1 for leaves. Children are in
+    Morton order: bit k of a child's index is set in the upper half along axis k,
+    so in 2D lower left, lower right, upper left, upper right.
+    bounds: An (M, 2D) array of node boundaries in the form of boundary.
+    level: For each node, its depth in the tree.
+    mass: For each node, the total mass of its bodies.
+    center_mass: An (M, D) array of node centers of mass.
+    quadrupole: An (M, D, D) array of node quadrupole moments about their centers
+    of mass, or None when the tree was built without them.
+    body_leaf: For each body, the index of the leaf that contains it.
+    leaf_order: The indices of the leaves in Morton order.
+    version: Changes whenever the shape of the tree changes. The nodes of a FlatQuadTree
+    are fixed once it is built, so it stays 0.
+    """
+    dim: int
+    bits: int
+    boundary: list
+    capacity: int
+    order: np.ndarray
+    start: np.ndarray
+    count: np.ndarray
+    child: np.ndarray
+    bounds: np.ndarray
+    level: np.ndarray
+    mass: np.ndarray
+    center_mass: np.ndarray
+    quadrupole: np.ndarray
+    body_leaf: np.ndarray
+    leaf_order: np.ndarray
+    version: int = 0
+
+    def __init__(self, pos, mass, capacity, boundary=None, quadrupole=False):
+        pos = np.asarray(pos, dtype=np.float64)
+        self.dim = pos.shape[1] if pos.ndim == 2 else 2
+        self.bits = key_bits(self.dim)
+        self.boundary = bounding_box(pos) if boundary is None else list(boundary)
+        self.capacity = capacity
+        self.quadrupole = np.zeros((0, self.dim, self.dim)) if quadrupole else None
+        keys = morton_keys(pos.reshape(-1, self.dim), self.boundary, self.bits)
+        self.order = np.argsort(keys, kind='stable')
+        self.build(keys[self.order], len(pos))
+        self.update_mass(pos, mass)
+
+    def build(self, sorted_keys, n):
+        """Builds the node arrays level by level from the sorted Morton keys.
+        """
+        dim = self.dim
+        fan = 1 << dim
+        starts = [np.array([0])]
+        counts = [np.array([n])]
+        prefixes = [np.array([0], dtype=np.uint64)]
+        bounds = [np.array([self.boundary], dtype=np.float64)]
+        children = []
+        first = 1
+        for level in range(self.bits):
+            split = np.nonzero(counts[-1] > self.capacity)[0]
+            child = np.full((len(counts[-1]), fan), -1)
+            children.append(child)
+            if len(split) == 0:
+                break
+            child[split] = first + np.arange(fan * len(split)).reshape(-1, fan)
+            first += fan * len(split)
+            # the key range of each child is found by binary search in the sorted keys
+            shift = np.uint64(dim * (self.bits - 1 - level))
+            prefix = (prefixes[-1][split, None] << np.uint64(dim)) | np.arange(fan, dtype=np.uint64)
+            child_start = np.searchsorted(sorted_keys, prefix << shift)
+            end = starts[-1][split] + counts[-1][split]
+            child_end = np.concatenate([child_start[:, 1:], end[:, None]], axis=1)
+            parent = bounds[-1][split]
+            orthant = np.arange(fan)
+            child_bounds = np.empty((len(split), fan, 2 * dim))
+            for axis in range(dim):
+                half = (parent[:, dim + axis] / 2)[:, None]
+                child_bounds[:, :, axis] = parent[:, axis, None] + ((orthant >> axis) & 1) * half
+                child_bounds[:, :, dim + axis] = half
+            starts.append(child_start.ravel())
+            counts.append((child_end - child_start).ravel())
+            prefixes.append(prefix.ravel())
+            bounds.append(child_bounds.reshape(-1, 2 * dim))
+        else:
+            children.append(np.full((len(counts[-1]), fan), -1))
+        self.start = np.concatenate(starts)
+        self.count = np.concatenate(counts)
+        self.child = np.concatenate(children)
+        self.bounds = np.concatenate(bounds)
+        self.level = np.repeat(np.arange(len(counts)), [len(c) for c in counts])
+        # every body belongs to exactly one leaf, and leaves tile the sorted order
+        leaves = np.nonzero(self.child[:, 0] == -1)[0]
+        shift = dim * (self.bits - self.level[leaves]).astype(np.uint64)
+        first_key = np.concatenate(prefixes)[leaves] << shift
+        self.leaf_order = leaves[np.argsort(first_key)]
+        self.body_leaf = np.empty(n, dtype=np.int64)
+        self.body_leaf[self.order] = np.repeat(self.leaf_order, self.count[self.leaf_order])
+
+    def refit(self, pos, mass) -> float:
+        """Moves the bodies that left their leaf into the leaf that now contains them
+        and refreshes the node aggregates, keeping the tree structure.
+        Returns the fraction of bodies the tree no longer bins well: bodies in leaves
+        over capacity or outside the root boundary. A value of 1 means the number of
+        bodies changed and the tree must be rebuilt.
+        """
+        pos = np.asarray(pos, dtype=np.float64)
+        n = len(pos)
+        if n != len(self.body_leaf):
+            return 1.0
+        dim = self.dim
+        bounds = self.bounds[self.body_leaf]
+        lo = bounds[:, :dim]
+        moved = np.nonzero(((pos < lo) | (pos >= lo + bounds[:, dim:])).any(axis=1))[0]
+        if len(moved) > 0:
+            self.body_leaf[moved] = self.find_leaf(pos[moved])
+            self.sort_bodies()
+        self.update_mass(pos, mass)
+        if n == 0:
+            return 0.0
+        lo = np.array(self.boundary[:dim])
+        outside = np.count_nonzero(((pos < lo) | (pos >= lo + self.boundary[dim:])).any(axis=1))
+        overfull = (self.child[:, 0] == -1) & (self.count > self.capacity) & (self.level < self.bits)
+        return (self.count[overfull].sum() + outside) / n
+
+    def find_leaf(self, points) -> np.ndarray:
+        """Returns the index of the leaf containing each point, descending from the root.
+        Points outside the root boundary end up in the nearest edge leaf.
+        """
+        dim = self.dim
+        nodes = np.zeros(len(points), dtype=np.int64)
+        active = np.arange(len(points))
+        while len(active) > 0:
+            active = active[self.child[nodes[active], 0] != -1]
+            bounds = self.bounds[nodes[active]]
+            upper = points[active] >= bounds[:, :dim] + bounds[:, dim:] / 2
+            orthant = upper.astype(np.int64) @ (1 << np.arange(dim))
+            nodes[active] = self.child[nodes[active], orthant]
+        return nodes
+
+    def sort_bodies(self):
+        """Recomputes order, start and count after bodies changed leaves.
+        """
+        m = len(self.count)
+        rank = np.empty(m, dtype=np.int64)
+        rank[self.leaf_order] = np.arange(len(self.leaf_order))
+        self.order = np.argsort(rank[self.body_leaf], kind='stable')
+        self.count = np.bincount(self.body_leaf, minlength=m)
+        leaf_count = self.count[self.leaf_order]
+        self.start[self.leaf_order] = np.cumsum(leaf_count) - leaf_count
+        # children are in Morton order, so a node starts where its first child does
+        for nodes in reversed([self.internal_nodes(level) for level in range(self.depth())]):
+            self.count[nodes] = self.count[self.child[nodes]].sum(axis=1)
+            self.start[nodes] = self.start[self.child[nodes, 0]]
+
+    def update_mass(self, pos, mass):
+        """Recomputes the total mass, center of mass and, if enabled, the quadrupole
+        moment of every node, from the leaves up.
+        """
+        m = len(self.count)
+        dim = self.dim
+        mass = np.asarray(mass, dtype=np.float64)
+        self.mass = np.bincount(self.body_leaf, weights=mass, minlength=m)
+        moment = np.empty((m, dim))
+        for axis in range(dim):
+            moment[:, axis] = np.bincount(self.body_leaf, weights=mass * pos[:, axis], minlength=m)
+        internal = [self.internal_nodes(level) for level in range(self.depth())]
+        for nodes in reversed(internal):
+            self.mass[nodes] = self.mass[self.child[nodes]].sum(axis=1)
+            moment[nodes] = moment[self.child[nodes]].sum(axis=1)
+        # empty nodes keep their geometric center
+        self.center_mass = self.bounds[:, :dim] + self.bounds[:, dim:] / 2
+        nonempty = self.mass > 0
+        self.center_mass[nonempty] = moment[nonempty] / self.mass[nonempty, None]
+        if self.quadrupole is not None:
+            d = pos - self.center_mass[self.body_leaf]
+            q = quadrupole_moments(mass, d)
+            self.quadrupole = np.empty((m, dim, dim))
+            for i in range(dim):
+                for j in range(i, dim):
+                    self.quadrupole[:, i, j] = np.bincount(self.body_leaf, weights=q[:, i, j], minlength=m)
+                    self.quadrupole[:, j, i] = self.quadrupole[:, i, j]
+            # children's moments are shifted to their parent's center of mass
+            for nodes in reversed(internal):
+                children = self.child[nodes]
+                s = self.center_mass[children] - self.center_mass[nodes, None]
+                shifted = quadrupole_moments(self.mass[children].ravel(), s.reshape(-1, dim))
+                self.quadrupole[nodes] = (self.quadrupole[children]
+                                          + shifted.reshape(children.shape + (dim, dim))).sum(axis=1)
+
+    def internal_nodes(self, level) -> np.ndarray:
+        """Returns the indices of the internal nodes at the given depth.
+        """
+        lo, hi = np.searchsorted(self.level, [level, level + 1])
+        return lo + np.nonzero(self.child[lo:hi, 0] != -1)[0]
+
+    def walk(self, pos, theta=1.0, block=TARGET_BLOCK, targets=None, box=None, stats=None):
+        """Walks the tree for blocks of the bodies with indices targets and yields the
+        interactions found at each level as (first, local, nodes, sources, d, r): the
+        rows local of the block starting at targets[first] interact either with the
+        accepted nodes (sources is None) or with the bodies sources of leaves (nodes
+        is None), at separations d and distances r.
+        The tree is walked without recursion, level by level, for a block of bodies
+        at once. A node is approximated by its center of mass when its width is less
+        than theta times its distance to the body, and leaves are summed directly.
+        With a periodic box side, distances are taken to the nearest image of each node
+        or body. With a Profiler as stats, node visits, accepted and opened nodes and
+        leaf pairs are counted.
+        """
+        pos = np.asarray(pos, dtype=np.float64)
+        if targets is None:
+            targets = np.arange(len(pos))
+        # the dimension is read off the arrays, which is all a tree rebuilt by a worker has
+        width = self.bounds[:, pos.shape[1]]
+        fan = self.child.shape[1]
+        is_leaf = self.child[:, 0] == -1
+        for first in range(0, len(targets), block):
+            block_targets = targets[first:first + block]
+            # the positions of the block are gathered once, and then from a small array
+            block_pos = pos[block_targets]
+            local = np.arange(len(block_targets))
+            nodes = np.zeros(len(block_targets), dtype=np.int64)
+            while len(nodes) > 0:
+                # empty nodes contribute nothing
+                keep = self.mass[nodes] > 0
+                local = local[keep]
+                nodes = nodes[keep]
+                # np.take gathers rows several times faster than fancy indexing
+                d = np.take(self.center_mass, nodes, axis=0) - np.take(block_pos, local, axis=0)
+                if box is not None:
+                    d = minimum_image(d, box)
+                r = np.sqrt(np.einsum('ij,ij->i', d, d))
+                leaf = is_leaf[nodes]
+                accept = ~leaf & (width[nodes] < theta * r)
+                yield (first, local[accept], nodes[accept], None, np.compress(accept, d, axis=0),
+                       r[accept])
+                # leaves are summed body by body
+                leaf_local = local[leaf]
+                leaf_nodes = nodes[leaf]
+                sizes = self.count[leaf_nodes]
+                pair_local = np.repeat(leaf_local, sizes)
+                offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+                sources = self.order[np.repeat(self.start[leaf_nodes], sizes) + offsets]
+                d = np.take(pos, sources, axis=0) - np.take(block_pos, pair_local, axis=0)
+                if box is not None:
+                    d = minimum_image(d, box)
+                r = np.sqrt(np.einsum('ij,ij->i', d, d))
+                yield first, pair_local, None, sources, d, r
+                # everything else is opened
+                opened = ~leaf & ~accept
+                if stats is not None:
+                    stats.count('node_visits', len(nodes))
+                    stats.count('accepts', np.count_nonzero(accept))
+                    stats.count('rejects', np.count_nonzero(opened))
+                    stats.count('leaf_pairs', len(pair_local))
+                local = np.repeat(local[opened], fan)
+                nodes = self.child[nodes[opened]].ravel()
+
+    def accelerations(self, pos, mass, theta=1.0, soft=SOFT_PARAM, block=TARGET_BLOCK, targets=None, box=None,
+                      stats=None):
+        """Returns the (N, D) array of accelerations on every body, or on the bodies
+        with indices targets only, from the interactions of walk().
+        With a periodic box side, the tabulated Ewald correction adds the images
+        beyond the nearest one of each node or body. With the numba backend, open
+        boundaries are walked by the compiled kernel instead, one body at a time.
+        """
+        pos = np.asarray(pos, dtype=np.float64)
+        mass = np.asarray(mass, dtype=np.float64)
+        if targets is None:
+            targets = np.arange(len(pos))
+        if kernels.use_numba() and box is None:
+            acc, work = kernels.tree_accelerations(self, pos, mass, theta, soft, G, targets)
+            if stats is not None:
+                for name, value in zip(kernels.COUNTERS, work):
+                    stats.count(name, int(value))
+            return acc
+        acc = np.zeros((len(targets), pos.shape[1]))
+        soft2 = soft ** 2
+        table = ewald_table(box) if box is not None else None
+        for first, local, nodes, sources, d, r in self.walk(pos, theta, block, targets, box, stats):
+            block_acc = acc[first:first + block]
+            source_mass = self.mass[nodes] if sources is None else mass[sources]
+            self.accumulate(block_acc, local, source_mass, d, r, soft2)
+            if sources is None and self.quadrupole is not None:
+                self.accumulate_quadrupole(block_acc, local, self.quadrupole[nodes], d, r, soft2)
+            if table is not None:
+                table.accumulate(block_acc, local, G * source_mass, d)
+        return acc
+
+    def potentials(self, pos, mass, theta=1.0, soft=SOFT_PARAM, block=TARGET_BLOCK, targets=None):
+        """Returns the gravitational potential per unit mass at every body, or at the
+        bodies with indices targets only, from the interactions of walk(). Approximated
+        nodes only contribute their monopole.
+        The potential of the softened law G m / (r^2 + soft^2) is
+        -G m (pi / 2 - arctan(r / soft)) / soft, and bodies at zero distance (including
+        a body and itself) are skipped like in the forces.
+        """
+        pos = np.asarray(pos, dtype=np.float64)
+        mass = np.asarray(mass, dtype=np.float64)
+        if targets is None:
+            targets = np.arange(len(pos))
+        phi = np.zeros(len(targets))
+        for first, local, nodes, sources, d, r in self.walk(pos, theta, block, targets):
+            block_phi = phi[first:first + block]
+            source_mass = self.mass[nodes] if sources is None else mass[sources]
+            p = -G * source_mass * (np.pi / 2 - np.arctan(r / soft)) / soft
+            p[r == 0] = 0
+            block_phi += np.bincount(local, weights=p, minlength=len(block_phi))
+        return phi
+
+    @staticmethod
+    def accumulate(acc, local, mass, d, r, soft2):
+        """Adds the softened attraction of the given masses to the rows local of acc.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f = G * mass / (r * (r ** 2 + soft2))
+        # bodies at the same position (including a body and itself) exert no force
+        f[r == 0] = 0
+        for axis in range(acc.shape[1]):
+            acc[:, axis] += np.bincount(local, weights=f * d[:, axis], minlength=len(acc))
+
+    @staticmethod
+    def accumulate_quadrupole(acc, local, quadrupole, d, r, soft2):
+        """Adds the quadrupole correction of approximated nodes to the rows local of acc,
+        the gradient of the potential -G d.Q.d / (2 s^5) softened like the monopole,
+        with s^2 = r^2 + soft^2.
+        """
+        qd = np.einsum('kij,kj->ki', quadrupole, d)
+        dqd = np.einsum('ki,ki->k', d, qd)
+        s2 = r ** 2 + soft2
+        a = G * (2.5 * (dqd / s2 ** 3.5)[:, None] * d - qd / (s2 ** 2.5)[:, None])
+        for axis in range(acc.shape[1]):
+            acc[:, axis] += np.bincount(local, weights=a[:, axis], minlength=len(acc))
+
+    def segments(self) -> np.ndarray:
+        """Returns a (K, 4) array of segments [x1, y1, x2, y2] that draw the tree: the root
+        boundary and the two lines that split each internal node, without duplicates.
+        Only quadtrees are drawn.
+        """
+        x, y, width, height = self.boundary
+        border = np.array([[x, y, x + width, y], [x, y, x, y + height],
+                           [x + width, y, x + width, y + height], [x, y + height, x + width, y + height]])
+        x, y, width, height = self.bounds[self.child[:, 0] != -1].T
+        vertical = np.stack([x + width / 2, y, x + width / 2, y + height], axis=1)
+        horizontal = np.stack([x, y + height / 2, x + width, y + height / 2], axis=1)
+        return np.concatenate([border, vertical, horizontal])
+
+    def lines(self) -> np.ndarray:
+        """Returns a (K, 4) array of lines that represent the boundaries of the leaves.
+        """
+        x, y, width, height = self.bounds[self.child[:, 0] == -1].T
+        lines = np.empty((len(x), 4, 4))
+        lines[:, 0] = np.stack([x, y, x + width, y], axis=1)
+        lines[:, 1] = np.stack([x, y, x, y + height], axis=1)
+        lines[:, 2] = np.stack([x + width, y, x + width, y + height], axis=1)
+        lines[:, 3] = np.stack([x, y + height, x + width, y + height], axis=1)
+        return lines.reshape(-1, 4)
+
+    def depth(self) -> int:
+        """Returns the depth of the deepest node.
+        """
+        return int(self.level[-1])
@@ -0,0 +1,289 @@
+import numpy as np
+from forces import G, SOFT_PARAM, direct_accelerations
+from flattree import FlatQuadTree, TARGET_BLOCK
+
+ORDER = 5 # Chebyshev nodes per axis of each cell, the error falls roughly tenfold per extra node
+LEAF_SIZE = 16 # largest number of bodies in a leaf of the adaptive quadtree
+ERROR_SAMPLES = 256 # bodies compared with direct summation by error()
+
+
+def chebyshev_nodes(order) -> np.ndarray:
+    """Returns the order Chebyshev nodes of the first kind on [-1, 1].
+    """
+    return np.cos((2 * np.arange(order) + 1) * np.pi / (2 * order))
+
+
+def interpolation_weights(points, order) -> np.ndarray:
+    """Returns the (len(points), order^2) weights of the Chebyshev interpolation of the
+    2D nodes at points given in cell coordinates [-1, 1]^2. Node k = a * order + b sits
+    at (chebyshev_nodes[a], chebyshev_nodes[b]).
+    """
+    n = np.arange(1, order)
+    nodes = np.cos(np.arccos(chebyshev_nodes(order))[:, None] * n)
+    weights = []
+    for axis in range(2):
+        t = np.cos(np.arccos(np.clip(points[:, axis], -1, 1))[:, None] * n)
+        weights.append(1 / order + 2 / order * t @ nodes.T)
+    return (weights[0][:, :, None] * weights[1][:, None, :]).reshape(len(points), order * order)
+
+
+def adjacent(a, level_a, b, level_b) -> np.ndarray:
+    """Returns whether the cells with integer coordinates a at depths level_a and b at
+    depths level_b touch or overlap, row by row.
+    """
+    fine = np.maximum(level_a, level_b)[:, None]
+    shift_a = fine - level_a[:, None]
+    shift_b = fine - level_b[:, None]
+    a_lo, a_hi = a << shift_a, (a + 1) << shift_a
+    b_lo, b_hi = b << shift_b, (b + 1) << shift_b
+    return np.all((a_lo <= b_hi) & (b_lo <= a_hi), axis=1)
+
+
+def expand(starts, sizes):
+    """Returns, for groups of sizes consecutive items beginning at starts, the group of
+    every item and its position.
+    """
+    group = np.repeat(np.arange(len(sizes)), sizes)
+    offsets = np.arange(len(group)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return group, np.repeat(starts, sizes) + offsets
+
+
+def by_target(targets, sources, n):
+    """Returns the pairs sorted by target, with where the pairs of each of n targets
+    start and how many there are.
+    """
+    order = np.argsort(targets, kind='stable')
+    sources = sources[order]
+    count = np.bincount(targets, minlength=n)
+    return sources, np.cumsum(count) - count, count
+
+
+class FastMultipole:
+    """A class to compute accelerations with a fast multipole method on an adaptive quadtree.
+    The softened force law of this project is not harmonic in the plane, so the far
+    field is expanded with Chebyshev interpolation of the kernel instead of complex
+    Laurent series: each cell carries the equivalent masses of its bodies at order^2
+    Chebyshev nodes (the multipole expansion) and the accelerations at the same nodes
+    caused by well separated cells (the local expansion).
+    Cells are split until they hold at most leaf_size bodies, so clustered bodies get
+    deeper cells and the work stays linear in N. Each cell interacts through the
+    classic lists of adaptive FMM: U, the adjacent leaves summed body by body; V, the
+    children of its parent's neighbours that are not adjacent, through their
+    expansions; W, the smaller cells not adjacent to a leaf but whose parent is, whose
+    equivalent masses act on the leaf's bodies; and X, the reverse of W, whose bodies
+    feed the local expansion directly.
+    === Instance Attributes ===
+    order: The number of Chebyshev nodes per axis of each cell.
+    leaf_size: The largest number of bodies in a leaf, unless it is at maximum depth.
+    soft: The softening parameter in meters.
+    nodes: The (order^2, 2) Chebyshev nodes of a cell, in cell coordinates.
+    m2m: For each child quadrant (lower left, lower right, upper left, upper right),
+    the (order^2, order^2) interpolation weights of the parent nodes at the child nodes.
+    """
+    order: int
+    leaf_size: int
+    soft: float
+    nodes: np.ndarray
+    m2m: list
+
+    def __init__(self, order=ORDER, leaf_size=LEAF_SIZE, soft=SOFT_PARAM):
+        self.order = order
+        self.leaf_size = leaf_size
+        self.soft = soft
+        x = chebyshev_nodes(order)
+        self.nodes = np.stack(np.meshgrid(x, x, indexing='ij'), axis=-1).reshape(-1, 2)
+        self.m2m = []
+        for dy in range(2):
+            for dx in range(2):
+                shift = np.array([dx - 0.5, dy - 0.5])
+                self.m2m.append(interpolation_weights(self.nodes / 2 + shift, order))
+
+    def m2l(self, width) -> dict:
+        """Returns the (order^2, 2 * order^2) matrices that turn the equivalent masses of
+        a source cell into the accelerations at the nodes of a target cell, for every
+        offset (ox, oy) of the source from the target in cells of the given width.
+        """
+        half = width / 2
+        # separation of source node l from target node k, in cell coordinates
+        spread = half * (self.nodes[None, :, :] - self.nodes[:, None, :])
+        soft2 = self.soft ** 2
+        operators = {}
+        for ox in range(-3, 4):
+            for oy in range(-3, 4):
+                if max(abs(ox), abs(oy)) < 2:
+                    continue
+                d = spread + width * np.array([ox, oy])
+                r = np.sqrt((d ** 2).sum(axis=-1))
+                kernel = (G / (r * (r ** 2 + soft2)))[:, :, None] * d
+                operators[ox, oy] = kernel.transpose(1, 0, 2).reshape(len(self.nodes), -1)
+        return operators
+
+    def kernel(self, d) -> np.ndarray:
+        """Returns the softened acceleration per unit source mass at separations d,
+        0 at zero distance.
+        """
+        r2 = np.einsum('...i,...i->...', d, d)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f = G / (np.sqrt(r2) * (r2 + self.soft ** 2))
+        f[r2 == 0] = 0
+        return f[..., None] * d
+
+    @staticmethod
+    def interaction_lists(tree, coords) -> dict:
+        """Returns the interaction lists of the nonempty cells of tree, as (target, source)
+        arrays: 'u' pairs of adjacent leaves, 'v' pairs of well separated cells of the same
+        depth, and 'x' pairs of a cell and a larger leaf adjacent to its parent but not
+        to it. The W list is the reverse of the X list. coords are the integer
+        coordinates of the cells at their depths.
+        The lists are found top down: the neighbours of a cell at its depth (its
+        colleagues) are among the children of its parent's colleagues, and the larger
+        leaves adjacent to it among those adjacent to its parent.
+        """
+        leaf = tree.child[:, 0] == -1
+        level = tree.level
+        nonempty = tree.count > 0
+        lists = {'u': [], 'v': [], 'x': []}
+        colleagues = (np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64))
+        near = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        while len(colleagues[0]) > 0 or len(near[0]) > 0:
+            target, source = colleagues
+            both = leaf[target] & leaf[source]
+            lists['u'].append((target[both], source[both]))
+            coarse_target, coarse_source = near
+            ends = leaf[coarse_target]
+            lists['u'].append((coarse_target[ends], coarse_source[ends]))
+            lists['u'].append((coarse_source[ends], coarse_target[ends]))
+            # children of internal colleagues are the candidate colleagues of the children
+            split = ~leaf[target] & ~leaf[source]
+            child_target = np.repeat(tree.child[target[split]], 4, axis=1).ravel()
+            child_source = np.tile(tree.child[source[split]], 4).ravel()
+            keep = nonempty[child_target] & nonempty[child_source]
+            child_target = child_target[keep]
+            child_source = child_source[keep]
+            close = np.all(np.abs(coords[child_source] - coords[child_target]) <= 1, axis=1)
+            lists['v'].append((child_target[~close], child_source[~close]))
+            colleagues = (child_target[close], child_source[close])
+            # leaves adjacent to an internal cell are candidates for its children
+            ends = ~leaf[target] & leaf[source]
+            target = np.concatenate([target[ends], coarse_target[~leaf[coarse_target]]])
+            source = np.concatenate([source[ends], coarse_source[~leaf[coarse_target]]])
+            child_target = tree.child[target].ravel()
+            child_source = np.repeat(source, 4)
+            keep = nonempty[child_target]
+            child_target = child_target[keep]
+            child_source = child_source[keep]
+            close = adjacent(coords[child_target], level[child_target], coords[child_source], level[child_source])
+            lists['x'].append((child_target[~close], child_source[~close]))
+            near = (child_target[close], child_source[close])
+        return {name: tuple(np.concatenate(part) for part in zip(*pairs)) for name, pairs in lists.items()}
+
+    def accelerations(self, pos, mass, targets=None, block=TARGET_BLOCK) -> np.ndarray:
+        """Returns the (N, 2) array of accelerations on every body, or on the bodies
+        with indices targets only.
+        """
+        pos = np.asarray(pos, dtype=np.float64)
+        mass = np.asarray(mass, dtype=np.float64)
+        n = len(pos)
+        if targets is None:
+            targets = np.arange(n)
+        acc = np.zeros((len(targets), 2))
+        if n == 0 or len(targets) == 0:
+            return acc
+        k = len(self.nodes)
+        tree = FlatQuadTree(pos, mass, self.leaf_size)
+        cells = len(tree.count)
+        width = tree.bounds[:, 2]
+        half = width / 2
+        centers = tree.bounds[:, :2] + half[:, None]
+        coords = np.rint((tree.bounds[:, :2] - tree.boundary[:2]) / width[:, None]).astype(np.int64)
+        # the Chebyshev nodes of every cell, in meters
+        points = centers[:, None, :] + half[:, None, None] * self.nodes
+        lists = self.interaction_lists(tree, coords)
+        depth = int(tree.level[-1])
+
+        # leaves: equivalent masses at the Chebyshev nodes
+        moments = np.zeros((cells, k))
+        for first in range(0, n, block):
+            bodies = tree.order[first:first + block]
+            leaf = tree.body_leaf[bodies]
+            weights = mass[bodies, None] * interpolation_weights(
+                (pos[bodies] - centers[leaf]) / half[leaf, None], self.order)
+            runs = np.flatnonzero(np.diff(leaf, prepend=-1))
+            moments[leaf[runs]] += np.add.reduceat(weights, runs)
+        # upward pass: children to parents
+        for level in range(depth - 1, -1, -1):
+            parents = tree.internal_nodes(level)
+            moments[parents] = sum(moments[tree.child[parents, q]] @ self.m2m[q] for q in range(4))
+
+        # V list: well separated cells of the same depth, grouped by offset so that each
+        # group applies one operator and has each target once
+        local = np.zeros((cells, 2 * k))
+        target, source = lists['v']
+        offset = coords[source] - coords[target]
+        for level in np.unique(tree.level[target]):
+            operators = self.m2l(tree.bounds[0, 2] / (1 << int(level)))
+            at_level = np.flatnonzero(tree.level[target] == level)
+            key = (offset[at_level, 0] + 3) * 7 + offset[at_level, 1] + 3
+            for value in np.unique(key):
+                pairs = at_level[key == value]
+                ox, oy = divmod(int(value), 7)
+                local[target[pairs]] += moments[source[pairs]] @ operators[ox - 3, oy - 3]
+        local = local.reshape(cells, k, 2)
+        # X list: bodies of larger leaves straight into the local expansions
+        target, source = lists['x']
+        pair, body = expand(tree.start[source], tree.count[source])
+        for first in range(0, len(pair), block):
+            rows = pair[first:first + block]
+            bodies = tree.order[body[first:first + block]]
+            contribution = mass[bodies, None, None] * self.kernel(pos[bodies, None, :] - points[target[rows]])
+            np.add.at(local, target[rows], contribution)
+        # downward pass: parents to children
+        for level in range(depth):
+            parents = tree.internal_nodes(level)
+            for q in range(4):
+                local[tree.child[parents, q]] += np.einsum('lk,pkd->pld', self.m2m[q], local[parents])
+
+        u_source, u_start, u_count = by_target(*lists['u'], cells)
+        w_source, w_start, w_count = by_target(lists['x'][1], lists['x'][0], cells)
+        soft2 = self.soft ** 2
+        for first in range(0, len(targets), block):
+            block_targets = targets[first:first + block]
+            block_acc = acc[first:first + block]
+            leaf = tree.body_leaf[block_targets]
+            # far field: interpolate the local expansion of the leaf
+            weights = interpolation_weights((pos[block_targets] - centers[leaf]) / half[leaf, None], self.order)
+            block_acc += np.einsum('bk,bkd->bd', weights, local[leaf])
+            # W list: equivalent masses of smaller separated cells
+            pair_local, position = expand(w_start[leaf], w_count[leaf])
+            cell = w_source[position]
+            a = np.einsum('pk,pkd->pd', moments[cell],
+                          self.kernel(points[cell] - pos[block_targets[pair_local], None, :]))
+            for axis in range(2):
+                block_acc[:, axis] += np.bincount(pair_local, weights=a[:, axis], minlength=len(block_acc))
+            # U list: adjacent leaves, body by body
+            pair_local, position = expand(u_start[leaf], u_count[leaf])
+            cell = u_source[position]
+            group, body = expand(tree.start[cell], tree.count[cell])
+            pair_local = np.take(pair_local, group)
+            sources = np.take(tree.order, body)
+            # np.take gathers rows several times faster than fancy indexing
+            d = np.take(pos, sources, axis=0) - np.take(pos[block_targets], pair_local, axis=0)
+            r = np.sqrt(np.einsum('ij,ij->i', d, d))
+            FlatQuadTree.accumulate(block_acc, pair_local, np.take(mass, sources), d, r, soft2)
+        return acc
+
+    def error(self, pos, mass, samples=ERROR_SAMPLES, seed=0) -> dict:
+        """Returns the median and maximum relative error of the accelerations against
+        direct summation, on a random sample of at most samples bodies.
+        """
+        pos = np.asarray(pos, dtype=np.float64)
+        rng = np.random.default_rng(seed)
+        targets = np.sort(rng.choice(len(pos), min(samples, len(pos)), replace=False))
+        approx = self.accelerations(pos, mass, targets)
+        exact = direct_accelerations(pos, mass, self.soft, targets=targets)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = np.linalg.norm(approx - exact, axis=1) / np.linalg.norm(exact, axis=1)
+        relative = relative[np.isfinite(relative)]
+        if len(relative) == 0:
+            return {'median': 0.0, 'max': 0.0}
+        return {'median': float(np.median(relative)), 'max': float(relative.max())}
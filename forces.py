@@ -0,0 +1,61 @@
+import numpy as np
+import kernels
+from periodic import ewald_table, minimum_image
+
+G = 6.67430e-11
+SOFT_PARAM = 1e7 # softening parameter
+BLOCK_ELEMENTS = 1 << 22 # pair interactions evaluated per block, bounds peak memory
+PERIODIC_BLOCK_FACTOR = 4 # periodic blocks are this much smaller, the table lookup needs more memory per pair
+
+
+def direct_accelerations(pos, mass, soft=SOFT_PARAM, block_elements=BLOCK_ELEMENTS, targets=None, box=None):
+    """Returns the (N, D) array of accelerations from all-pairs direct summation, or
+    the accelerations of the bodies with indices targets only, for 2D or 3D positions.
+    Uses the same softened force law as gforce(), G * m1 * m2 / (r^2 + soft^2)
+    along the unit vector between the bodies, and skips pairs at zero distance.
+    The interaction matrix is evaluated in blocks of rows so that at most
+    block_elements pairs are held in memory at once.
+    With a periodic box side, each pair interacts through its nearest image plus the
+    tabulated Ewald correction for all the other images. Periodic boxes are 2D.
+    With the numba backend, open boundaries are summed by the compiled kernel instead.
+    """
+    pos = np.asarray(pos, dtype=np.float64)
+    mass = np.asarray(mass, dtype=np.float64)
+    n, dim = pos.shape
+    if targets is None:
+        targets = np.arange(n)
+    if kernels.use_numba() and box is None:
+        return kernels.direct_accelerations(pos, mass, soft, G, targets)
+    acc = np.zeros((len(targets), dim))
+    if n == 0:
+        return acc
+    if box is not None:
+        if dim != 2:
+            raise ValueError('periodic boxes are only supported in 2D')
+        table = ewald_table(box)
+        block_elements //= PERIODIC_BLOCK_FACTOR
+    rows = max(1, block_elements // n)
+    soft2 = soft ** 2
+    for start in range(0, len(targets), rows):
+        stop = min(start + rows, len(targets))
+        block = targets[start:stop]
+        # one (rows, N) array per axis, cheaper than a single (rows, N, D) array
+        d = [pos[None, :, axis] - pos[block, None, axis] for axis in range(dim)]
+        if box is not None:
+            d = [minimum_image(component, box) for component in d]
+        r2 = d[0] * d[0]
+        for component in d[1:]:
+            r2 += component * component
+        r = np.sqrt(r2)
+        r2 += soft2
+        r2 *= r
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f = np.divide(G * mass, r2)
+        # bodies at the same position (including a body and itself) exert no force
+        f[r == 0] = 0
+        for axis, component in enumerate(d):
+            acc[start:stop, axis] = np.einsum('ij,ij->i', f, component)
+        if box is not None:
+            correction = table.correction(np.stack([d[0].ravel(), d[1].ravel()], axis=1))
+            acc[start:stop] += np.einsum('ijd,j->id', correction.reshape(len(block), n, 2), G * mass)
+    return acc
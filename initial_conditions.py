@@ -0,0 +1,196 @@
+import json
+import numpy as np
+from structures import ParticleSet
+from forces import G, SOFT_PARAM, direct_accelerations
+from flattree import FlatQuadTree
+
+MASS = 1e24 # 1 septillion kg, roughly 1/5 of earth
+RADIUS = 1e6 # 1 million meters, roughly 1/6 of earth
+SIZE = 1e9 # side of the square the bodies start in, in meters
+SPEED = 1e3 # largest initial velocity component of uniform bodies in m/s
+CENTER = (SIZE / 2, SIZE / 2) # where clustered systems are placed
+PLUMMER_CUTOFF = 10 # Plummer bodies are drawn within this many scale radii
+DIRECT_LIMIT = 4096 # bodies up to which forces are summed directly for every body
+SAMPLES = 16384 # above it, bodies whose accelerations estimate the virial and the rotation curve
+SAMPLE_THETA = 0.5 # opening criterion of the tree that evaluates them
+CURVE_BINS = 64 # radial bins of the estimated rotation curve
+DISK_SCALE = 3 # disk radius in exponential scale lengths
+
+
+def uniform(n, mass=MASS, radius=RADIUS, size=SIZE, speed=SPEED, seed=None, dim=2) -> ParticleSet:
+    """Returns n equal bodies placed uniformly in the [0, size] square, or cube when
+    dim is 3, with velocity components uniform in [-speed, speed].
+    """
+    rng = np.random.default_rng(seed)
+    pos = rng.uniform(0, size, (n, dim))
+    vel = rng.uniform(-speed, speed, (n, dim))
+    return ParticleSet(pos, vel, mass, radius)
+
+
+def plummer(n, mass=MASS, radius=RADIUS, scale=SIZE / 20, center=CENTER, velocity=(0, 0), virial_ratio=1.0,
+            soft=SOFT_PARAM, seed=None, dim=2) -> ParticleSet:
+    """Returns n equal bodies following the surface density of a Plummer sphere seen
+    in projection, Sigma(R) ~ (1 + R^2 / scale^2)^-2, or with dim 3 the density of the
+    sphere itself, rho(r) ~ (1 + r^2 / scale^2)^-5/2, truncated at PLUMMER_CUTOFF
+    scale radii. Velocities are isotropic, scaled to virial_ratio (see virialize()),
+    and the whole cluster moves with velocity.
+    """
+    rng = np.random.default_rng(seed)
+    if dim == 2:
+        # the mass within R is R^2 / (R^2 + scale^2) of the total
+        top = PLUMMER_CUTOFF ** 2 / (1 + PLUMMER_CUTOFF ** 2)
+        u = rng.uniform(0, top, n)
+        r = scale * np.sqrt(u / (1 - u))
+        angle = rng.uniform(0, 2 * np.pi, n)
+        direction = np.stack([np.cos(angle), np.sin(angle)], axis=1)
+    else:
+        # the mass within r is (r^2 / (r^2 + scale^2))^3/2 of the total
+        top = (PLUMMER_CUTOFF ** 2 / (1 + PLUMMER_CUTOFF ** 2)) ** 1.5
+        u = rng.uniform(0, top, n) ** (2 / 3)
+        r = scale * np.sqrt(u / (1 - u))
+        direction = rng.normal(0, 1, (n, dim))
+        direction /= np.linalg.norm(direction, axis=1)[:, None]
+    pos = _center(center, dim) + r[:, None] * direction
+    particles = ParticleSet(pos, rng.normal(0, 1, (n, dim)), mass, radius)
+    virialize(particles, virial_ratio, soft)
+    particles.vel += _center(velocity, dim, 0.0)
+    return particles
+
+
+def disk(n, mass=MASS, radius=RADIUS, disk_radius=SIZE / 4, center=CENTER, central_mass=0.0, dispersion=0.0,
+         soft=SOFT_PARAM, seed=None) -> ParticleSet:
+    """Returns n bodies in a disk rotating counterclockwise, with an exponential
+    surface density truncated at disk_radius (DISK_SCALE scale lengths). Each body
+    starts on the circular orbit given by the accelerations of all the others,
+    with random velocity components of dispersion times that speed. With a
+    central_mass, body 0 is a central body of that mass at rest.
+    """
+    rng = np.random.default_rng(seed)
+    h = disk_radius / DISK_SCALE
+    # the mass within x scale lengths is 1 - (1 + x) e^-x, inverted on a grid
+    x = np.linspace(0, DISK_SCALE, 4097)
+    cdf = 1 - (1 + x) * np.exp(-x)
+    r = h * np.interp(rng.uniform(0, cdf[-1], n), cdf, x)
+    angle = rng.uniform(0, 2 * np.pi, n)
+    direction = np.stack([np.cos(angle), np.sin(angle)], axis=1)
+    pos = np.asarray(center, dtype=np.float64) + r[:, None] * direction
+    masses = np.full(n, float(mass))
+    if central_mass > 0 and n > 0:
+        pos[0] = center
+        r[0] = 0
+        masses[0] = central_mass
+    particles = ParticleSet(pos, 0.0, masses, radius)
+    targets, acc = sample_accelerations(particles, soft)
+    # centripetal acceleration times radius is the squared circular speed
+    v2 = np.maximum(-np.einsum('ij,ij->i', acc, direction[targets]) * r[targets], 0)
+    if len(targets) < n:
+        # large disks interpolate the rotation curve of the sampled bodies, averaged in radial bins
+        order = np.argsort(r[targets])
+        bins = np.array_split(order, min(CURVE_BINS, len(order)))
+        curve_r = np.array([r[targets][b].mean() for b in bins])
+        curve_v2 = np.array([v2[b].mean() for b in bins])
+        v2 = np.interp(r, curve_r, curve_v2)
+    speed = np.sqrt(v2)
+    particles.vel = speed[:, None] * np.stack([-direction[:, 1], direction[:, 0]], axis=1)
+    particles.vel += dispersion * speed[:, None] * rng.normal(0, 1, (n, 2))
+    if central_mass > 0 and n > 0:
+        particles.vel[0] = 0
+    return particles
+
+
+def collision(n, clusters=2, mass=MASS, radius=RADIUS, scale=SIZE / 40, separation=SIZE / 2, center=CENTER,
+              speed=None, virial_ratio=1.0, soft=SOFT_PARAM, seed=None, dim=2) -> ParticleSet:
+    """Returns n bodies split into Plummer clusters evenly spaced on a circle of
+    diameter separation, in the xy plane, each falling towards the center at speed.
+    The default speed is the circular speed sqrt(G M / separation) of a cluster of mass M.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = np.full(clusters, n // clusters)
+    sizes[:n % clusters] += 1
+    if speed is None:
+        speed = np.sqrt(G * mass * n / clusters / separation)
+    systems = []
+    for k, size in enumerate(sizes):
+        angle = 2 * np.pi * k / clusters
+        direction = _center([np.cos(angle), np.sin(angle)], dim, 0.0)
+        systems.append(plummer(size, mass, radius, scale, _center(center, dim) + separation / 2 * direction,
+                               -speed * direction, virial_ratio, soft, seed=rng.integers(2 ** 63), dim=dim))
+    return ParticleSet(np.concatenate([system.pos for system in systems]),
+                       np.concatenate([system.vel for system in systems]),
+                       np.concatenate([system.mass for system in systems]),
+                       np.concatenate([system.radius for system in systems]))
+
+
+def _center(point, dim, fill=SIZE / 2) -> np.ndarray:
+    """Returns point as an array of dim coordinates, so a 2D point given to a 3D
+    generator lies at height fill.
+    """
+    point = np.asarray(point, dtype=np.float64)
+    return np.concatenate([point, np.full(dim - len(point), fill)])
+
+
+def sample_accelerations(particles, soft=SOFT_PARAM):
+    """Returns the indices of a sample of the bodies and their accelerations. Sets of
+    at most DIRECT_LIMIT bodies are summed directly and entirely; larger sets are
+    sampled with SAMPLES bodies, always the same ones, evaluated with a tree.
+    """
+    n = len(particles)
+    if n <= DIRECT_LIMIT:
+        return np.arange(n), direct_accelerations(particles.pos, particles.mass, soft)
+    targets = np.sort(np.random.default_rng(0).choice(n, min(SAMPLES, n), replace=False))
+    tree = FlatQuadTree(particles.pos, particles.mass, 8)
+    return targets, tree.accelerations(particles.pos, particles.mass, SAMPLE_THETA, soft, targets=targets)
+
+
+def virialize(particles, virial_ratio=1.0, soft=SOFT_PARAM):
+    """Scales the velocities in the center of mass frame so that the kinetic energy
+    T and the virial V = sum(m r . a) satisfy 2 T = -virial_ratio V. A ratio of 1 is
+    virial equilibrium, below 1 the system collapses and 0 leaves it at rest.
+    The bulk velocity of the bodies is kept. V is estimated from a sample of the
+    bodies in large systems.
+    """
+    if len(particles) < 2:
+        return particles
+    mass = particles.mass
+    bulk = mass @ particles.vel / mass.sum()
+    center = mass @ particles.pos / mass.sum()
+    vel = particles.vel - bulk
+    kinetic = 0.5 * np.sum(mass * np.einsum('ij,ij->i', vel, vel))
+    targets, acc = sample_accelerations(particles, soft)
+    virial = np.sum(mass[targets] * np.einsum('ij,ij->i', particles.pos[targets] - center, acc))
+    virial *= len(particles) / len(targets)
+    factor = np.sqrt(virial_ratio * -virial / (2 * kinetic)) if kinetic > 0 else 0.0
+    particles.vel = bulk + vel * factor
+    return particles
+
+
+GENERATORS = {'uniform': uniform, 'plummer': plummer, 'disk': disk, 'collision': collision}
+
+
+def make_initial_conditions(name, n, seed=None, **options) -> ParticleSet:
+    """Returns n bodies from the generator called name, with its other options.
+    """
+    if name not in GENERATORS:
+        raise ValueError(f'unknown initial conditions {name!r}, expected one of {sorted(GENERATORS)}')
+    return GENERATORS[name](n, seed=seed, **options)
+
+
+def save(path, particles, metadata=None):
+    """Saves the bodies to a .npz file, with metadata such as the generator and seed.
+    """
+    np.savez(path, pos=particles.pos, vel=particles.vel, mass=particles.mass, radius=particles.radius,
+             metadata=np.frombuffer(json.dumps(metadata or {}).encode('utf-8'), dtype=np.uint8))
+
+
+def load(path) -> ParticleSet:
+    """Returns the bodies saved in a .npz file.
+    """
+    with np.load(path) as data:
+        return ParticleSet(data['pos'], data['vel'], data['mass'], data['radius'])
+
+
+def load_metadata(path) -> dict:
+    """Returns the metadata saved with the bodies in a .npz file.
+    """
+    with np.load(path) as data:
+        return json.loads(data['metadata'].tobytes().decode('utf-8'))
@@ -0,0 +1,150 @@
+import json
+import time
+from contextlib import nullcontext
+
+# returned by phase() when profiling is off, entering it does nothing
+NULL_PHASE = nullcontext()
+
+
+class Phase:
+    """A class to time one phase of a step as a context manager.
+    Time spent in phases nested inside it is not counted as its own.
+    === Instance Attributes ===
+    profiler: The profiler the time is added to.
+    name: The name of the phase.
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.stack.append([self.name, time.perf_counter(), 0.0])
+        return self
+
+    def __exit__(self, *exc):
+        name, start, nested = self.profiler.stack.pop()
+        elapsed = time.perf_counter() - start
+        if self.profiler.stack:
+            self.profiler.stack[-1][2] += elapsed
+        step = self.profiler.step_times
+        step[name] = step.get(name, 0.0) + elapsed - nested
+
+
+class Profiler:
+    """A class to collect per-phase timers and counters for every step of a simulation.
+    Phases are timed with `with profiler.phase(name):` and counters are added with
+    count(). end_step() closes the step: its record is appended to records, written
+    to the log file as one JSON line and passed to every callback.
+    Code paths take a profiler argument that defaults to None and only touch it when
+    one is given, so a disabled profiler costs nothing.
+    === Instance Attributes ===
+    records: The record of every finished step: its index, the seconds spent in each
+    phase, the counters and any extra values given to end_step().
+    callbacks: The functions called with the record of each finished step.
+    log: The open JSON lines log file, or None.
+    step_times: The seconds spent in each phase during the current step.
+    step_counts: The counters of the current step.
+    stack: The phases currently open, innermost last.
+    """
+    records: list
+    callbacks: list
+    step_times: dict
+    step_counts: dict
+    stack: list
+
+    def __init__(self, log_path=None, callbacks=None):
+        self.records = []
+        self.callbacks = list(callbacks or [])
+        self.log = open(log_path, 'w') if log_path is not None else None
+        self.step_times = {}
+        self.step_counts = {}
+        self.stack = []
+
+    def phase(self, name) -> Phase:
+        """Returns a context manager that times a phase of the current step.
+        """
+        return Phase(self, name)
+
+    def count(self, name, value=1):
+        """Adds value to a counter of the current step.
+        """
+        self.step_counts[name] = self.step_counts.get(name, 0) + int(value)
+
+    def gauge(self, name, value):
+        """Sets a value of the current step, such as the depth of the tree.
+        """
+        self.step_counts[name] = value
+
+    def end_step(self, step, **extra) -> dict:
+        """Closes the current step and returns its record.
+        """
+        record = {'step': step, 'times': self.step_times, 'counts': self.step_counts}
+        record.update(extra)
+        self.records.append(record)
+        self.step_times = {}
+        self.step_counts = {}
+        if self.log is not None:
+            self.log.write(json.dumps(record) + '\n')
+        for callback in self.callbacks:
+            callback(record)
+        return record
+
+    def totals(self):
+        """Returns the total seconds of each phase and the total of each counter over
+        all finished steps.
+        """
+        times = {}
+        counts = {}
+        for record in self.records:
+            for name, value in record['times'].items():
+                times[name] = times.get(name, 0.0) + value
+            for name, value in record['counts'].items():
+                counts[name] = counts.get(name, 0) + value
+        return times, counts
+
+    def summary(self) -> str:
+        """Returns a readable table of the time spent in each phase and the counters,
+        per step on average.
+        """
+        steps = max(len(self.records), 1)
+        times, counts = self.totals()
+        total = sum(times.values()) or 1.0
+        lines = [f'{len(self.records)} steps']
+        for name, value in sorted(times.items(), key=lambda item: -item[1]):
+            lines.append(f'  {name:16s} {value / steps * 1000:10.3f} ms/step {100 * value / total:5.1f}%')
+        for name, value in sorted(counts.items()):
+            lines.append(f'  {name:16s} {value / steps:14.1f} /step')
+        # extra values given to end_step are averaged over the steps
+        for name in self.records[0] if self.records else []:
+            values = [record.get(name) for record in self.records]
+            if name != 'step' and all(isinstance(value, (int, float)) for value in values):
+                lines.append(f'  {name:16s} {sum(values) / steps:14.1f} /step')
+        return '\n'.join(lines)
+
+    def close(self):
+        """Closes the log file.
+        """
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+def phase(profiler, name):
+    """Returns a context manager timing a phase with profiler, or one that does
+    nothing when profiler is None.
+    """
+    if profiler is None:
+        return NULL_PHASE
+    return profiler.phase(name)
+
+
+def slow_steps(threshold, report=print):
+    """Returns a callback that reports the steps taking longer than threshold seconds,
+    to spot pathological frames.
+    """
+    def callback(record):
+        total = sum(record['times'].values())
+        if total > threshold:
+            report(f"step {record['step']} took {total:.3f} s: {record['times']}")
+    return callback
@@ -0,0 +1,86 @@
+# weights of the 4th order triple jump (Yoshida 1990, Forest and Ruth 1990)
+W1 = 1 / (2 - 2 ** (1 / 3))
+W0 = 1 - 2 * W1
+
+
+class Integrator:
+    """A class to advance a ParticleSet with a symplectic kick-drift-kick scheme.
+    A step alternates kicks (velocities += fraction * dt * acc) and drifts
+    (positions += fraction * dt * vel), starting and ending with a kick, and
+    evaluates the accelerations after every drift. The accelerations at the end of
+    a step are the ones needed by the first kick of the next step, so they are
+    kept in particles.acc and reused: a scheme costs one evaluation per drift.
+    === Instance Attributes ===
+    name: The name of the scheme.
+    kicks: The fractions of the step of each kick, one more than drifts.
+    drifts: The fractions of the step of each drift.
+    fresh: Whether particles.acc holds the accelerations at the current positions.
+    """
+    name: str
+    kicks: list
+    drifts: list
+    fresh: bool
+
+    def __init__(self, name, kicks, drifts):
+        if len(kicks) != len(drifts) + 1:
+            raise ValueError('a scheme needs one more kick than drifts')
+        self.name = name
+        self.kicks = kicks
+        self.drifts = drifts
+        self.fresh = False
+
+    def evaluations(self) -> int:
+        """Returns the number of force evaluations per step.
+        """
+        return len(self.drifts)
+
+    def reset(self):
+        """Forgets the stored accelerations, for example after bodies were merged or
+        removed. They are evaluated again at the start of the next step.
+        """
+        self.fresh = False
+
+    def step(self, particles, dt, accelerations):
+        """Advances particles by dt seconds. accelerations(particles) must return the
+        (N, dim) accelerations at the current positions of particles.
+        """
+        if not self.fresh:
+            particles.acc = accelerations(particles)
+        for kick, drift in zip(self.kicks, self.drifts):
+            if kick != 0:
+                particles.vel += particles.acc * (kick * dt)
+            particles.pos += particles.vel * (drift * dt)
+            particles.acc = accelerations(particles)
+        if self.kicks[-1] != 0:
+            particles.vel += particles.acc * (self.kicks[-1] * dt)
+        self.fresh = True
+
+
+def euler() -> Integrator:
+    """Returns the semi-implicit Euler scheme of Body.update(), first order.
+    """
+    return Integrator('euler', [1.0, 0.0], [1.0])
+
+
+def leapfrog() -> Integrator:
+    """Returns the kick-drift-kick leapfrog (velocity Verlet) scheme, second order.
+    """
+    return Integrator('leapfrog', [0.5, 0.5], [1.0])
+
+
+def yoshida4() -> Integrator:
+    """Returns the 4th order Yoshida / Forest-Ruth scheme: three leapfrog steps of
+    W1, W0 and W1 times the step, with the touching half kicks merged.
+    """
+    return Integrator('yoshida4', [W1 / 2, (W1 + W0) / 2, (W0 + W1) / 2, W1 / 2], [W1, W0, W1])
+
+
+INTEGRATORS = {'euler': euler, 'leapfrog': leapfrog, 'yoshida4': yoshida4}
+
+
+def make_integrator(name) -> Integrator:
+    """Returns a new integrator by name, one of INTEGRATORS.
+    """
+    if name not in INTEGRATORS:
+        raise ValueError(f'unknown integrator {name!r}, expected one of {sorted(INTEGRATORS)}')
+    return INTEGRATORS[name]()
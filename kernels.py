@@ -0,0 +1,249 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+BACKENDS = ['numpy', 'numba'] # force kernels: vectorized NumPy, or compiled and threaded with numba
+BACKEND = 'numba' if NUMBA_AVAILABLE else 'numpy' # chosen when this module is imported
+COUNTERS = ['node_visits', 'accepts', 'rejects', 'leaf_pairs'] # tree work counted by the walk kernel
+
+
+def set_backend(name):
+    """Selects the backend of the force, tree and collision kernels for the whole process.
+    """
+    global BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f'unknown backend {name!r}, expected one of {BACKENDS}')
+    if name == 'numba' and not NUMBA_AVAILABLE:
+        raise ValueError('the numba backend needs numba to be installed')
+    BACKEND = name
+
+
+def use_numba() -> bool:
+    """Returns whether the compiled kernels are in use.
+    """
+    return BACKEND == 'numba'
+
+
+if NUMBA_AVAILABLE:
+    # the kernels are compiled on their first call and cached next to this file
+    jit = numba.njit(parallel=True, cache=True)
+    prange = numba.prange
+else:
+    # without numba the kernels stay plain Python and are never called
+    def jit(function):
+        return function
+    prange = range
+
+
+@jit
+def _direct_kernel(pos, mass, targets, soft2, g, acc):
+    n, dim = pos.shape
+    for t in prange(len(targets)):
+        i = targets[t]
+        for j in range(n):
+            r2 = 0.0
+            for k in range(dim):
+                d = pos[j, k] - pos[i, k]
+                r2 += d * d
+            # bodies at the same position (including a body and itself) exert no force
+            if r2 == 0.0:
+                continue
+            r = np.sqrt(r2)
+            f = g * mass[j] / (r * (r2 + soft2))
+            for k in range(dim):
+                acc[t, k] += f * (pos[j, k] - pos[i, k])
+
+
+@jit
+def _walk_kernel(pos, mass, targets, theta, soft2, g, child, count, start, order, width, node_mass, center_mass,
+                 quadrupole, stack_size, acc, counters):
+    dim = pos.shape[1]
+    fan = child.shape[1]
+    use_quadrupole = quadrupole.shape[0] > 0
+    for t in prange(len(targets)):
+        i = targets[t]
+        d = np.empty(dim)
+        qd = np.empty(dim)
+        stack = np.empty(stack_size, dtype=np.int64)
+        stack[0] = 0
+        top = 1
+        visits = accepts = rejects = pairs = 0
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            # empty nodes contribute nothing
+            if node_mass[node] <= 0:
+                continue
+            visits += 1
+            if child[node, 0] == -1:
+                # leaves are summed body by body
+                for s in range(start[node], start[node] + count[node]):
+                    j = order[s]
+                    pairs += 1
+                    r2 = 0.0
+                    for k in range(dim):
+                        d[k] = pos[j, k] - pos[i, k]
+                        r2 += d[k] * d[k]
+                    if r2 == 0.0:
+                        continue
+                    r = np.sqrt(r2)
+                    f = g * mass[j] / (r * (r2 + soft2))
+                    for k in range(dim):
+                        acc[t, k] += f * d[k]
+                continue
+            r2 = 0.0
+            for k in range(dim):
+                d[k] = center_mass[node, k] - pos[i, k]
+                r2 += d[k] * d[k]
+            r = np.sqrt(r2)
+            if width[node] < theta * r:
+                accepts += 1
+                f = g * node_mass[node] / (r * (r2 + soft2))
+                for k in range(dim):
+                    acc[t, k] += f * d[k]
+                if use_quadrupole:
+                    # softened like the monopole, r^2 becomes r^2 + soft^2
+                    s2 = r2 + soft2
+                    dqd = 0.0
+                    for k in range(dim):
+                        qd[k] = 0.0
+                        for l in range(dim):
+                            qd[k] += quadrupole[node, k, l] * d[l]
+                        dqd += d[k] * qd[k]
+                    for k in range(dim):
+                        acc[t, k] += g * (2.5 * dqd / s2 ** 3.5 * d[k] - qd[k] / s2 ** 2.5)
+            else:
+                rejects += 1
+                for c in range(fan):
+                    stack[top] = child[node, c]
+                    top += 1
+        counters[t, 0] = visits
+        counters[t, 1] = accepts
+        counters[t, 2] = rejects
+        counters[t, 3] = pairs
+
+
+@jit
+def _morton_kernel(pos, boundary, bits, keys):
+    n, dim = pos.shape
+    scale = float(1 << bits)
+    one = np.uint64(1)
+    for i in prange(n):
+        key = np.uint64(0)
+        for k in range(dim):
+            c = (pos[i, k] - boundary[k]) / boundary[dim + k] * scale
+            c = min(max(c, 0.0), scale - 1)
+            cell = np.uint64(c)
+            # bit b of axis k goes to bit b * dim + k of the key
+            for b in range(bits):
+                if (cell >> np.uint64(b)) & one:
+                    key |= one << np.uint64(b * dim + k)
+        keys[i] = key
+
+
+@jit
+def _touching_kernel(pos, radius, order, cells, start, count, offsets, found, checks, first, second, fill):
+    dim = pos.shape[1]
+    for a in prange(len(cells)):
+        m = 0
+        pairs = 0
+        for o in range(len(offsets)):
+            target = cells[a] + offsets[o]
+            b = np.searchsorted(cells, target)
+            if b >= len(cells) or cells[b] != target:
+                continue
+            for p in range(start[a], start[a] + count[a]):
+                # within a cell, each unordered pair once
+                q0 = p + 1 if o == 0 else start[b]
+                for q in range(q0, start[b] + count[b]):
+                    i = order[p]
+                    j = order[q]
+                    pairs += 1
+                    r2 = 0.0
+                    for k in range(dim):
+                        d = pos[i, k] - pos[j, k]
+                        r2 += d * d
+                    if np.sqrt(r2) < radius[i] + radius[j]:
+                        if fill:
+                            first[found[a] + m] = i
+                            second[found[a] + m] = j
+                        m += 1
+        if not fill:
+            found[a] = m
+            checks[a] = pairs
+
+
+def direct_accelerations(pos, mass, soft, g, targets=None) -> np.ndarray:
+    """Returns the (N, D) accelerations of direct summation from the compiled kernel.
+    """
+    pos = np.ascontiguousarray(pos, dtype=np.float64)
+    targets = np.arange(len(pos)) if targets is None else np.asarray(targets, dtype=np.int64)
+    acc = np.zeros((len(targets), pos.shape[1]))
+    _direct_kernel(pos, np.ascontiguousarray(mass, dtype=np.float64), targets, float(soft) ** 2, g, acc)
+    return acc
+
+
+def tree_accelerations(tree, pos, mass, theta, soft, g, targets=None):
+    """Returns the (N, D) accelerations from a walk of a FlatQuadTree by the compiled
+    kernel, one body per thread, and the tree work in the order of COUNTERS.
+    """
+    pos = np.ascontiguousarray(pos, dtype=np.float64)
+    dim = pos.shape[1]
+    targets = np.arange(len(pos)) if targets is None else np.asarray(targets, dtype=np.int64)
+    acc = np.zeros((len(targets), dim))
+    counters = np.zeros((len(targets), len(COUNTERS)), dtype=np.int64)
+    fan = tree.child.shape[1]
+    quadrupole = tree.quadrupole if tree.quadrupole is not None else np.zeros((0, dim, dim))
+    # a node's siblings stay on the stack while it is opened, down to the deepest leaf,
+    # and the 64 bit Morton keys bound the depth (a tree rebuilt by a worker has no levels)
+    stack_size = (64 // dim + 1) * fan
+    _walk_kernel(pos, np.ascontiguousarray(mass, dtype=np.float64), targets, float(theta), float(soft) ** 2, g,
+                 tree.child, tree.count, tree.start, tree.order, np.ascontiguousarray(tree.bounds[:, dim]),
+                 tree.mass, tree.center_mass, quadrupole, stack_size, acc, counters)
+    return acc, counters.sum(axis=0)
+
+
+def morton_keys(pos, boundary, bits) -> np.ndarray:
+    """Returns the Morton keys of the positions from the compiled kernel.
+    """
+    keys = np.empty(len(pos), dtype=np.uint64)
+    _morton_kernel(np.ascontiguousarray(pos, dtype=np.float64), np.asarray(boundary, dtype=np.float64), bits, keys)
+    return keys
+
+
+def touching_pairs(pos, radius, order, cells, start, count, offsets):
+    """Returns the index arrays (i, j) of the overlapping bodies of a broad-phase grid
+    and the number of pairs checked, from the compiled kernel. Each cell is tested
+    against its neighbours by one thread, counting its pairs first and writing them
+    out second.
+    """
+    pos = np.ascontiguousarray(pos, dtype=np.float64)
+    radius = np.ascontiguousarray(radius, dtype=np.float64)
+    found = np.zeros(len(cells), dtype=np.int64)
+    checks = np.zeros(len(cells), dtype=np.int64)
+    empty = np.zeros(0, dtype=np.int64)
+    _touching_kernel(pos, radius, order, cells, start, count, offsets, found, checks, empty, empty, False)
+    total = int(found.sum())
+    found = np.cumsum(found) - found
+    first = np.empty(total, dtype=np.int64)
+    second = np.empty(total, dtype=np.int64)
+    _touching_kernel(pos, radius, order, cells, start, count, offsets, found, checks, first, second, True)
+    return first, second, int(checks.sum())
+
+
+def warm_up():
+    """Compiles the kernels, or loads them from the cache, on a few bodies, so that
+    timings do not include it.
+    """
+    pos = np.random.default_rng(0).uniform(0, 1, (64, 2))
+    direct_accelerations(pos, np.ones(64), 0.01, 1.0)
+    morton_keys(pos, np.array([0.0, 0.0, 1.0, 1.0]), 30)
+    from flattree import FlatQuadTree
+    from collisions import broad_phase
+    for quadrupole in [False, True]:
+        tree_accelerations(FlatQuadTree(pos, np.ones(64), 8, quadrupole=quadrupole), pos, np.ones(64), 0.5, 0.01, 1.0)
+    broad_phase(pos, np.full(64, 0.05))
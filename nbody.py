@@ -0,0 +1,188 @@
+import argparse
+import json
+import time
+from simulation import DT, Simulation, DirectEngine, TreeEngine, MultipoleEngine, MemorySink, TrajectorySink, Viewer
+from initial_conditions import MASS, RADIUS, SIZE, GENERATORS, make_initial_conditions, load, save
+from forces import SOFT_PARAM
+from outlines import OutlineRecorder
+from integrators import INTEGRATORS, make_integrator
+from blockstep import BlockStepper
+from instrumentation import Profiler
+from structures import ESCAPER_POLICIES
+from checkpoint import CHECKPOINT_EVERY, Checkpointer, load_checkpoint, resume
+from diagnostics import Diagnostics
+import kernels
+
+# options that describe how to start a run rather than the run itself
+RUN_OPTIONS = ['config', 'save_config', 'resume']
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Run an N-body simulation without a window unless --show is given.')
+    parser.add_argument('--config', default=None,
+                        help='JSON file of option values, keyed like the options with underscores; flags override it')
+    parser.add_argument('--save-config', default=None, help='write the resulting options to this JSON file')
+    parser.add_argument('--engine', choices=['direct', 'tree', 'fmm'], default='tree', help='force engine')
+    parser.add_argument('--bodies', type=int, default=500, help='number of bodies')
+    parser.add_argument('--steps', type=int, default=1000, help='number of steps')
+    parser.add_argument('--dt', type=float, default=DT, help='seconds per step')
+    parser.add_argument('--mass', type=float, default=MASS, help='mass of each body in kg')
+    parser.add_argument('--radius', type=float, default=RADIUS, help='radius of each body in meters')
+    parser.add_argument('--size', type=float, default=SIZE, help='side of the square the bodies start in')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the initial conditions')
+    parser.add_argument('--dim', type=int, choices=[2, 3], default=2,
+                        help='dimensions of the bodies, 3 uses an octree with the array-backed tree engine')
+    parser.add_argument('--ic', choices=sorted(GENERATORS), default='uniform',
+                        help='initial conditions: uniform box, Plummer sphere, rotating disk or colliding clusters')
+    parser.add_argument('--ic-file', default=None, help='load the initial bodies from this .npz file instead')
+    parser.add_argument('--save-ic', default=None, help='save the initial bodies to this .npz file')
+    parser.add_argument('--virial-ratio', type=float, default=1.0,
+                        help='2 T / -V of the plummer and collision clusters, 1 is virial equilibrium')
+    parser.add_argument('--clusters', type=int, default=2, help='number of colliding clusters')
+    parser.add_argument('--central-mass', type=float, default=0.0, help='mass of a central body of the disk')
+    parser.add_argument('--soft', type=float, default=SOFT_PARAM, help='softening parameter in meters')
+    parser.add_argument('--theta', type=float, default=1.0, help='opening criterion (NODE_DISTANCE_RATIO)')
+    parser.add_argument('--body-limit', type=int, default=1, help='bodies per tree leaf (BODY_LIMIT)')
+    parser.add_argument('--object-tree', action='store_true', help='use the object quadtree instead of the array-backed one')
+    parser.add_argument('--quadrupole', action='store_true', help='add the quadrupole moment of approximated nodes')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='rebuild the tree every --tree-update-freq steps instead of refitting it')
+    parser.add_argument('--rebuild-threshold', type=float, default=0.25,
+                        help='fraction of badly binned bodies that triggers a rebuild of a refitted tree')
+    parser.add_argument('--tree-update-freq', type=int, default=5, help='steps between tree rebuilds with --rebuild')
+    parser.add_argument('--escapers', choices=ESCAPER_POLICIES, default='expand',
+                        help='policy of the object tree for bodies leaving its root')
+    parser.add_argument('--fmm-order', type=int, default=5, help='expansion nodes per axis of the fmm engine')
+    parser.add_argument('--backend', choices=kernels.BACKENDS, default=kernels.BACKEND,
+                        help='kernels of the direct sum, the array-backed tree and the collisions, numba when installed')
+    parser.add_argument('--workers', type=int, default=1, help='processes sharing the force calculation')
+    parser.add_argument('--integrator', choices=sorted(INTEGRATORS), default='leapfrog', help='integration scheme')
+    parser.add_argument('--block-levels', type=int, default=0, help='individual timesteps down to dt / 2^levels')
+    parser.add_argument('--block-eta', type=float, default=0.1, help='accuracy parameter of the individual timesteps')
+    parser.add_argument('--periodic', type=float, default=None, metavar='BOX',
+                        help='wrap the bodies into a periodic box of this side in meters')
+    parser.add_argument('--collisions', action='store_true', help='merge touching bodies every step')
+    parser.add_argument('--trajectory', default=None, help='stream the frames to this file instead of memory')
+    parser.add_argument('--outlines', action='store_true', help='record the tree outlines of every frame')
+    parser.add_argument('--profile', action='store_true', help='time the phases of every step and count the tree work')
+    parser.add_argument('--profile-log', default=None, help='write one JSON line of profile per step to this file')
+    parser.add_argument('--diagnostics-every', type=int, default=0,
+                        help='measure energy, momentum, angular momentum and virial ratio every this many steps')
+    parser.add_argument('--energy-tolerance', type=float, default=None,
+                        help='stop the run when the relative energy error of the diagnostics exceeds this')
+    parser.add_argument('--show', action='store_true', help='animate the frames at the end')
+    parser.add_argument('--stride', type=int, default=1, help='steps per animation frame')
+    parser.add_argument('--quiet', action='store_true', help='do not print the progress')
+    parser.add_argument('--checkpoint', default=None, help='save the state of the run to this file every few steps')
+    parser.add_argument('--checkpoint-every', type=int, default=CHECKPOINT_EVERY, help='steps between checkpoints')
+    parser.add_argument('--resume', default=None,
+                        help='continue the run saved in this checkpoint file, with its options unless overridden')
+    return parser
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """Returns the options of the command line, with the defaults taken from the
+    --config file when one is given, and before it from the --resume checkpoint.
+    """
+    parser = make_parser()
+    args, _ = parser.parse_known_args(argv)
+    if args.resume is not None:
+        meta, _ = load_checkpoint(args.resume)
+        parser.set_defaults(**meta['metadata'].get('options', {}))
+    if args.config is not None:
+        with open(args.config) as f:
+            config = json.load(f)
+        known = {action.dest for action in parser._actions}
+        unknown = set(config) - known
+        if unknown:
+            parser.error(f'unknown options in {args.config}: {", ".join(sorted(unknown))}')
+        parser.set_defaults(**config)
+    return parser.parse_args(argv)
+
+
+def initial_conditions(args):
+    """Returns the initial bodies described by the options.
+    """
+    if args.ic_file is not None:
+        particles = load(args.ic_file)
+        args.bodies = len(particles)
+        args.dim = particles.dim
+        return particles
+    if args.dim != 2 and args.ic == 'disk':
+        raise ValueError('disk initial conditions are 2D')
+    center = (args.size / 2,) * args.dim
+    options = {'uniform': {'size': args.size, 'dim': args.dim},
+               'plummer': {'scale': args.size / 20, 'center': center, 'virial_ratio': args.virial_ratio,
+                           'soft': args.soft, 'dim': args.dim},
+               'disk': {'disk_radius': args.size / 4, 'center': center, 'central_mass': args.central_mass,
+                        'soft': args.soft},
+               'collision': {'clusters': args.clusters, 'scale': args.size / 40, 'separation': args.size / 2,
+                             'center': center, 'virial_ratio': args.virial_ratio, 'soft': args.soft,
+                             'dim': args.dim}}[args.ic]
+    particles = make_initial_conditions(args.ic, args.bodies, args.seed, mass=args.mass, radius=args.radius,
+                                        **options)
+    if args.save_ic is not None:
+        save(args.save_ic, particles, {'generator': args.ic, 'seed': args.seed, 'options': options})
+    return particles
+
+
+def build(args) -> Simulation:
+    """Returns the simulation described by the options.
+    """
+    if args.outlines and args.engine != 'tree':
+        raise ValueError('tree outlines need the tree engine')
+    kernels.set_backend(args.backend)
+    particles = initial_conditions(args)
+    if args.engine == 'direct':
+        engine = DirectEngine(args.soft, args.periodic, args.workers)
+    elif args.engine == 'tree':
+        engine = TreeEngine(args.theta, args.body_limit, args.soft, not args.object_tree, args.quadrupole,
+                            not args.rebuild, args.rebuild_threshold, args.tree_update_freq, args.escapers,
+                            args.periodic, args.workers)
+    else:
+        if args.periodic is not None:
+            raise ValueError('a periodic box is not supported by the fmm engine')
+        engine = MultipoleEngine(args.fmm_order, args.soft)
+    if args.block_levels > 0:
+        integrator = BlockStepper(args.block_levels, args.block_eta, args.soft)
+    else:
+        integrator = make_integrator(args.integrator)
+    if args.trajectory is not None:
+        sink = TrajectorySink(args.trajectory, args.bodies, args.steps + 1, args.dt, radii=args.collisions,
+                              metadata={'options': options(args)}, dim=particles.dim)
+    else:
+        sink = MemorySink(args.bodies, radii=args.collisions, dim=particles.dim)
+    outlines = OutlineRecorder() if args.outlines else None
+    profiler = Profiler(args.profile_log) if args.profile or args.profile_log else None
+    viewer = Viewer(args.periodic or args.size, f'{args.bodies} bodies', args.stride) if args.show else None
+    checkpointer = None
+    if args.checkpoint is not None:
+        checkpointer = Checkpointer(args.checkpoint, args.checkpoint_every, {'options': options(args)})
+    if args.energy_tolerance is not None and args.diagnostics_every <= 0:
+        raise ValueError('an energy tolerance needs --diagnostics-every')
+    diagnostics = Diagnostics(args.diagnostics_every, args.energy_tolerance) if args.diagnostics_every > 0 else None
+    simulation = Simulation(particles, engine, integrator, args.dt, sink, outlines, args.collisions, profiler,
+                            viewer, not args.quiet, checkpointer, diagnostics)
+    if args.resume is not None:
+        resume(simulation, args.resume)
+    return simulation
+
+
+def options(args) -> dict:
+    """Returns the options that describe the run itself.
+    """
+    return {name: value for name, value in vars(args).items() if name not in RUN_OPTIONS}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.save_config is not None:
+        with open(args.save_config, 'w') as f:
+            json.dump(options(args), f, indent=1)
+    start_time = time.time()
+    build(args).run(args.steps)
+    print('Total time:', time.time() - start_time)
+
+
+if __name__ == '__main__':
+    main()
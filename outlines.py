@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class OutlineRecorder:
+    """A class to record the outline of a quadtree at every frame, compactly.
+    Each distinct outline is stored once as a (K, 4) float32 array of segments
+    [x1, y1, x2, y2], and frames only keep the index of their outline, so frames
+    between two changes of the tree cost a single integer.
+    === Instance Attributes ===
+    outlines: The distinct outlines, in the order they were recorded.
+    frames: For each frame, the index of its outline in outlines.
+    """
+    outlines: list
+    frames: list
+
+    def __init__(self):
+        self.outlines = []
+        self.frames = []
+        self._tree = None
+        self._version = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def record(self, tree):
+        """Records the outline of tree for the next frame.
+        The segments are only computed when the tree was rebuilt or changed shape.
+        """
+        if tree is not self._tree or tree.version != self._version:
+            self.outlines.append(np.asarray(tree.segments(), dtype=np.float32))
+            self._tree = tree
+            self._version = tree.version
+        self.frames.append(len(self.outlines) - 1)
+
+    def segments(self, frame) -> np.ndarray:
+        """Returns the (K, 4) segments of the outline at frame.
+        """
+        return self.outlines[self.frames[frame]]
+
+    def nbytes(self) -> int:
+        """Returns the memory used by the recorded outlines in bytes.
+        """
+        return sum(outline.nbytes for outline in self.outlines) + 8 * len(self.frames)
+
+    def arrays(self) -> dict:
+        """Returns the recorded outlines as the arrays frames, sizes and segments.
+        """
+        sizes = np.array([len(outline) for outline in self.outlines], dtype=np.int64)
+        segments = np.concatenate(self.outlines) if self.outlines else np.zeros((0, 4), np.float32)
+        return {'frames': np.array(self.frames, dtype=np.int64), 'sizes': sizes, 'segments': segments}
+
+    def set_arrays(self, data):
+        """Replaces the recorded outlines by the ones in arrays returned by arrays().
+        """
+        ends = np.cumsum(data['sizes'])
+        self.outlines = np.split(data['segments'], ends[:-1]) if len(ends) > 0 else []
+        self.frames = data['frames'].tolist()
+        self._tree = None
+        self._version = None
+
+    def save(self, path):
+        """Saves the recorded outlines to a .npz file.
+        """
+        np.savez(path, **self.arrays())
+
+    @classmethod
+    def load(cls, path):
+        """Returns the outlines saved in a .npz file.
+        """
+        recorder = cls()
+        with np.load(path) as data:
+            recorder.set_arrays(data)
+        return recorder
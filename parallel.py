@@ -0,0 +1,185 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import kernels
+from forces import SOFT_PARAM, direct_accelerations
+from flattree import FlatQuadTree
+
+TREE_FIELDS = ['order', 'start', 'count', 'child', 'bounds', 'mass', 'center_mass', 'quadrupole']
+CHUNKS_PER_WORKER = 4 # slices handed to each worker per evaluation, evens out the load
+
+# shared memory blocks attached by a worker process, by field name
+_attached = {}
+
+
+class SharedArrays:
+    """A class to represent a set of named arrays kept in shared memory blocks.
+    Blocks are reused between calls and only reallocated when an array outgrows them.
+    === Instance Attributes ===
+    blocks: The shared memory block of each field.
+    specs: The (block name, shape, dtype) of the array stored in each field.
+    """
+    blocks: dict
+    specs: dict
+
+    def __init__(self):
+        self.blocks = {}
+        self.specs = {}
+
+    def put(self, field, array) -> np.ndarray:
+        """Copies the array into the block of field and returns the shared view of it.
+        """
+        array = np.ascontiguousarray(array)
+        block = self.blocks.get(field)
+        if block is None or block.size < max(array.nbytes, 1):
+            if block is not None:
+                block.close()
+                block.unlink()
+            # leave room to grow so the block is not reallocated every step
+            block = shared_memory.SharedMemory(create=True, size=max(2 * array.nbytes, 64))
+            self.blocks[field] = block
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        view[...] = array
+        self.specs[field] = (block.name, array.shape, array.dtype.str)
+        return view
+
+    def get(self, field) -> np.ndarray:
+        """Returns the shared view of the array stored in field.
+        """
+        name, shape, dtype = self.specs[field]
+        return np.ndarray(shape, dtype=dtype, buffer=self.blocks[field].buf)
+
+    def close(self):
+        """Frees every shared memory block.
+        """
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+        self.specs = {}
+
+
+def _attach(field, spec) -> np.ndarray:
+    """Returns a worker's view of the shared array described by spec.
+    """
+    name, shape, dtype = spec
+    attached = _attached.get(field)
+    if attached is None or attached.name != name:
+        if attached is not None:
+            attached.close()
+        # workers share the parent's resource tracker, and the parent unlinks the block
+        attached = shared_memory.SharedMemory(name=name)
+        _attached[field] = attached
+    return np.ndarray(shape, dtype=dtype, buffer=attached.buf)
+
+
+def _initialize(backend):
+    """Selects the kernel backend of the parent in a new worker process.
+    """
+    kernels.set_backend(backend)
+
+
+def _evaluate(specs, bounds, theta, soft, box):
+    """Computes the accelerations of a slice of the bodies listed in the shared ids
+    array in a worker process and writes them into the shared acceleration array.
+    """
+    pos = _attach('pos', specs['pos'])
+    mass = _attach('mass', specs['mass'])
+    acc = _attach('acc', specs['acc'])
+    ids = _attach('ids', specs['ids'])[bounds[0]:bounds[1]]
+    if 'tree_order' in specs:
+        tree = FlatQuadTree.__new__(FlatQuadTree)
+        tree.quadrupole = None
+        for field in TREE_FIELDS:
+            if 'tree_' + field in specs:
+                array = _attach('tree_' + field, specs['tree_' + field])
+                # the tree is shared read only between workers
+                array.flags.writeable = False
+                setattr(tree, field, array)
+        acc[ids] = tree.accelerations(pos, mass, theta, soft, targets=ids, box=box)
+    else:
+        acc[ids] = direct_accelerations(pos, mass, soft, targets=ids, box=box)
+
+
+class ParallelForces:
+    """A class to evaluate accelerations on several CPU cores.
+    Bodies are split into slices that a pool of worker processes evaluates at the same
+    time. Positions, masses, accelerations and the tree are passed through shared memory,
+    so only the names of the blocks and the slice bounds are sent to the workers.
+    === Instance Attributes ===
+    workers: The number of worker processes.
+    theta: The opening criterion used when walking a tree.
+    soft: The softening parameter in meters.
+    box: The side of the periodic box in meters, or None.
+    pool: The pool of worker processes.
+    shared: The arrays shared with the workers.
+    """
+    workers: int
+    theta: float
+    soft: float
+    box: float
+    pool: ProcessPoolExecutor
+    shared: SharedArrays
+
+    def __init__(self, workers=None, theta=1.0, soft=SOFT_PARAM, box=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.theta = theta
+        self.soft = soft
+        self.box = box
+        # workers are started fresh rather than forked, as a fork of a process whose numba
+        # threads are running never exits, and they use the parent's kernel backend
+        self.pool = ProcessPoolExecutor(self.workers, multiprocessing.get_context('spawn'), _initialize,
+                                        (kernels.BACKEND,))
+        self.shared = SharedArrays()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def accelerations(self, pos, mass, tree=None, targets=None) -> np.ndarray:
+        """Returns the (N, D) array of accelerations on every body, or the accelerations
+        of the bodies with indices targets only.
+        With a FlatQuadTree, built once by the caller, each worker walks it for a slice
+        of the bodies in Morton order. Without one, slices are summed directly.
+        """
+        n = len(pos)
+        if tree is not None:
+            ids = tree.order
+            if targets is not None:
+                # targets are walked in Morton order so each slice stays compact
+                rank = np.empty(n, dtype=np.int64)
+                rank[tree.order] = np.arange(n)
+                ids = tree.order[np.sort(rank[targets])]
+        else:
+            ids = np.arange(n) if targets is None else np.asarray(targets, dtype=np.int64)
+        fields = ['pos', 'mass', 'acc', 'ids']
+        self.shared.put('ids', ids)
+        self.shared.put('pos', np.asarray(pos, dtype=np.float64))
+        self.shared.put('mass', np.asarray(mass, dtype=np.float64))
+        self.shared.put('acc', np.zeros(np.shape(pos)))
+        if tree is not None:
+            for field in TREE_FIELDS:
+                array = getattr(tree, field)
+                if array is not None:
+                    self.shared.put('tree_' + field, array)
+                    fields.append('tree_' + field)
+        specs = {field: self.shared.specs[field] for field in fields}
+        chunks = min(len(ids), self.workers * CHUNKS_PER_WORKER)
+        bounds = np.linspace(0, len(ids), chunks + 1).astype(int) if chunks > 0 else []
+        futures = [self.pool.submit(_evaluate, specs, (int(lo), int(hi)), self.theta, self.soft, self.box)
+                   for lo, hi in zip(bounds[:-1], bounds[1:])]
+        for future in futures:
+            future.result()
+        if targets is not None:
+            return self.shared.get('acc')[targets]
+        return self.shared.get('acc').copy()
+
+    def close(self):
+        """Stops the worker processes and frees the shared memory.
+        """
+        self.pool.shutdown()
+        self.shared.close()
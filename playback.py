@@ -0,0 +1,140 @@
+import argparse
+import os
+import numpy as np
+from trajectory import TrajectoryReader
+from outlines import OutlineRecorder
+
+SCALE = 1e-6 # meters to million km
+DELTA = 0.01 # 0.01 seconds per frame
+MARKER_SIZE = 1 # marker size when the trajectory has no radii
+
+
+def select_bodies(n, max_bodies, seed=0) -> np.ndarray:
+    """Returns the sorted indices of at most max_bodies bodies, chosen at random.
+    """
+    if max_bodies is None or max_bodies >= n:
+        return np.arange(n)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(n, max_bodies, replace=False))
+
+
+def frame_bounds(pos, pad=0.05):
+    """Returns square axis limits (lo, hi) around the finite positions of a frame.
+    """
+    pos = pos[np.isfinite(pos).all(axis=1)]
+    if len(pos) == 0:
+        return 0.0, 1.0
+    lo = pos.min()
+    hi = pos.max()
+    margin = (hi - lo) * pad or 1.0
+    return lo - margin, hi + margin
+
+
+class Playback:
+    """A class to animate a saved trajectory, reading one frame at a time.
+    === Instance Attributes ===
+    reader: The trajectory being played.
+    frames: The indices of the frames shown, every stride frames.
+    bodies: The indices of the bodies shown.
+    scale: The factor from meters to plot units.
+    fig: The matplotlib figure.
+    scatter: The scatter plot of the bodies.
+    outlines: The recorded quadtree outlines, or None.
+    lines: The LineCollection that draws the outlines, or None.
+    """
+    reader: TrajectoryReader
+    frames: np.ndarray
+    bodies: np.ndarray
+    scale: float
+
+    def __init__(self, reader, stride=1, max_bodies=None, bound=None, scale=SCALE, seed=0, outlines=None):
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import LineCollection
+        self.reader = reader
+        self.frames = np.arange(0, len(reader), stride)
+        self.bodies = select_bodies(reader.n, max_bodies, seed)
+        self.scale = scale
+        self.fig = plt.figure()
+        self.scatter = plt.scatter([], [], s=MARKER_SIZE, c='black')
+        ax = self.fig.get_axes()[0]
+        self.outlines = outlines
+        self.lines = None
+        if outlines is not None:
+            self.lines = LineCollection([], colors='r')
+            ax.add_collection(self.lines)
+        if bound is None:
+            lo, hi = frame_bounds(reader.positions()[0][:, :2] * scale)
+        else:
+            lo, hi = 0, bound * scale
+        ax.set_xlim(lo, hi)
+        ax.set_ylim(lo, hi)
+        ax.set_title(f'{len(self.bodies)} of {reader.n} bodies')
+        ax.set_xlabel('x (million km)')
+        ax.set_ylabel('y (million km)')
+        ax.set_aspect('equal', adjustable='box')
+
+    def update(self, i):
+        """Draws the i-th shown frame. Only that frame is read from the file.
+        """
+        frame = self.frames[i]
+        # 3D runs are seen from above, along the z axis
+        self.scatter.set_offsets(self.reader.positions()[frame][self.bodies, :2] * self.scale)
+        if self.reader.header['radii']:
+            self.scatter.set_sizes(self.reader.radii()[frame][self.bodies] * self.scale)
+        if self.lines is not None and frame < len(self.outlines):
+            self.lines.set_segments(self.outlines.segments(frame).reshape(-1, 2, 2) * self.scale)
+            return [self.lines, self.scatter]
+        return [self.scatter]
+
+    def animation(self, delta=DELTA):
+        """Returns a FuncAnimation that plays the frames.
+        """
+        from matplotlib import animation
+        return animation.FuncAnimation(self.fig, self.update, frames=range(len(self.frames)),
+                                       interval=delta * 1000, blit=True)
+
+    def save_images(self, directory, dpi=None):
+        """Renders every shown frame to a numbered PNG file in directory.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for i in range(len(self.frames)):
+            self.update(i)
+            self.fig.savefig(os.path.join(directory, f'frame_{i:06d}.png'), dpi=dpi)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Play back a saved N-body trajectory.')
+    parser.add_argument('trajectory', help='trajectory file written by a simulation')
+    parser.add_argument('--stride', type=int, default=1, help='show every stride-th frame (SIM_SPEED)')
+    parser.add_argument('--max-bodies', type=int, default=None, help='draw a random subset of this many bodies')
+    parser.add_argument('--bound', type=float, default=None, help='axis limit in meters, default fits the first frame')
+    parser.add_argument('--delta', type=float, default=DELTA, help='seconds per animation frame')
+    parser.add_argument('--outlines', default=None, help='quadtree outlines (.npz) saved with the trajectory')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the body subset')
+    parser.add_argument('--save', default=None, help='write a video (.mp4 with ffmpeg, .gif with pillow) instead of showing it')
+    parser.add_argument('--images', default=None, help='write one PNG per frame into this directory instead of showing it')
+    parser.add_argument('--dpi', type=int, default=None, help='resolution of exported frames')
+    args = parser.parse_args(argv)
+
+    import matplotlib
+    headless = args.save is not None or args.images is not None
+    if headless:
+        matplotlib.use('Agg')
+    reader = TrajectoryReader(args.trajectory)
+    outlines = OutlineRecorder.load(args.outlines) if args.outlines is not None else None
+    playback = Playback(reader, args.stride, args.max_bodies, args.bound, seed=args.seed, outlines=outlines)
+    print('Frames:', len(playback.frames))
+    if args.images is not None:
+        playback.save_images(args.images, args.dpi)
+    if args.save is not None:
+        writer = 'pillow' if args.save.endswith('.gif') else None
+        playback.animation(args.delta).save(args.save, writer=writer, fps=1 / args.delta, dpi=args.dpi)
+    if not headless:
+        import matplotlib.pyplot as plt
+        anim = playback.animation(args.delta)
+        plt.show()
+        plt.close()
+
+
+if __name__ == '__main__':
+    main()
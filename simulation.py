@@ -0,0 +1,546 @@
+import numpy as np
+from structures import ParticleSet, QuadTree
+from forces import G, SOFT_PARAM, direct_accelerations
+from flattree import FlatQuadTree
+from collisions import merge_collisions
+from parallel import ParallelForces
+from trajectory import TrajectoryReader, TrajectoryWriter
+from integrators import make_integrator
+from fmm import FastMultipole
+from periodic import wrap
+from instrumentation import phase
+from initial_conditions import SIZE
+
+DT = 59220 * 0.01 # seconds per step, TSTEP * DELTA of the drivers
+SCALE = 1e-6 # meters to million km in the plots
+DELTA = 0.01 # seconds per animation frame
+
+
+def gforce(m1, m2, vec_r, soft=SOFT_PARAM):
+    # calculate gravitational force between two bodies
+    r = np.linalg.norm(vec_r)
+    if r == 0:
+        return np.zeros(len(vec_r))
+    dir_r = vec_r / r
+    force_mag = G * m1 * m2 / (r ** 2 + soft ** 2)
+    return force_mag * dir_r
+
+
+def quadrupole_force(body, quadtree, soft=SOFT_PARAM):
+    # quadrupole correction to the force of a node approximated by its center of mass,
+    # softened like gforce() by replacing r^2 with r^2 + soft^2
+    d = quadtree.center_mass - body.pos
+    r = np.linalg.norm(d)
+    if r == 0:
+        return np.zeros(len(d))
+    s2 = r ** 2 + soft ** 2
+    qd = quadtree.quadrupole @ d
+    return G * body.mass * (2.5 * np.dot(d, qd) * d / s2 ** 3.5 - qd / s2 ** 2.5)
+
+
+def calculate_total_force(body, quadtree, theta=1.0, soft=SOFT_PARAM, quadrupole=False, stats=None):
+    if stats is not None:
+        stats.count('node_visits')
+    if quadtree.get_total_mass() == 0:
+        return np.zeros(len(body.pos))
+    if len(quadtree.children) > 0 and quadtree.get_ratio(body) < theta:
+        if stats is not None:
+            stats.count('accepts')
+        force = gforce(body.mass, quadtree.get_total_mass(), quadtree.center_mass - body.pos, soft)
+        if quadrupole:
+            force += quadrupole_force(body, quadtree, soft)
+        return force
+    else:
+        if stats is not None:
+            stats.count('rejects' if len(quadtree.children) > 0 else 'leaves')
+        # leaves, and bodies that did not fit in a child, are summed directly
+        force = np.zeros(len(body.pos))
+        for other in quadtree.bodies:
+            force += gforce(body.mass, other.mass, other.pos - body.pos, soft)
+        for child in quadtree.children:
+            force += calculate_total_force(body, child, theta, soft, quadrupole, stats)
+        return force
+
+
+def escaped_force(body, quadtree, soft=SOFT_PARAM):
+    # bodies outside the root are not in the tree and are summed directly
+    force = np.zeros(len(body.pos))
+    for other in quadtree.direct_bodies():
+        force += gforce(body.mass, other.mass, other.pos - body.pos, soft)
+    return force
+
+
+class DirectEngine:
+    """A class to compute accelerations by all-pairs direct summation.
+    Every engine has start(), accelerations(), update() and close(), and a box that
+    is the side of its periodic box or None.
+    === Instance Attributes ===
+    soft: The softening parameter in meters.
+    box: The side of the periodic box in meters, or None.
+    pool: The worker processes sharing the summation, or None.
+    """
+    soft: float
+
+    def __init__(self, soft=SOFT_PARAM, box=None, workers=1):
+        self.soft = soft
+        self.box = box
+        self.pool = ParallelForces(workers, soft=soft, box=box) if workers > 1 else None
+
+    def start(self, particles):
+        """Prepares the engine for the initial bodies.
+        """
+
+    def accelerations(self, particles, targets=None, stats=None) -> np.ndarray:
+        """Returns the accelerations of every body, or of the bodies with indices targets.
+        """
+        if self.pool is not None:
+            return self.pool.accelerations(particles.pos, particles.mass, targets=targets)
+        return direct_accelerations(particles.pos, particles.mass, self.soft, targets=targets, box=self.box)
+
+    def update(self, particles, step, merged):
+        """Called at the end of every step, merged telling whether bodies were merged.
+        """
+
+    def supports(self, dim) -> bool:
+        """Returns whether the engine handles bodies in dim dimensions. The Ewald
+        correction of periodic boxes is 2D.
+        """
+        return dim == 2 or self.box is None
+
+    def close(self):
+        """Stops the worker processes.
+        """
+        if self.pool is not None:
+            self.pool.close()
+
+
+class TreeEngine(DirectEngine):
+    """A class to compute accelerations with a Barnes-Hut quadtree.
+    The tree is refitted before every evaluation when incremental, and rebuilt when
+    too many bodies left their leaves, after bodies were merged, or every
+    update_freq steps otherwise.
+    === Instance Attributes ===
+    theta: The opening criterion, NODE_DISTANCE_RATIO of the drivers.
+    body_limit: The number of bodies per leaf.
+    flat: Whether the array-backed quadtree is used instead of the object tree.
+    quadrupole: Whether nodes also carry their quadrupole moment.
+    incremental: Whether the tree is refitted every evaluation.
+    rebuild_threshold: The fraction of badly binned bodies that triggers a rebuild.
+    update_freq: The steps between rebuilds when not incremental.
+    escapers: The policy of the object tree for bodies leaving its root.
+    tree: The current quadtree, or None before start().
+    bodies: The views of the bodies used by the object tree.
+    """
+    theta: float
+    body_limit: int
+    flat: bool
+    quadrupole: bool
+    incremental: bool
+    rebuild_threshold: float
+    update_freq: int
+    escapers: str
+
+    def __init__(self, theta=1.0, body_limit=1, soft=SOFT_PARAM, flat=True, quadrupole=False, incremental=True,
+                 rebuild_threshold=0.25, update_freq=5, escapers='expand', box=None, workers=1):
+        if box is not None and not flat:
+            raise ValueError('a periodic box is only supported by the array-backed quadtree')
+        self.theta = theta
+        self.body_limit = body_limit
+        self.soft = soft
+        self.flat = flat
+        self.quadrupole = quadrupole
+        self.incremental = incremental
+        self.rebuild_threshold = rebuild_threshold
+        self.update_freq = update_freq
+        self.escapers = escapers
+        self.box = box
+        self.pool = ParallelForces(workers, theta, soft, box) if flat and workers > 1 else None
+        self.tree = None
+        self.bodies = []
+
+    def build(self, particles):
+        """Builds a new tree over the current bodies.
+        """
+        if self.flat:
+            # a periodic box is the root itself, so the tree stays balanced however far bodies travel
+            boundary = [0, 0, self.box, self.box] if self.box is not None else None
+            self.tree = FlatQuadTree(particles.pos, particles.mass, self.body_limit, boundary,
+                                     quadrupole=self.quadrupole)
+        else:
+            self.bodies = particles.bodies()
+            # the root is sized to the current extent of the bodies
+            self.tree = QuadTree(None, self.body_limit, self.bodies, self.escapers)
+
+    def refit(self, particles) -> float:
+        """Refits the tree to the moved bodies and returns the fraction of badly binned bodies.
+        """
+        if self.flat:
+            return self.tree.refit(particles.pos, particles.mass)
+        return self.tree.refit()
+
+    def start(self, particles):
+        self.build(particles)
+
+    def accelerations(self, particles, targets=None, stats=None) -> np.ndarray:
+        with phase(stats, 'tree'):
+            if self.tree is None:
+                self.build(particles)
+            elif self.incremental and self.refit(particles) > self.rebuild_threshold:
+                # the tree follows the bodies through every stage of a step
+                self.build(particles)
+        if targets is None:
+            targets = np.arange(len(particles))
+        if stats is not None:
+            stats.count('evaluated', len(targets))
+        if self.pool is not None:
+            return self.pool.accelerations(particles.pos, particles.mass, self.tree, targets)
+        if self.flat:
+            return self.tree.accelerations(particles.pos, particles.mass, self.theta, self.soft,
+                                           targets=np.asarray(targets), box=self.box, stats=stats)
+        acc = np.zeros((len(targets), 2))
+        for i, target in enumerate(targets):
+            # traverse quadtree
+            body = self.bodies[target]
+            force = calculate_total_force(body, self.tree, self.theta, self.soft, self.quadrupole, stats)
+            acc[i] = (force + escaped_force(body, self.tree, self.soft)) / body.mass
+        return acc
+
+    def supports(self, dim) -> bool:
+        # the object quadtree is 2D, the array-backed tree becomes an octree in 3D
+        return dim == 2 or (self.flat and self.box is None)
+
+    def update(self, particles, step, merged):
+        if merged:
+            # merging reorders the bodies, so the tree cannot be refitted
+            self.build(particles)
+        elif not self.incremental and step % self.update_freq == 0:
+            self.build(particles)
+
+
+class MultipoleEngine(DirectEngine):
+    """A class to compute accelerations with the fast multipole method.
+    === Instance Attributes ===
+    fmm: The fast multipole solver.
+    """
+    fmm: FastMultipole
+
+    def __init__(self, order=5, soft=SOFT_PARAM):
+        self.soft = soft
+        self.box = None
+        self.pool = None
+        self.fmm = FastMultipole(order, soft=soft)
+
+    def accelerations(self, particles, targets=None, stats=None) -> np.ndarray:
+        return self.fmm.accelerations(particles.pos, particles.mass, targets)
+
+    def supports(self, dim) -> bool:
+        return dim == 2
+
+
+class MemorySink:
+    """A class to keep the frames of a simulation in memory.
+    Bodies missing from the end of a frame, for example after merging, are stored as
+    NaN positions with zero radius.
+    === Instance Attributes ===
+    n: The number of bodies of a frame.
+    radii: Whether the radii are stored too.
+    dim: The number of dimensions of the positions.
+    positions: The (n, dim) positions of every frame.
+    radius: The (n,) radii of every frame, when stored.
+    """
+    n: int
+    radii: bool
+    dim: int
+    positions: list
+    radius: list
+
+    def __init__(self, n, radii=False, dim=2):
+        self.n = n
+        self.radii = radii
+        self.dim = dim
+        self.positions = []
+        self.radius = []
+
+    def open(self, frames=0):
+        """Starts storing frames after the first frames frames already stored.
+        """
+        del self.positions[frames:]
+        del self.radius[frames:]
+
+    def write(self, particles):
+        """Appends the current frame.
+        """
+        pos = np.full((self.n, self.dim), np.nan)
+        pos[:len(particles)] = particles.pos
+        self.positions.append(pos)
+        if self.radii:
+            rad = np.zeros(self.n)
+            rad[:len(particles)] = particles.radius
+            self.radius.append(rad)
+
+    def close(self):
+        """Returns the (frames, n, dim) positions and the (frames, n) radii, or None.
+        """
+        return np.array(self.positions), np.array(self.radius) if self.radii else None
+
+
+class TrajectorySink:
+    """A class to stream the frames of a simulation to a trajectory file.
+    The file is only created, or reopened, by open().
+    === Instance Attributes ===
+    path: The path of the trajectory file.
+    n: The number of bodies of a frame.
+    frames: The number of frames the file has room for.
+    dt: The seconds per step.
+    radii: Whether the radii are stored too.
+    metadata: Extra values stored in the header of the file.
+    dim: The number of dimensions of the positions.
+    writer: The writer of the file, or None before open().
+    """
+    path: str
+    n: int
+    frames: int
+    dt: float
+    radii: bool
+    metadata: dict
+    dim: int
+
+    def __init__(self, path, n, frames, dt, radii=False, metadata=None, dim=2):
+        self.path = path
+        self.n = n
+        self.frames = frames
+        self.dt = dt
+        self.radii = radii
+        self.metadata = metadata
+        self.dim = dim
+        self.writer = None
+
+    def open(self, frames=0):
+        """Creates the file, or appends to the existing file after its first frames frames.
+        """
+        if frames == 0:
+            self.writer = TrajectoryWriter(self.path, self.n, self.frames, self.dt, self.radii, self.metadata,
+                                           self.dim)
+        else:
+            self.writer = TrajectoryWriter.reopen(self.path, frames, self.frames)
+
+    def write(self, particles):
+        """Appends the current frame.
+        """
+        self.writer.write(particles.pos, particles.radius)
+
+    def close(self):
+        """Closes the file and returns its positions and radii, or None, read back lazily.
+        """
+        self.writer.close()
+        reader = TrajectoryReader(self.path)
+        return reader.positions(), reader.radii() if reader.header['radii'] else None
+
+
+class Viewer:
+    """A class to animate the frames of a simulation with matplotlib.
+    matplotlib is only imported by show(), so headless runs never load it.
+    === Instance Attributes ===
+    bound: The axis limit in meters.
+    title: The title of the plot.
+    stride: The steps per animation frame, SIM_SPEED of the drivers.
+    delta: The seconds per animation frame.
+    scale: The factor from meters to plot units.
+    """
+    bound: float
+    title: str
+    stride: int
+    delta: float
+    scale: float
+
+    def __init__(self, bound=SIZE, title='', stride=1, delta=DELTA, scale=SCALE):
+        self.bound = bound
+        self.title = title
+        self.stride = stride
+        self.delta = delta
+        self.scale = scale
+
+    def show(self, positions, radii=None, outlines=None):
+        """Animates the frames in a window until it is closed.
+        """
+        import matplotlib.pyplot as plt
+        from matplotlib import animation
+        from matplotlib.collections import LineCollection
+        fig = plt.figure()
+        scatter = plt.scatter([], [], s=1, c='black')
+        ax = fig.get_axes()[0]
+        lines = None
+        if outlines is not None:
+            lines = LineCollection([], colors='r')
+            ax.add_collection(lines)
+        ax.set_xlim(0, self.bound * self.scale)
+        ax.set_ylim(0, self.bound * self.scale)
+        ax.set_title(self.title)
+        ax.set_xlabel('x (million km)')
+        ax.set_ylabel('y (million km)')
+        ax.set_aspect('equal', adjustable='box')
+
+        def update(frame):
+            # 3D runs are seen from above, along the z axis
+            scatter.set_offsets(positions[frame * self.stride][:, :2] * self.scale)
+            if radii is not None:
+                scatter.set_sizes(radii[frame * self.stride] * self.scale)
+            if lines is not None:
+                lines.set_segments(outlines.segments(frame * self.stride).reshape(-1, 2, 2) * self.scale)
+                return [lines, scatter]
+            return [scatter]
+
+        frames = len(positions) // self.stride
+        print('Frames:', frames)
+        print('Frames per second:', 1 / self.delta)
+        anim = animation.FuncAnimation(fig, update, frames=range(frames), interval=self.delta * 1000, blit=True)
+        plt.show()
+        plt.close()
+
+
+class Simulation:
+    """A class to run an N-body simulation out of injectable components: the engine
+    computing the accelerations, the integrator advancing the bodies, the sink
+    storing the frames and an optional viewer animating them.
+    === Instance Attributes ===
+    particles: The bodies being simulated.
+    engine: The DirectEngine, TreeEngine or MultipoleEngine computing the accelerations.
+    integrator: The Integrator or BlockStepper advancing the bodies.
+    dt: The seconds per step.
+    sink: The MemorySink or TrajectorySink storing the frames.
+    outlines: The OutlineRecorder of the tree outlines, or None.
+    collisions: Whether touching bodies are merged after every step.
+    profiler: The Profiler timing the phases of each step, or None.
+    viewer: The Viewer animating the frames at the end of run(), or None.
+    progress: Whether run() prints its progress.
+    checkpointer: The Checkpointer saving the state of the run every few steps, or None.
+    diagnostics: The Diagnostics measuring the conserved quantities every few steps, or None.
+    steps_done: The number of steps taken so far, restored by resuming from a checkpoint.
+    """
+    particles: ParticleSet
+    dt: float
+    collisions: bool
+    progress: bool
+    steps_done: int
+
+    def __init__(self, particles, engine, integrator=None, dt=DT, sink=None, outlines=None, collisions=False,
+                 profiler=None, viewer=None, progress=True, checkpointer=None, diagnostics=None):
+        if outlines is not None and not hasattr(engine, 'tree'):
+            raise ValueError('tree outlines need an engine with a tree')
+        if not engine.supports(particles.dim):
+            raise ValueError(f'{type(engine).__name__} does not support {particles.dim}D bodies with these options')
+        if outlines is not None and particles.dim != 2:
+            raise ValueError('tree outlines are only drawn in 2D')
+        self.particles = particles
+        self.engine = engine
+        self.integrator = integrator if integrator is not None else make_integrator('leapfrog')
+        self.dt = dt
+        self.sink = sink if sink is not None else MemorySink(len(particles), dim=particles.dim)
+        if self.sink.dim != particles.dim:
+            raise ValueError(f'the sink stores {self.sink.dim}D frames of {particles.dim}D bodies')
+        self.outlines = outlines
+        self.collisions = collisions
+        self.profiler = profiler
+        self.viewer = viewer
+        self.progress = progress
+        self.checkpointer = checkpointer
+        self.diagnostics = diagnostics
+        self.steps_done = 0
+
+    def accelerations(self, particles, targets=None) -> np.ndarray:
+        """Returns the accelerations of every body, or of the bodies with indices
+        targets, the callback given to the integrator.
+        """
+        if self.engine.box is not None:
+            wrap(particles.pos, self.engine.box)
+        with phase(self.profiler, 'forces'):
+            return self.engine.accelerations(particles, targets, self.profiler)
+
+    def start(self):
+        """Stores the initial frame.
+        """
+        self.engine.start(self.particles)
+        self.sink.open()
+        if self.outlines is not None:
+            # one outline per stored frame, starting with the initial positions
+            self.outlines.record(self.engine.tree)
+        self.sink.write(self.particles)
+        if self.diagnostics is not None:
+            self.diagnostics.open(self.diagnostics_path())
+            self.diagnostics.step(self, 0)
+
+    def diagnostics_path(self):
+        """Returns the path of the CSV file of the diagnostics, next to the trajectory
+        file, or None when the frames are kept in memory.
+        """
+        if isinstance(self.sink, TrajectorySink):
+            return self.sink.path + '.diagnostics.csv'
+        return None
+
+    def step(self, k):
+        """Advances the bodies by one step, merges touching bodies and stores the frame.
+        """
+        profiler = self.profiler
+        with phase(profiler, 'integrate'):
+            self.integrator.step(self.particles, self.dt, self.accelerations)
+        with phase(profiler, 'collisions'):
+            merged = self.collisions and merge_collisions(self.particles, profiler) > 0
+        if merged:
+            self.integrator.reset()
+        with phase(profiler, 'tree'):
+            self.engine.update(self.particles, k, merged)
+        with phase(profiler, 'bookkeeping'):
+            if self.outlines is not None:
+                # the tree is refitted in place, so its outline is recorded now
+                self.outlines.record(self.engine.tree)
+            self.sink.write(self.particles)
+        if self.diagnostics is not None:
+            with phase(profiler, 'diagnostics'):
+                # an incrementally refitted tree is current here, so the potential walk reuses it
+                self.diagnostics.step(self, k + 1)
+        if profiler is not None:
+            tree = getattr(self.engine, 'tree', None)
+            if tree is not None:
+                profiler.gauge('tree_depth', tree.depth())
+            counts = profiler.step_counts
+            profiler.end_step(k, bodies=len(self.particles),
+                              visits_per_body=counts.get('node_visits', 0) / max(counts.get('evaluated', 0), 1))
+
+    def finish(self):
+        """Stops the engine, closes the sink and the profiler and returns the positions
+        and radii of every frame.
+        """
+        self.engine.close()
+        if self.profiler is not None:
+            print(self.profiler.summary())
+            self.profiler.close()
+        if self.diagnostics is not None:
+            print(self.diagnostics.summary())
+            self.diagnostics.close()
+        positions, radii = self.sink.close()
+        if self.outlines is not None and isinstance(self.sink, TrajectorySink):
+            self.outlines.save(self.sink.path + '.outlines.npz')
+        return positions, radii
+
+    def run(self, steps):
+        """Runs the simulation until steps steps were taken and returns the positions
+        and radii (or None) of every frame, the initial one included. A simulation
+        resumed from a checkpoint continues where it stopped. The viewer, if any,
+        animates the frames afterwards.
+        """
+        if self.steps_done == 0:
+            self.start()
+        for k in range(self.steps_done, steps):
+            self.step(k)
+            self.steps_done = k + 1
+            if self.checkpointer is not None:
+                self.checkpointer.step(self)
+            if self.diagnostics is not None and self.diagnostics.exceeded:
+                print(f'Stopped after {k + 1} steps: the energy error exceeds {self.diagnostics.tolerance}')
+                break
+            if self.progress and k % 10 == 0:
+                print(f"{k*100.0/float(steps)}% done")
+        positions, radii = self.finish()
+        if self.viewer is not None:
+            self.viewer.show(positions, radii, self.outlines)
+        return positions, radii
@@ -1,84 +1,174 @@
 import numpy as np
+from flattree import MORTON_BITS, bounding_box
+
+ESCAPER_POLICIES = ['expand', 'drop', 'direct'] # what a QuadTree does with bodies outside its root
+MAX_DEPTH = MORTON_BITS # levels below the root past which a QuadTree leaf keeps its bodies instead of subdividing
+
+
+def quadrupole_moment(mass, d):
+    """Returns the in-plane block of the traceless quadrupole moment of a point mass at offset d.
+    """
+    return mass * (3 * np.outer(d, d) - np.dot(d, d) * np.eye(2))
+
 
 class QuadTree:
     """A class to represent a quadtree.
     === Instance Attributes ===
-    boundary: The boundary of the quadtree in the form of a list of 4 integers [x, y, width, height]. 
+    boundary: The boundary of the quadtree in the form of a list of 4 floats [x, y, width, height]. 
     capacity: The maximum number of bodies that can be stored in a quadtree node. 
     bodies: A list of bodies in the quadtree node. 
     children: A list of 4 quadtree nodes that are children of the current node.
+    escapers: What the root does with a body outside its boundary: 'expand' doubles the
+    root towards it, 'drop' leaves it out of the tree and 'direct' leaves it out of the
+    tree but has it summed directly by the force calculation.
+    escaped: The bodies outside the root that were dropped or kept for direct summation.
+    total_mass: The total mass of the bodies in the node and all its descendants.
+    center_mass: The center of mass of the bodies in the node and all its descendants.
+    quadrupole: The in-plane 2x2 block of the traceless quadrupole moment about center_mass.
+    version: Incremented by refit() whenever the shape of the tree may have changed.
     """
     boundary: list
     capacity: int
     bodies: list
     children: list
+    escapers: str
+    escaped: list
+    total_mass: np.float64
     center_mass: np.array
+    quadrupole: np.array
+    version: int
 
-    def __init__(self, boundary, capacity, bodies=None):
-        self.boundary = boundary
+    def __init__(self, boundary, capacity, bodies=None, escapers='expand'):
+        if escapers not in ESCAPER_POLICIES:
+            raise ValueError(f'unknown escaper policy {escapers!r}, expected one of {ESCAPER_POLICIES}')
+        if boundary is None:
+            # the root is sized to the bodies it starts with
+            bodies = list(bodies) if bodies is not None else []
+            boundary = bounding_box(np.array([body.pos for body in bodies]).reshape(-1, 2))
+        self.boundary = [float(v) for v in boundary]
         self.capacity = capacity
+        self.escapers = escapers
+        self.version = 0
         self.bodies = []
         self.children = []
+        self.escaped = []
         if bodies is not None:
             for body in bodies:
                 self.insert(body)
-        # center of mass
+        self.update_mass()
+
+    def update_mass(self):
+        """Recomputes the total mass, center of mass and quadrupole moment of the node
+        and all its descendants, from the leaves up.
+        Must be called again after inserting bodies or moving them.
+        """
+        for child in self.children:
+            child.update_mass()
         x, y, width, height = self.boundary
-        self.center_mass = np.array([0.0, 0.0])
+        self.total_mass = 0
+        moment = np.array([0.0, 0.0])
         for body in self.bodies:
-            self.center_mass += body.pos * body.mass
-        total_mass = self.get_total_mass()
-        if total_mass != 0:
-            self.center_mass /= sum([body.mass for body in self.bodies])
+            self.total_mass += body.mass
+            moment += body.pos * body.mass
+        for child in self.children:
+            self.total_mass += child.total_mass
+            moment += child.center_mass * child.total_mass
+        if self.total_mass != 0:
+            self.center_mass = moment / self.total_mass
         else:
-            self.center_mass = np.array([x + width // 2, y + height // 2], dtype=np.float64)
+            self.center_mass = np.array([x + width / 2, y + height / 2], dtype=np.float64)
+        # children's moments are shifted to this node's center of mass
+        self.quadrupole = np.zeros((2, 2))
+        for body in self.bodies:
+            self.quadrupole += quadrupole_moment(body.mass, body.pos - self.center_mass)
+        for child in self.children:
+            self.quadrupole += child.quadrupole
+            self.quadrupole += quadrupole_moment(child.total_mass, child.center_mass - self.center_mass)
     
     def insert(self, body):
         """Inserts a body into the quadtree. 
-        If the number of bodies in the node exceeds the capacity, the node is subdivided into 4 children.
+        A body outside the root is handled by the escaper policy.
+        """
+        if not self.contains(body):
+            if self.escapers == 'expand' and np.all(np.isfinite(body.pos)):
+                self.expand(body)
+            else:
+                self.escaped.append(body)
+                return
+        self.place(body)
+
+    def place(self, body, depth=0):
+        """Places a body inside the node, depth levels below the root, into the node or one of its descendants.
+        If the number of bodies in the node exceeds the capacity, the node is subdivided into 4 children,
+        unless it is MAX_DEPTH levels deep: bodies too close to be told apart, such as coincident
+        bodies, stay together in the leaf.
         """
         if len(self.children) > 0:
             index = self.get_index(body)
             # if the body fits in a child node, insert it into that node
             if index != -1:
-                self.children[index].insert(body)
+                self.children[index].place(body, depth + 1)
                 return
         self.bodies.append(body)
-        if len(self.bodies) > self.capacity:
+        if len(self.bodies) > self.capacity and (len(self.children) > 0 or depth < MAX_DEPTH):
             if len(self.children) == 0:
                 self.subdivide()
             i = 0
             while i < len(self.bodies):
                 index = self.get_index(self.bodies[i])
                 if index != -1:
-                    self.children[index].insert(self.bodies.pop(i))
+                    self.children[index].place(self.bodies.pop(i), depth + 1)
                 else:
                     i += 1
 
+    def expand(self, body):
+        """Doubles the root towards the body until it contains it. The old root becomes
+        one quadrant of the new one, so the existing nodes keep their boundaries.
+        """
+        while not self.contains(body):
+            x, y, width, height = self.boundary
+            old = QuadTree(self.boundary, self.capacity, escapers=self.escapers)
+            old.bodies = self.bodies
+            old.children = self.children
+            self.boundary = [x - width if body.pos[0] < x else x,
+                             y - height if body.pos[1] < y else y, 2 * width, 2 * height]
+            self.bodies = []
+            self.children = []
+            self.subdivide()
+            self.children[self.get_quadrant(np.array([x + width / 2, y + height / 2]))] = old
+        self.version += 1
+
     def subdivide(self):
         """Subdivides the quadtree into 4 children.
         """
         x, y, width, height = self.boundary
+        half_width = width / 2
+        half_height = height / 2
         # lower right, lower left, upper left, upper right
-        self.children.append(QuadTree([x + width // 2, y, width // 2, height // 2], self.capacity))
-        self.children.append(QuadTree([x, y, width // 2, height // 2], self.capacity))
-        self.children.append(QuadTree([x, y + height // 2, width // 2, height // 2], self.capacity))
-        self.children.append(QuadTree([x + width // 2, y + height // 2, width // 2, height // 2], self.capacity))
+        self.children.append(QuadTree([x + half_width, y, half_width, half_height], self.capacity, escapers=self.escapers))
+        self.children.append(QuadTree([x, y, half_width, half_height], self.capacity, escapers=self.escapers))
+        self.children.append(QuadTree([x, y + half_height, half_width, half_height], self.capacity, escapers=self.escapers))
+        self.children.append(QuadTree([x + half_width, y + half_height, half_width, half_height], self.capacity, escapers=self.escapers))
 
     def get_index(self, body):
         """Returns the index of the child that the body sits in.
         """
+        return self.get_quadrant(body.pos)
+
+    def get_quadrant(self, pos):
+        """Returns the index of the child that contains the point pos, or -1 if the
+        point is outside the node.
+        """
         x, y, width, height = self.boundary
-        pos = body.pos
-        if x + width // 2 > pos[0] >= x:
-            if y + height // 2 > pos[1] >= y:
+        if x + width / 2 > pos[0] >= x:
+            if y + height / 2 > pos[1] >= y:
                 return 1
-            elif y + height > pos[1] >= y + height // 2:
+            elif y + height > pos[1] >= y + height / 2:
                 return 2
-        elif x + width > pos[0] >= x + width // 2:
-            if y + height // 2 > pos[1] >= y:
+        elif x + width > pos[0] >= x + width / 2:
+            if y + height / 2 > pos[1] >= y:
                 return 0
-            elif y + height > pos[1] >= y + height // 2:
+            elif y + height > pos[1] >= y + height / 2:
                 return 3
         return -1
     
@@ -104,6 +194,13 @@ class QuadTree:
                 count += child.count()
             return count
     
+    def depth(self) -> int:
+        """Returns the number of levels below the node, 0 for a leaf.
+        """
+        if len(self.children) == 0:
+            return 0
+        return 1 + max(child.depth() for child in self.children)
+
     def contains(self, body) -> bool:
         """Returns whether the quadtree node contains the body.
         """
@@ -133,24 +230,96 @@ class QuadTree:
                 lines.extend(child.lines())
             return lines
     
+    def segments(self) -> list:
+        """Returns a list of segments that draw the quadtree: the boundary of the node and
+        the two lines that split each internal node, without duplicates.
+        """
+        x, y, width, height = self.boundary
+        segments = [[x, y, x + width, y], [x, y, x, y + height],
+                    [x + width, y, x + width, y + height], [x, y + height, x + width, y + height]]
+        self.split_lines(segments)
+        return segments
+
+    def split_lines(self, segments):
+        """Appends the lines that split the node and its descendants to segments.
+        """
+        if len(self.children) > 0:
+            x, y, width, height = self.boundary
+            segments.append([x + width / 2, y, x + width / 2, y + height])
+            segments.append([x, y + height / 2, x + width, y + height / 2])
+            for child in self.children:
+                child.split_lines(segments)
+
     def get_bodies(self) -> list:
         """Returns a list of bodies in the quadtree.
         """
         if len(self.children) == 0:
             return self.bodies
         else:
-            bodies = []
+            bodies = list(self.bodies)
             for child in self.children:
-                bodies.extend(child.return_bodies())
+                bodies.extend(child.get_bodies())
             return bodies
-    
+
+    def refit(self) -> float:
+        """Re-inserts the bodies that left their node, merges subtrees that no longer
+        need subdividing and refreshes the node aggregates, keeping the rest of the tree.
+        Returns the fraction of bodies that were re-inserted, the bodies that left their
+        node or are outside the root, which like FlatQuadTree.refit() tells how much of
+        the tree no longer bins the bodies it was built for.
+        """
+        # bodies left outside the root may have come back
+        moved = self.escaped
+        self.escaped = []
+        if len(self.children) > 0:
+            moved.extend(self.bodies)
+            self.bodies = []
+        self.remove_escaped(moved)
+        for body in moved:
+            self.insert(body)
+        # nodes only split or merge when bodies move between them
+        if len(moved) > 0:
+            self.version += 1
+        self.collapse()
+        self.update_mass()
+        total = len(self.get_bodies()) + len(self.escaped)
+        if total == 0:
+            return 0.0
+        return len(moved) / total
+
+    def direct_bodies(self) -> list:
+        """Returns the bodies outside the root that must be summed directly.
+        """
+        return self.escaped if self.escapers == 'direct' else []
+
+    def remove_escaped(self, moved):
+        """Removes the bodies that are no longer inside their node and appends them to moved.
+        """
+        i = 0
+        while i < len(self.bodies):
+            if self.contains(self.bodies[i]):
+                i += 1
+            else:
+                moved.append(self.bodies.pop(i))
+        for child in self.children:
+            child.remove_escaped(moved)
+
+    def collapse(self) -> int:
+        """Turns subtrees holding no more than capacity bodies back into leaves.
+        Returns the number of bodies in the node and its descendants.
+        """
+        total = len(self.bodies)
+        for child in self.children:
+            total += child.collapse()
+        if len(self.children) > 0 and total <= self.capacity:
+            self.bodies = self.get_bodies()
+            self.children = []
+        return total
+
     def get_total_mass(self) -> np.float64:
         """Returns the total mass of the bodies in the quadtree.
         """
-        mass = 0
-        for body in self.bodies:
-            mass += body.mass
-        return mass
+        return self.total_mass
     
     def get_ratio(self, body) -> np.float64:
         """Returns the ratio of the node's width to the distance from the center of mass to the body.
@@ -158,8 +327,9 @@ class QuadTree:
         x, y, width, height = self.boundary
         r = np.linalg.norm(self.center_mass - body.pos)
         if r == 0:
-            return 0
-        return width / np.linalg.norm(self.center_mass - body.pos)
+            # a body sitting on the center of mass always opens the node
+            return np.inf
+        return width / r
 
     def find_node(self, body):
         """Returns the node that contains the body.
@@ -176,6 +346,7 @@ class QuadTree:
         """
         self.bodies = []
         self.children = []
+        self.escaped = []
 
 
 class Body:
@@ -213,4 +384,135 @@ class Body:
     def density(self):
         """Returns the density of the body.
         """
-        return self.mass / (4 / 3 * np.pi * self.radius ** 3)
\ No newline at end of file
+        return self.mass / (4 / 3 * np.pi * self.radius ** 3)
+
+
+class BodyView(Body):
+    """A Body that reads and writes its state through a row of a ParticleSet.
+    === Instance Attributes ===
+    particles: The ParticleSet that stores the state of the body.
+    index: The row of the body in the ParticleSet arrays.
+    """
+    particles: 'ParticleSet'
+    index: int
+
+    def __init__(self, particles, index):
+        self.particles = particles
+        self.index = index
+
+    @property
+    def pos(self):
+        return self.particles.pos[self.index]
+
+    @pos.setter
+    def pos(self, value):
+        self.particles.pos[self.index] = value
+
+    @property
+    def vel(self):
+        return self.particles.vel[self.index]
+
+    @vel.setter
+    def vel(self, value):
+        self.particles.vel[self.index] = value
+
+    @property
+    def acc(self):
+        return self.particles.acc[self.index]
+
+    @acc.setter
+    def acc(self, value):
+        self.particles.acc[self.index] = value
+
+    @property
+    def mass(self):
+        return self.particles.mass[self.index]
+
+    @mass.setter
+    def mass(self, value):
+        self.particles.mass[self.index] = value
+
+    @property
+    def radius(self):
+        return self.particles.radius[self.index]
+
+    @radius.setter
+    def radius(self, value):
+        self.particles.radius[self.index] = value
+
+
+class ParticleSet:
+    """A class to represent a set of celestial bodies as contiguous arrays, in 2D or 3D.
+    === Instance Attributes ===
+    pos: An (N, D) array of positions in meters.
+    vel: An (N, D) array of velocities in meters per second.
+    acc: An (N, D) array of accelerations in meters per second squared.
+    mass: An (N,) array of masses in kilograms.
+    radius: An (N,) array of radii in meters.
+    """
+    pos: np.ndarray
+    vel: np.ndarray
+    acc: np.ndarray
+    mass: np.ndarray
+    radius: np.ndarray
+
+    def __init__(self, pos, vel, mass, radius, acc=None):
+        self.pos = np.array(pos, dtype=np.float64)
+        if self.pos.ndim != 2:
+            self.pos = self.pos.reshape(-1, 2)
+        n, dim = self.pos.shape
+        self.vel = np.array(np.broadcast_to(vel, (n, dim)), dtype=np.float64)
+        if acc is None:
+            self.acc = np.zeros((n, dim))
+        else:
+            self.acc = np.array(np.broadcast_to(acc, (n, dim)), dtype=np.float64)
+        self.mass = np.array(np.broadcast_to(mass, (n,)), dtype=np.float64)
+        self.radius = np.array(np.broadcast_to(radius, (n,)), dtype=np.float64)
+
+    @classmethod
+    def from_bodies(cls, bodies):
+        """Returns a ParticleSet holding a copy of the state of the bodies.
+        """
+        return cls([body.pos for body in bodies], [body.vel for body in bodies],
+                   [body.mass for body in bodies], [body.radius for body in bodies],
+                   [body.acc for body in bodies])
+
+    def __len__(self):
+        return len(self.pos)
+
+    @property
+    def dim(self) -> int:
+        return self.pos.shape[1]
+
+    def __getitem__(self, index):
+        return BodyView(self, index)
+
+    def __iter__(self):
+        return iter(self.bodies())
+
+    def bodies(self) -> list:
+        """Returns a list of Body views, one per row of the arrays.
+        """
+        return [BodyView(self, i) for i in range(len(self))]
+
+    def update(self, delta, timestep):
+        """Updates the positions and velocities of all bodies at once.
+        """
+        self.vel += self.acc * delta * timestep
+        self.pos += self.vel * delta * timestep
+
+    def compact(self, keep):
+        """Removes the bodies where the boolean mask keep is False.
+        Body views created before compacting are invalidated.
+        """
+        keep = np.asarray(keep, dtype=bool)
+        self.pos = self.pos[keep]
+        self.vel = self.vel[keep]
+        self.acc = self.acc[keep]
+        self.mass = self.mass[keep]
+        self.radius = self.radius[keep]
+
+    def density(self) -> np.ndarray:
+        """Returns the density of every body.
+        """
+        return self.mass / (4 / 3 * np.pi * self.radius ** 3)
@@ -0,0 +1,38 @@
+import numpy as np
+import nbody
+from checkpoint import _object_tree, _object_tree_arrays
+
+OPTIONS = ['--ic', 'plummer', '--bodies', '200', '--object-tree', '--quiet'] # a small object tree run
+
+
+def run(steps, *options):
+    simulation = nbody.build(nbody.parse_args([*OPTIONS, '--steps', str(steps), *options]))
+    simulation.run(steps)
+    return simulation
+
+
+def test_object_tree_round_trip():
+    simulation = run(5)
+    tree = simulation.engine.tree
+    restored = _object_tree({'capacity': tree.capacity, 'escapers': tree.escapers, 'version': tree.version},
+                            _object_tree_arrays(tree), simulation.engine.bodies)
+    expected = _object_tree_arrays(tree)
+    got = _object_tree_arrays(restored)
+    for name in expected:
+        assert np.array_equal(expected[name], got[name]), name
+    assert restored.version == tree.version
+
+
+def test_checkpoints_leave_the_object_tree_run_unchanged(tmp_path):
+    plain = run(20)
+    checkpointed = run(20, '--checkpoint', str(tmp_path / 'ck.npz'), '--checkpoint-every', '3')
+    assert np.array_equal(np.array(plain.sink.positions), np.array(checkpointed.sink.positions))
+
+
+def test_object_tree_resume_is_bit_identical(tmp_path):
+    plain = run(20)
+    path = str(tmp_path / 'ck.npz')
+    run(11, '--checkpoint', path, '--checkpoint-every', '11')
+    resumed = nbody.build(nbody.parse_args(['--resume', path, '--steps', '20']))
+    resumed.run(20)
+    assert np.array_equal(np.array(plain.sink.positions), np.array(resumed.sink.positions))
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from diagnostics import FIELDS, Diagnostics, angular_momentum, measure, potential_energy
+from initial_conditions import plummer
+from integrators import make_integrator
+from simulation import Simulation, TreeEngine
+from structures import ParticleSet
+
+
+def test_angular_momentum_3d_vector():
+    # a ring spinning about the x axis has no z component
+    angle = np.linspace(0, 2 * np.pi, 16, endpoint=False)
+    pos = np.stack([np.zeros(16), np.cos(angle), np.sin(angle)], axis=1)
+    vel = np.stack([np.zeros(16), -np.sin(angle), np.cos(angle)], axis=1)
+    spin = angular_momentum(ParticleSet(pos, vel, 2.0, 1.0))
+    assert np.allclose(spin, [32.0, 0.0, 0.0])
+
+
+def test_angular_momentum_2d_is_z():
+    particles = plummer(200, seed=0)
+    spin = angular_momentum(particles)
+    assert spin[0] == 0 and spin[1] == 0
+    pos3 = np.concatenate([particles.pos, np.zeros((200, 1))], axis=1)
+    vel3 = np.concatenate([particles.vel, np.zeros((200, 1))], axis=1)
+    assert np.allclose(angular_momentum(ParticleSet(pos3, vel3, particles.mass, 1.0)), spin)
+
+
+def test_measure_fields():
+    record = measure(plummer(200, seed=0, dim=3))
+    assert set(record) | {'step', 'time', 'energy_error'} == set(FIELDS)
+
+
+def test_initial_virial_ratio():
+    # plummer() virializes the bodies, and no force was evaluated before step 0
+    diagnostics = Diagnostics(every=1)
+    simulation = Simulation(plummer(300, seed=0), TreeEngine(0.5, 8), progress=False, diagnostics=diagnostics)
+    simulation.run(1)
+    assert abs(diagnostics.records[0]['virial_ratio'] - 1) < 0.1
+
+
+def test_potential_on_current_positions():
+    # the tree of --rebuild runs lags the bodies between rebuilds
+    diagnostics = Diagnostics(every=1)
+    engine = TreeEngine(0.5, 8, incremental=False, update_freq=5)
+    simulation = Simulation(plummer(300, seed=0), engine, progress=False, diagnostics=diagnostics)
+    simulation.run(3)
+    assert diagnostics.records[-1]['potential'] == potential_energy(simulation.particles)
+
+
+@pytest.mark.parametrize('name', ['euler', 'leapfrog', 'yoshida4'])
+def test_stored_accelerations_are_current(name):
+    particles = plummer(300, seed=0)
+    engine = TreeEngine(0.5, 8)
+    simulation = Simulation(particles, engine, make_integrator(name), progress=False)
+    simulation.run(2)
+    assert np.allclose(particles.acc, engine.accelerations(particles), rtol=1e-12, atol=0)
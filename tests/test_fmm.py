@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from fmm import FastMultipole
+from flattree import FlatQuadTree
+from initial_conditions import collision, plummer, uniform
+
+
+@pytest.mark.parametrize('generator', [uniform, plummer, collision])
+def test_error_against_direct(generator):
+    particles = generator(5000, seed=0)
+    error = FastMultipole().error(particles.pos, particles.mass)
+    assert error['median'] < 1e-3
+    # bodies whose attractions nearly cancel have larger relative errors
+    assert error['max'] < 0.1
+
+
+def test_targets():
+    particles = plummer(3000, seed=1)
+    fmm = FastMultipole()
+    targets = np.array([5, 2999, 0, 1234])
+    assert np.allclose(fmm.accelerations(particles.pos, particles.mass, targets),
+                       fmm.accelerations(particles.pos, particles.mass)[targets], rtol=1e-12)
+
+
+@pytest.mark.parametrize('generator', [uniform, plummer, collision])
+def test_every_leaf_sees_every_body_once(generator):
+    particles = generator(20000, seed=2)
+    tree = FlatQuadTree(particles.pos, particles.mass, 16)
+    coords = np.rint((tree.bounds[:, :2] - tree.boundary[:2]) / tree.bounds[:, 2:3]).astype(np.int64)
+    lists = FastMultipole.interaction_lists(tree, coords)
+    cells = len(tree.count)
+    # the far field of a cell is that of its V and X lists plus the far field of its parent
+    far = np.zeros(cells)
+    for name in ['v', 'x']:
+        target, source = lists[name]
+        np.add.at(far, target, tree.count[source])
+    internal = np.flatnonzero(tree.child[:, 0] != -1)
+    for parent in internal:
+        far[tree.child[parent]] += far[parent]
+    target, source = lists['u']
+    near = np.bincount(target, weights=tree.count[source], minlength=cells)
+    target, source = lists['x']
+    w = np.bincount(source, weights=tree.count[target], minlength=cells)
+    leaves = np.flatnonzero((tree.child[:, 0] == -1) & (tree.count > 0))
+    assert np.all(far[leaves] + near[leaves] + w[leaves] == len(particles))
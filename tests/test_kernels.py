@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+import kernels
+from forces import direct_accelerations
+from flattree import FlatQuadTree, morton_keys
+from collisions import collision_pairs, merge_collisions
+from initial_conditions import plummer
+from structures import ParticleSet
+
+pytestmark = pytest.mark.skipif(not kernels.NUMBA_AVAILABLE, reason='numba is not installed')
+
+N = 3000 # bodies of the compared systems
+TOLERANCE = 1e-10 # largest relative difference of the accelerations, the backends only round differently
+
+
+def both(function):
+    """Returns the results of function with the NumPy and the numba backend.
+    """
+    previous = kernels.BACKEND
+    try:
+        results = []
+        for backend in ['numpy', 'numba']:
+            kernels.set_backend(backend)
+            results.append(function())
+        return results
+    finally:
+        kernels.set_backend(previous)
+
+
+def relative_difference(a, b) -> float:
+    return float(np.max(np.linalg.norm(a - b, axis=1) / np.linalg.norm(a, axis=1)))
+
+
+@pytest.fixture(params=[2, 3], ids=['2d', '3d'])
+def particles(request):
+    return plummer(N, seed=0, dim=request.param)
+
+
+def test_direct(particles):
+    expected, got = both(lambda: direct_accelerations(particles.pos, particles.mass))
+    assert relative_difference(expected, got) < TOLERANCE
+
+
+def test_direct_targets(particles):
+    targets = np.arange(0, N, 7)
+    expected, got = both(lambda: direct_accelerations(particles.pos, particles.mass, targets=targets))
+    assert got.shape == (len(targets), particles.dim)
+    assert relative_difference(expected, got) < TOLERANCE
+
+
+def test_morton_keys(particles):
+    boundary = np.concatenate([particles.pos.min(axis=0), np.ptp(particles.pos, axis=0)])
+    expected, got = both(lambda: morton_keys(particles.pos, boundary))
+    assert np.array_equal(expected, got)
+
+
+def test_tree_order(particles):
+    expected, got = both(lambda: FlatQuadTree(particles.pos, particles.mass, 8).order)
+    assert np.array_equal(expected, got)
+
+
+@pytest.mark.parametrize('quadrupole', [False, True], ids=['monopole', 'quadrupole'])
+@pytest.mark.parametrize('theta', [0.0, 0.5, 1.0])
+def test_tree_walk(particles, quadrupole, theta):
+    tree = FlatQuadTree(particles.pos, particles.mass, 8, quadrupole=quadrupole)
+    expected, got = both(lambda: tree.accelerations(particles.pos, particles.mass, theta))
+    assert relative_difference(expected, got) < TOLERANCE
+
+
+def test_tree_walk_targets(particles):
+    tree = FlatQuadTree(particles.pos, particles.mass, 8, quadrupole=True)
+    targets = np.random.default_rng(1).choice(N, 500, replace=False)
+    expected, got = both(lambda: tree.accelerations(particles.pos, particles.mass, 0.5, targets=targets))
+    assert got.shape == (len(targets), particles.dim)
+    assert relative_difference(expected, got) < TOLERANCE
+
+
+def test_tree_walk_refitted(particles):
+    tree = FlatQuadTree(particles.pos, particles.mass, 8, quadrupole=True)
+    pos = particles.pos + np.random.default_rng(2).normal(0, 1e7, particles.pos.shape)
+    tree.refit(pos, particles.mass)
+    expected, got = both(lambda: tree.accelerations(pos, particles.mass, 0.5))
+    assert relative_difference(expected, got) < TOLERANCE
+
+
+def test_tree_counters(particles):
+    class Counter:
+        def __init__(self):
+            self.counts = {}
+
+        def count(self, name, value=1):
+            self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    tree = FlatQuadTree(particles.pos, particles.mass, 8)
+
+    def counts():
+        counter = Counter()
+        tree.accelerations(particles.pos, particles.mass, 0.5, stats=counter)
+        return counter.counts
+
+    expected, got = both(counts)
+    assert expected == got
+
+
+def pairs(i, j) -> set:
+    return set(zip(np.minimum(i, j).tolist(), np.maximum(i, j).tolist()))
+
+
+def test_collision_pairs(particles):
+    radius = np.full(N, 0.01 * float(np.ptp(particles.pos)))
+    expected, got = both(lambda: pairs(*collision_pairs(particles.pos, radius)))
+    assert len(expected) > 0
+    assert expected == got
+
+
+def test_merge_collisions(particles):
+    def merged():
+        copy = ParticleSet(particles.pos, particles.vel, particles.mass, 0.005 * float(np.ptp(particles.pos)))
+        merge_collisions(copy)
+        return copy
+
+    expected, got = both(merged)
+    assert len(got) < N
+    assert np.array_equal(expected.pos, got.pos)
+    assert np.array_equal(expected.mass, got.mass)
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from forces import direct_accelerations
+from flattree import FlatQuadTree
+from initial_conditions import plummer, uniform
+from simulation import TreeEngine
+
+THETA = 0.5 # opening criterion of the compared walks
+
+
+def errors(acc, exact) -> np.ndarray:
+    return np.linalg.norm(acc - exact, axis=1) / np.linalg.norm(exact, axis=1)
+
+
+@pytest.mark.parametrize('dim', [2, 3])
+@pytest.mark.parametrize('generator', [plummer, uniform])
+def test_flat_tree_quadrupole_reduces_error(generator, dim):
+    particles = generator(3000, seed=0, dim=dim)
+    exact = direct_accelerations(particles.pos, particles.mass)
+    monopole, quadrupole = [errors(FlatQuadTree(particles.pos, particles.mass, 8, quadrupole=q)
+                                   .accelerations(particles.pos, particles.mass, THETA), exact)
+                            for q in [False, True]]
+    assert np.median(quadrupole) < np.median(monopole)
+    assert np.percentile(quadrupole, 99) < np.percentile(monopole, 99)
+    assert quadrupole.max() < monopole.max()
+
+
+def test_object_tree_quadrupole_reduces_error():
+    particles = plummer(500, seed=0)
+    exact = direct_accelerations(particles.pos, particles.mass)
+    monopole, quadrupole = [errors(TreeEngine(THETA, 1, flat=False, quadrupole=q).accelerations(particles), exact)
+                            for q in [False, True]]
+    assert np.median(quadrupole) < np.median(monopole)
+    assert quadrupole.max() < monopole.max()
@@ -0,0 +1,35 @@
+import numpy as np
+from simulation import TreeEngine
+from structures import MAX_DEPTH, ParticleSet, QuadTree
+
+
+def test_coincident_bodies_stop_subdividing():
+    # merged bodies can end up at the same position, which no split separates
+    pos = np.array([[0.0, 0.0], [0.0, 0.0], [0.0, 0.0], [1e9, 1e9]])
+    particles = ParticleSet(pos, np.zeros((4, 2)), 1.0, 1.0)
+    tree = QuadTree(None, 1, particles.bodies())
+    assert tree.depth() == MAX_DEPTH
+    assert len(tree.get_bodies()) == 4
+    assert tree.total_mass == 4
+    assert tree.refit() == 0.0
+
+
+def test_refit_returns_the_reinserted_fraction():
+    rng = np.random.default_rng(0)
+    particles = ParticleSet(rng.uniform(0, 1e9, (100, 2)), np.zeros((100, 2)), 1.0, 1.0)
+    tree = QuadTree(None, 1, particles.bodies())
+    assert tree.refit() == 0.0
+    # swapping two distant bodies moves both out of their leaves
+    particles.pos[[0, 1]] = particles.pos[[1, 0]]
+    assert tree.refit() == 0.02
+
+
+def test_object_tree_rebuilds_past_the_threshold():
+    rng = np.random.default_rng(0)
+    particles = ParticleSet(rng.uniform(0, 1e9, (100, 2)), np.zeros((100, 2)), 1.0, 1.0)
+    engine = TreeEngine(body_limit=1, flat=False, rebuild_threshold=0.25)
+    engine.start(particles)
+    tree = engine.tree
+    particles.pos[:] = rng.uniform(0, 1e9, (100, 2))
+    engine.accelerations(particles)
+    assert engine.tree is not tree
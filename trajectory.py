@@ -0,0 +1,169 @@
+import json
+import os
+import numpy as np
+
+MAGIC = b'NBODYTRJ'
+HEADER_SIZE = 4096 # bytes reserved for the header before the first frame
+UNITS = {'pos': 'm', 'radius': 'm', 'dt': 's'}
+
+
+def frame_dtype(n, radii, dim=2) -> np.dtype:
+    """Returns the record type of one frame of n bodies in dim dimensions.
+    """
+    fields = [('pos', '<f8', (n, dim))]
+    if radii:
+        fields.append(('radius', '<f8', (n,)))
+    return np.dtype(fields)
+
+
+def read_header(path) -> dict:
+    """Returns the header of a trajectory file.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    if not raw.startswith(MAGIC):
+        raise ValueError(f'{path} is not a trajectory file')
+    return json.loads(raw[len(MAGIC):].decode('utf-8'))
+
+
+def write_header(f, header):
+    """Writes the header at the start of an open trajectory file.
+    """
+    raw = MAGIC + json.dumps(header).encode('utf-8')
+    if len(raw) > HEADER_SIZE:
+        raise ValueError('trajectory header is too large')
+    f.seek(0)
+    f.write(raw.ljust(HEADER_SIZE, b' '))
+
+
+class TrajectoryWriter:
+    """A class to stream simulation frames into a preallocated, memory-mapped file.
+    The file holds a fixed-size JSON header followed by one record per frame, so
+    memory use does not grow with the length of the run.
+    === Instance Attributes ===
+    path: The path of the trajectory file.
+    header: The header of the file: number of bodies, frame capacity, frames written,
+    seconds per step, dimensions and units.
+    frames: The memory-mapped frame records.
+    """
+    path: str
+    header: dict
+    frames: np.memmap
+
+    def __init__(self, path, n, steps, dt, radii=False, metadata=None, dim=2):
+        self.path = path
+        self.header = {'n': int(n), 'steps': int(steps), 'frames': 0, 'dt': float(dt),
+                       'radii': bool(radii), 'dim': int(dim), 'units': UNITS, 'metadata': metadata or {}}
+        dtype = frame_dtype(n, radii, dim)
+        with open(path, 'wb') as f:
+            write_header(f, self.header)
+            # the frames are allocated up front, sparsely where the file system allows it
+            f.truncate(HEADER_SIZE + dtype.itemsize * steps)
+        self.frames = np.memmap(path, dtype=dtype, mode='r+', offset=HEADER_SIZE, shape=(steps,))
+
+    @classmethod
+    def reopen(cls, path, frames, steps):
+        """Returns a writer appending to an existing trajectory file after its first
+        frames frames, with room for steps frames in total. Later frames are dropped.
+        """
+        writer = cls.__new__(cls)
+        writer.path = path
+        writer.header = read_header(path)
+        if writer.header['frames'] < frames:
+            raise ValueError(f'{path} holds {writer.header["frames"]} frames, {frames} are needed')
+        writer.header['frames'] = frames
+        writer.header['steps'] = max(int(steps), frames)
+        dtype = frame_dtype(writer.header['n'], writer.header['radii'], writer.header.get('dim', 2))
+        with open(path, 'r+b') as f:
+            write_header(f, writer.header)
+            f.truncate(HEADER_SIZE + dtype.itemsize * writer.header['steps'])
+        writer.frames = np.memmap(path, dtype=dtype, mode='r+', offset=HEADER_SIZE, shape=(writer.header['steps'],))
+        return writer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, pos, radius=None):
+        """Appends a frame. Bodies missing from the end of pos, for example after merging,
+        are stored as NaN positions with zero radius.
+        """
+        i = self.header['frames']
+        if i >= self.header['steps']:
+            raise ValueError('trajectory file is full')
+        frame_pos = self.frames['pos'][i]
+        frame_pos[:] = np.nan
+        frame_pos[:len(pos)] = pos
+        if self.header['radii']:
+            frame_radius = self.frames['radius'][i]
+            frame_radius[:] = 0
+            if radius is not None:
+                frame_radius[:len(radius)] = radius
+        self.header['frames'] = i + 1
+
+    def flush(self):
+        """Writes the frames and the frame count to disk.
+        """
+        self.frames.flush()
+        with open(self.path, 'r+b') as f:
+            write_header(f, self.header)
+
+    def close(self):
+        """Flushes the file and drops the frames that were allocated but never written.
+        """
+        if self.frames is None:
+            return
+        self.flush()
+        size = HEADER_SIZE + self.frames.dtype.itemsize * self.header['frames']
+        # the memory map must be released before the file can shrink
+        self.frames = None
+        os.truncate(self.path, size)
+
+
+class TrajectoryReader:
+    """A class to read frames of a trajectory file lazily through a memory map.
+    Only the frames that are indexed are read from disk.
+    === Instance Attributes ===
+    path: The path of the trajectory file.
+    header: The header of the file.
+    frames: The memory-mapped frame records.
+    """
+    path: str
+    header: dict
+    frames: np.memmap
+
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        # files written before 3D support hold 2D frames
+        dtype = frame_dtype(self.header['n'], self.header['radii'], self.header.get('dim', 2))
+        count = self.header['frames']
+        if count == 0:
+            self.frames = np.zeros(0, dtype=dtype)
+        else:
+            self.frames = np.memmap(path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def n(self) -> int:
+        return self.header['n']
+
+    @property
+    def dt(self) -> float:
+        return self.header['dt']
+
+    def positions(self, start=0, stop=None, stride=1) -> np.ndarray:
+        """Returns a lazy (frames, N, D) view of the positions of a range of frames.
+        """
+        return self.frames['pos'][start:stop:stride]
+
+    def radii(self, start=0, stop=None, stride=1) -> np.ndarray:
+        """Returns a lazy (frames, N) view of the radii of a range of frames.
+        """
+        if not self.header['radii']:
+            raise ValueError(f'{self.path} does not store radii')
+        return self.frames['radius'][start:stop:stride]